@@ -0,0 +1,156 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+import time
+
+# Каталог instance/ уже используется Flask для forum.db
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+DEFAULT_CACHE_PATH = os.path.join(INSTANCE_DIR, 'analysis_cache.db')
+
+
+def normalize_text(text):
+    """
+    Нормализует текст перед хешированием: одинаковые по смыслу тексты,
+    отличающиеся только пробелами и переводами строк, дают один ключ.
+    """
+    if not text:
+        return ''
+    return ' '.join(text.replace('\r\n', '\n').split())
+
+
+def make_cache_key(text, model, prompt_version):
+    """
+    Формирует ключ кэша из нормализованного текста, модели и версии промпта.
+
+    Args:
+        text (str): Исходный текст
+        model (str): Название модели
+        prompt_version (str): Версия промпта
+
+    Returns:
+        str: SHA-256 хеш в шестнадцатеричном виде
+    """
+    payload = f"{model}\x00{prompt_version}\x00{normalize_text(text)}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Персистентный кэш результатов в SQLite с TTL и LRU-вытеснением.
+
+    Каждый экземпляр работает со своей таблицей, поэтому в одном файле
+    можно хранить несколько независимых кэшей.
+    """
+
+    def __init__(self, table='emotion_analysis', db_path=None, ttl_seconds=None, max_entries=None):
+        self.table = table
+        self.db_path = db_path or os.environ.get('ANALYSIS_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.ttl_seconds = int(ttl_seconds if ttl_seconds is not None
+                               else os.environ.get('ANALYSIS_CACHE_TTL', 7 * 24 * 3600))
+        self.max_entries = int(max_entries if max_entries is not None
+                               else os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', 5000))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_last_access "
+                         f"ON {self.table} (last_access)")
+
+    def get(self, key):
+        """
+        Возвращает значение из кэша или None, если записи нет или она устарела.
+        """
+        now = time.time()
+        try:
+            with self._lock, self._connect() as conn:
+                row = conn.execute(f"SELECT value, created_at FROM {self.table} WHERE key = ?",
+                                   (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                value, created_at = row
+                if self.ttl_seconds > 0 and now - created_at > self.ttl_seconds:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    self.misses += 1
+                    return None
+                conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+                self.hits += 1
+            return json.loads(value)
+        except Exception as e:
+            print(f"Ошибка при чтении кэша {self.table}: {str(e)}")
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """
+        Сохраняет значение в кэш и при необходимости вытесняет самые старые по доступу записи.
+        """
+        now = time.time()
+        try:
+            data = json.dumps(value, ensure_ascii=False)
+            with self._lock, self._connect() as conn:
+                conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, last_access) "
+                             f"VALUES (?, ?, ?, ?)", (key, data, now, now))
+                self._evict(conn, now)
+        except Exception as e:
+            print(f"Ошибка при записи в кэш {self.table}: {str(e)}")
+
+    def delete(self, key):
+        """
+        Удаляет запись из кэша.
+        """
+        try:
+            with self._lock, self._connect() as conn:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        except Exception as e:
+            print(f"Ошибка при удалении из кэша {self.table}: {str(e)}")
+
+    def _evict(self, conn, now):
+        if self.ttl_seconds > 0:
+            conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.ttl_seconds,))
+        if self.max_entries > 0:
+            conn.execute(f"""
+                DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM {self.table}
+                    ORDER BY last_access DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    def stats(self):
+        """
+        Возвращает счетчики попаданий/промахов и текущий размер кэша.
+        """
+        try:
+            with self._lock, self._connect() as conn:
+                size = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        except Exception:
+            size = None
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'size': size,
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds
+        }
@@ -1,5 +1,15 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response
-from war_diary_analyzer import WarDiaryAnalyzer
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response, send_from_directory, send_file, abort
+from war_diary_analyzer import get_analyzer, analysis_cache, generation_executor, abandon_stage, STAGE_TIMEOUTS, safe_image_pool
+from job_queue import JobQueue
+import emotion_lexicon
+from media_storage import GENERATED_IMAGES_DIR
+from image_derivatives import derivative_urls, variant_path, is_original, schedule_derivatives, DERIVATIVE_WIDTHS, FULL_VARIANT
+from music_metadata import metadata_store
+from music_poller import music_poller, MUSIC_MAX_WAIT_SECONDS
+from asset_fetcher import asset_fetcher
+from audio_proxy import audio_cache, proxy_url_for, is_allowed_url
+from media_retention import media_retention
+from notifications import music_events
 from forum import init_forum, db, User, Topic, Message, TopicVote, MessageVote, UserFeedback
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 import os
@@ -8,8 +18,10 @@ from datetime import datetime
 from dotenv import load_dotenv, find_dotenv, dotenv_values
 import json
 import requests
-from urllib.parse import quote
-import urllib.parse
+import queue
+import re
+import threading
+import time
 
 # Улучшенная загрузка переменных окружения
 env_path = find_dotenv() 
@@ -40,6 +52,8 @@ print("OPENAI_API_KEY:", "Установлен" if os.environ.get("OPENAI_API_KE
 print("SUNOAI_API_KEY:", "Установлен" if os.environ.get("SUNOAI_API_KEY") else "НЕ УСТАНОВЛЕН")
 
 app = Flask(__name__)
+# Абсолютный путь: и проверка наличия файла, и send_from_directory не зависят от текущего каталога
+GENERATED_IMAGES_ROOT = os.path.join(app.root_path, GENERATED_IMAGES_DIR)
 app.config['SECRET_KEY'] = os.urandom(24)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///forum.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -50,6 +64,58 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 init_forum(app)
 
+# Персистентная очередь задач генерации (instance/jobs.db)
+job_queue = JobQueue()
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_services():
+    """
+    Запускает фоновые службы рабочего процесса (однократно).
+    Вызывается при запуске приложения (см. конец модуля), а для WSGI-серверов,
+    импортирующих приложение без BACKGROUND_SERVICES_ON_START, — при первом запросе.
+    """
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    # Задачи, оставшиеся после падения процесса на этом хосте, возвращаются в очередь при запуске;
+    # задачи процессов других хостов — после истечения аренды (JOB_LEASE_SECONDS)
+    job_queue.start()
+    # Метаданные музыки раньше хранились в публично доступных JSON-файлах; переносим их в SQLite
+    # один раз, а сами файлы убираем в instance/legacy_music_metadata
+    imported = metadata_store.import_legacy_files_once()
+    if imported:
+        print(f"Перенесены метаданные музыкальных задач из JSON-файлов: {imported}")
+    music_poller.start()
+    # Заранее генерируем запасные безопасные изображения (расходует вызовы DALL-E, поэтому по запросу)
+    if os.environ.get('SAFE_IMAGE_POOL_PREFILL', '0').lower() in ('1', 'true', 'yes'):
+        try:
+            safe_image_pool.fill_in_background(get_analyzer().generate_image)
+        except Exception as e:
+            # Без ключа OpenAI анализатор не создается; остальные страницы (форум) должны работать
+            print(f"Пул безопасных изображений не пополняется: {str(e)}")
+    # Ограничение объема и срока хранения сгенерированных файлов
+    if os.environ.get('MEDIA_RETENTION', '1').lower() in ('1', 'true', 'yes'):
+        media_retention.start()
+
+@app.before_request
+def ensure_background_services():
+    start_background_services()
+
+@app.after_request
+def record_media_access(response):
+    """
+    Отмечает обращения к сгенерированным файлам для очистки по давности использования.
+    """
+    if response.status_code in (200, 206, 304):
+        if request.path.startswith(('/static/generated_images/', '/static/generated_music/')):
+            media_retention.record_access(request.path.lstrip('/'))
+        elif request.path.startswith('/images/') and request.view_args:
+            media_retention.record_access(os.path.join(GENERATED_IMAGES_DIR, request.view_args.get('filename', '')))
+    return response
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -84,8 +150,23 @@ def analyze():
         print(f"Получен текст дневника длиной {len(diary_text)} символов")
         print(f"Выбранные типы генерации: {generation_types}")
         
-        # Создаем анализатор и проводим эмоциональный анализ
-        analyzer = WarDiaryAnalyzer()
+        # По умолчанию только ставим задачу в очередь и сразу возвращаем ее идентификатор:
+        # генерация выполняется исполнителями очереди, а не потоком обработки запроса.
+        # Синхронный ответ с результатами — только по явному запросу (sync=1)
+        if request.form.get('sync', '').lower() not in ('1', 'true', 'yes'):
+            job_id = job_queue.enqueue('analyze', {
+                'diary_text': diary_text,
+                'generation_types': generation_types,
+                'base_url': os.environ.get('EXTERNAL_URL', request.host_url.rstrip('/'))
+            })
+            return jsonify({
+                'job_id': job_id,
+                'status': 'queued',
+                'status_url': url_for('job_status', job_id=job_id)
+            }), 202
+        
+        # Используем общий анализатор и проводим эмоциональный анализ
+        analyzer = get_analyzer()
         
         # Сначала всегда проводим эмоциональный анализ
         emotions = analyzer.analyze_emotions(diary_text)
@@ -99,144 +180,33 @@ def analyze():
                 'emotion_analysis': emotions,
             }), 500
         
-        # Формируем ответ, всегда включаем анализ эмоций
+        # Формируем ответ, всегда включаем анализ эмоций и его идентификатор для повторных запросов
         response_data = {
             'emotion_analysis': emotions,
+            'analysis_id': analyzer.register_analysis(diary_text, emotions),
+            # Словарный анализ вместо GPT (API не ответил вовремя)
+            'degraded': bool(emotions.get('degraded')),
         }
         
-        # На основе эмоционального анализа генерируем выбранные типы контента
-        if 'text' in generation_types:
-            print("Начало генерации художественного произведения")
-            literary_work = analyzer.generate_literary_work(diary_text, emotions)
-            print(f"Генерация текста завершена, длина: {len(literary_work)}")
-            response_data['generated_literary_work'] = literary_work
-        
+        # На основе эмоционального анализа параллельно генерируем выбранные типы контента
         if 'image' in generation_types:
-            try:
-                print("Начало генерации изображения")
-                # Убедимся, что папка для изображений существует
-                os.makedirs(os.path.join('static', 'generated_images'), exist_ok=True)
-                
-                image_result = analyzer.generate_image_from_diary(diary_text, emotions)
-                print(f"Генерация изображения завершена: {image_result.get('success', False)}")
-                
-                if image_result.get('success', False):
-                    # Преобразуем пути к изображениям в URL-адреса
-                    local_path = image_result.get('local_path', '')
-                    print(f"Локальный путь к изображению: {local_path}")
-                    
-                    if local_path and os.path.exists(local_path):
-                        # Если путь начинается с 'static/', преобразуем его в URL
-                        if local_path.startswith('static/'):
-                            image_url = '/' + local_path
-                        elif local_path.startswith('static\\'):
-                            # Для Windows пути
-                            image_url = '/' + local_path.replace('\\', '/')
-                        else:
-                            # Пытаемся преобразовать любой другой путь
-                            image_url = '/' + local_path.replace('\\', '/')
-                    else:
-                        # Если локальный путь не существует, используем внешний URL
-                        image_url = image_result.get('image_url', '')
-                        print(f"Локальный путь не найден, используем внешний URL")
-                    
-                    print(f"URL изображения: {image_url}")
-                    
-                    response_data['generated_image'] = {
-                        'success': True,
-                        'image_url': image_url,
-                        'external_url': image_result.get('image_url', '')
-                    }
-                else:
-                    error_message = image_result.get('error', 'Неизвестная ошибка при генерации изображения')
-                    print(f"Ошибка генерации изображения: {error_message}")
-                    
-                    # Проверяем, связана ли ошибка с политикой содержания
-                    if 'type' in image_result and image_result['type'] == 'content_policy_violation':
-                        # Если тип уже определен в image_result, используем его напрямую
-                        response_data['generated_image'] = {
-                            'success': False,
-                            'error': error_message,
-                            'type': 'content_policy_violation',
-                            'can_regenerate_safe': image_result.get('can_regenerate_safe', True),
-                            'technical_error': image_result.get('technical_error', '')
-                        }
-                    elif any(term in error_message.lower() for term in 
-                          ["content_policy_violation", "policy", "violates", "content policy", "насилия", "насилие"]):
-                        # Если ошибка похожа на нарушение политики содержания
-                        response_data['generated_image'] = {
-                            'success': False,
-                            'error': "Текст содержит описания, которые невозможно визуализировать согласно политике OpenAI.",
-                            'type': 'content_policy_violation',
-                            'can_regenerate_safe': True,
-                            'technical_error': error_message
-                        }
-                    else:
-                        # Другие типы ошибок
-                        response_data['generated_image'] = {
-                            'success': False,
-                            'error': error_message
-                        }
-            except Exception as img_error:
-                print(f"Исключение при генерации изображения: {str(img_error)}")
-                import traceback
-                traceback.print_exc()
-                
-                error_message = str(img_error)
-                # Проверяем, связана ли ошибка с политикой содержания
-                if any(term in error_message.lower() for term in 
-                      ["content_policy_violation", "policy", "violates", "content policy", "насилия", "насилие"]):
-                    response_data['generated_image'] = {
-                        'success': False,
-                        'error': "Текст содержит описания, которые невозможно визуализировать согласно политике OpenAI.",
-                        'type': 'content_policy_violation',
-                        'can_regenerate_safe': True,
-                        'technical_error': error_message
-                    }
-                else:
-                    response_data['generated_image'] = {
-                        'success': False,
-                        'error': f"Ошибка: {str(img_error)}"
-                    }
+            # Убедимся, что папка для изображений существует
+            os.makedirs(os.path.join('static', 'generated_images'), exist_ok=True)
+        if 'music' in generation_types:
+            # Убедимся, что папка для музыки существует
+            os.makedirs(os.path.join('static', 'generated_music'), exist_ok=True)
         
+        # Используем внешний URL, если он указан, или request.host_url в противном случае
+        base_url = os.environ.get('EXTERNAL_URL', request.host_url.rstrip('/'))
         if 'music' in generation_types:
-            print("Начало генерации музыки")
-            try:
-                # Убедимся, что папка для музыки существует
-                os.makedirs(os.path.join('static', 'generated_music'), exist_ok=True)
-                
-                # Используем внешний URL, если он указан, или request.host_url в противном случае
-                base_url = os.environ.get('EXTERNAL_URL', request.host_url.rstrip('/'))
-                print(f"Используется base_url для коллбэка: {base_url}")
-                music_result = analyzer.generate_music(diary_text, emotions, base_url=base_url)
-                print(f"Генерация музыки завершена: {music_result['success']}")
-                
-                if not music_result.get('success', False):
-                    error_msg = music_result.get('error', 'Неизвестная ошибка при генерации музыки')
-                    print(f"Ошибка генерации музыки: {error_msg}")
-                    response_data['generated_music'] = {
-                        'success': False,
-                        'error': error_msg
-                    }
-                else:
-                    response_data['generated_music'] = {
-                        'success': True,
-                        'music_description': music_result.get('music_description', ''),
-                        'audio_url': music_result.get('audio_url', ''),
-                        'stream_url': music_result.get('stream_url', ''),
-                        'embed_url': music_result.get('embed_url', ''),
-                        'task_id': music_result.get('task_id', ''),
-                        'status': music_result.get('status', 'unknown'),
-                        'local_path': music_result.get('local_path', '')
-                    }
-            except Exception as music_error:
-                print(f"Исключение при генерации музыки: {str(music_error)}")
-                import traceback
-                traceback.print_exc()
-                response_data['generated_music'] = {
-                    'success': False,
-                    'error': f"Ошибка: {str(music_error)}"
-                }
+            print(f"Используется base_url для коллбэка: {base_url}")
+        
+        stage_results = analyzer.run_generation_stages(diary_text, emotions, generation_types, base_url=base_url)
+        
+        if 'text' in stage_results:
+            print(f"Генерация текста завершена, длина: {len(stage_results['text'])}")
+        for stage, result in stage_results.items():
+            response_data[STAGE_RESPONSE_FIELDS[stage]] = build_stage_response(stage, result)
         
         print("=== Обработка запроса /analyze успешно завершена ===")
         return jsonify(response_data)
@@ -246,6 +216,384 @@ def analyze():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+# Поля ответа /analyze для результатов этапов генерации
+STAGE_RESPONSE_FIELDS = {'text': 'generated_literary_work', 'image': 'generated_image', 'music': 'generated_music'}
+
+def build_stage_response(stage, result):
+    """
+    Преобразует результат этапа генерации в формат соответствующего поля ответа /analyze.
+    """
+    if stage == 'image':
+        return build_image_response(result)
+    if stage == 'music':
+        return build_music_response(result)
+    return result
+
+def is_stage_successful(stage, response):
+    if stage == 'text':
+        return isinstance(response, str) and bool(response) and not response.startswith('Произошла ошибка')
+    return isinstance(response, dict) and response.get('success', False)
+
+def run_analysis_job(payload, report_progress, checkpoint):
+    """
+    Выполняет задачу 'analyze' из очереди: анализ эмоций и выбранные этапы генерации.
+    Возвращает данные в том же формате, что и синхронный ответ /analyze.
+    
+    Анализ эмоций и результат каждого завершенного этапа сохраняются в checkpoint задачи.
+    При возобновлении после падения процесса они не выполняются повторно: повторный запрос
+    к DALL-E или Suno оплачивался бы еще раз и запускал бы вторую задачу генерации музыки.
+    """
+    diary_text = payload['diary_text']
+    generation_types = payload.get('generation_types', [])
+    analyzer = get_analyzer()
+    
+    saved = dict(checkpoint or {})
+    completed = set(saved.get('completed_stages', []))
+    emotions = saved.get('emotion_analysis')
+    if emotions is None:
+        report_progress('emotion_analysis', 10)
+        emotions = analyzer.analyze_emotions(diary_text)
+        if 'error' in emotions and emotions['error']:
+            raise RuntimeError(emotions['error'])
+    else:
+        print("Используется сохраненный анализ эмоций задачи")
+    # Реестр анализов хранится в памяти процесса, поэтому идентификатор выдается заново
+    saved.update({'emotion_analysis': emotions,
+                  'analysis_id': analyzer.register_analysis(diary_text, emotions),
+                  'degraded': bool(emotions.get('degraded'))})
+    
+    def progress():
+        done = sum(1 for stage in generation_types if STAGE_RESPONSE_FIELDS.get(stage) in saved)
+        return 40 + 55 * done // max(1, len(generation_types))
+    
+    report_progress('generation', progress(), checkpoint=saved)
+    
+    if 'image' in generation_types:
+        os.makedirs(os.path.join('static', 'generated_images'), exist_ok=True)
+    if 'music' in generation_types:
+        os.makedirs(os.path.join('static', 'generated_music'), exist_ok=True)
+    
+    remaining = [stage for stage in generation_types if stage not in completed]
+    if len(remaining) < len(generation_types):
+        print(f"Пропускаются уже выполненные этапы: {', '.join(sorted(completed))}")
+    
+    lock = threading.Lock()
+    finished = False
+    reported = set()
+    
+    def on_stage_done(stage, result):
+        # Сохраняем результат сразу: задача может упасть, пока ждет остальные этапы
+        with lock:
+            if finished:
+                return
+            response = build_stage_response(stage, result)
+            saved[STAGE_RESPONSE_FIELDS[stage]] = response
+            reported.add(stage)
+            if is_stage_successful(stage, response):
+                completed.add(stage)
+                saved['completed_stages'] = sorted(completed)
+            report_progress(f'{stage}_done', progress(), checkpoint=saved)
+    
+    stage_results = analyzer.run_generation_stages(diary_text, emotions, remaining,
+                                                   base_url=payload.get('base_url'),
+                                                   on_stage_done=on_stage_done)
+    with lock:
+        finished = True
+        for stage, result in stage_results.items():
+            if stage not in reported:
+                # Этап завершился с ошибкой или по таймауту
+                saved[STAGE_RESPONSE_FIELDS[stage]] = build_stage_response(stage, result)
+    
+    return {key: value for key, value in saved.items() if key != 'completed_stages'}
+
+job_queue.register_handler('analyze', run_analysis_job)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Возвращает статус и прогресс задачи генерации, а после завершения — ее результат.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена', 'status': 'not_found'}), 404
+    return jsonify(job)
+
+@app.route('/analyze/preview', methods=['POST'])
+def analyze_preview():
+    """
+    Мгновенный предварительный анализ эмоций по словарю, без обращения к OpenAI.
+    """
+    diary_text = request.form.get('diary_text', '') or (request.get_json(silent=True) or {}).get('diary_text', '')
+    if not diary_text:
+        return jsonify({'error': 'Текст дневника не может быть пустым'}), 400
+    return jsonify(emotion_lexicon.analyze(diary_text))
+
+# Предварительный словарный анализ в потоке /analyze/stream (событие emotion_preview)
+STREAM_EMOTION_PREVIEW = os.environ.get('STREAM_EMOTION_PREVIEW', '1').lower() not in ('0', 'false', 'no')
+
+def sse_event(event, data):
+    """
+    Форматирует событие Server-Sent Events.
+    
+    Args:
+        event (str): Имя события
+        data: Данные события (сериализуются в JSON)
+        
+    Returns:
+        str: Строка события в формате text/event-stream
+    """
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """
+    Потоковый вариант /analyze: отправляет события SSE по мере готовности этапов.
+    
+    События: started, emotion_preview, emotion_analysis, literary_token, generated_literary_work,
+    generated_image, generated_music, error, done.
+    """
+    diary_text = request.form.get('diary_text', '')
+    generation_types = request.form.getlist('generation_types[]')
+    
+    if not diary_text:
+        return jsonify({'error': 'Текст дневника не может быть пустым'}), 400
+    if not generation_types:
+        return jsonify({'error': 'Выберите хотя бы один тип генерации'}), 400
+    
+    # Значения из контекста запроса вычисляем заранее: генератор работает после возврата из обработчика
+    base_url = os.environ.get('EXTERNAL_URL', request.host_url.rstrip('/'))
+    analyzer = get_analyzer()
+    
+    def generate():
+        print("=== Начало потоковой обработки /analyze/stream ===")
+        # Первое событие отправляем сразу, чтобы клиент получил ответ без ожидания анализа
+        yield sse_event('started', {'generation_types': generation_types})
+        
+        # Словарный анализ занимает миллисекунды и показывается, пока идет запрос к GPT
+        if STREAM_EMOTION_PREVIEW:
+            try:
+                yield sse_event('emotion_preview', emotion_lexicon.analyze(diary_text))
+            except Exception as e:
+                print(f"Ошибка предварительного анализа эмоций: {str(e)}")
+        
+        try:
+            emotions = analyzer.analyze_emotions(diary_text)
+        except Exception as e:
+            print(f"Ошибка при анализе эмоций: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+            return
+        
+        if 'error' in emotions and emotions['error']:
+            yield sse_event('error', {'error': emotions['error'], 'emotion_analysis': emotions})
+            return
+        
+        yield sse_event('emotion_analysis', {**emotions,
+                                             'degraded': bool(emotions.get('degraded')),
+                                             'analysis_id': analyzer.register_analysis(diary_text, emotions)})
+        
+        events = queue.Queue()
+        
+        def run_text():
+            try:
+                parts = []
+                for token in analyzer.stream_literary_work(diary_text, emotions):
+                    parts.append(token)
+                    events.put(('literary_token', {'token': token}))
+                events.put(('generated_literary_work', {'text': ''.join(parts)}))
+            except Exception as e:
+                print(f"Ошибка при потоковой генерации текста: {str(e)}")
+                events.put(('generated_literary_work', {'text': f"Произошла ошибка при генерации текста: {str(e)}"}))
+        
+        def run_image():
+            try:
+                os.makedirs(os.path.join('static', 'generated_images'), exist_ok=True)
+                result = analyzer.generate_image_from_diary(diary_text, emotions)
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+            events.put(('generated_image', build_image_response(result)))
+        
+        def run_music():
+            try:
+                os.makedirs(os.path.join('static', 'generated_music'), exist_ok=True)
+                result = analyzer.generate_music(diary_text, emotions, base_url=base_url)
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+            events.put(('generated_music', build_music_response(result)))
+        
+        stages = {
+            'generated_literary_work': ('text', run_text),
+            'generated_image': ('image', run_image),
+            'generated_music': ('music', run_music),
+        }
+        pending = {}
+        futures = {}
+        started_at = time.time()
+        for final_event, (stage, func) in stages.items():
+            if stage in generation_types:
+                futures[final_event] = generation_executor.submit(func)
+                pending[final_event] = started_at + STAGE_TIMEOUTS.get(stage, 180)
+        
+        while pending:
+            # Сроки этапов проверяются на каждой итерации: поток токенов текста
+            # не должен откладывать таймаут изображения или музыки
+            now = time.time()
+            for final_event, deadline in list(pending.items()):
+                if now > deadline:
+                    print(f"Превышено время ожидания события {final_event}")
+                    pending.pop(final_event)
+                    abandon_stage(stages[final_event][0], futures[final_event])
+                    if final_event == 'generated_literary_work':
+                        yield sse_event(final_event, {'text': "Произошла ошибка при генерации текста: превышено время ожидания"})
+                    else:
+                        yield sse_event(final_event, {'success': False, 'error': 'Превышено время ожидания'})
+            if not pending:
+                break
+            try:
+                event, payload = events.get(timeout=max(0.1, min(15, min(pending.values()) - now)))
+            except queue.Empty:
+                # Комментарий SSE удерживает соединение открытым
+                yield ": keep-alive\n\n"
+                continue
+            if event in pending or (event == 'literary_token' and 'generated_literary_work' in pending):
+                yield sse_event(event, payload)
+            pending.pop(event, None)
+        
+        yield sse_event('done', {})
+        print("=== Потоковая обработка /analyze/stream завершена ===")
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def build_image_response(image_result):
+    """
+    Преобразует результат генерации изображения в формат ответа /analyze.
+    
+    Args:
+        image_result (dict): Результат generate_image_from_diary
+        
+    Returns:
+        dict: Данные для поля generated_image
+    """
+    try:
+        print(f"Генерация изображения завершена: {image_result.get('success', False)}")
+        
+        if image_result.get('success', False):
+            # Преобразуем пути к изображениям в URL-адреса
+            local_path = image_result.get('local_path', '')
+            print(f"Локальный путь к изображению: {local_path}")
+            
+            if local_path and os.path.exists(local_path):
+                # Если путь начинается с 'static/', преобразуем его в URL
+                if local_path.startswith('static/'):
+                    image_url = '/' + local_path
+                elif local_path.startswith('static\\'):
+                    # Для Windows пути
+                    image_url = '/' + local_path.replace('\\', '/')
+                else:
+                    # Пытаемся преобразовать любой другой путь
+                    image_url = '/' + local_path.replace('\\', '/')
+            else:
+                # Если локальный путь не существует, используем внешний URL
+                image_url = image_result.get('image_url', '')
+                print(f"Локальный путь не найден, используем внешний URL")
+            
+            print(f"URL изображения: {image_url}")
+            
+            response = {
+                'success': True,
+                'image_url': image_url,
+                'external_url': image_result.get('image_url', ''),
+                **derivative_urls(local_path if local_path and os.path.exists(local_path) else '')
+            }
+            if image_result.get('is_safe_alternative'):
+                # Запрос был перенаправлен на безопасную генерацию (прогноз отклонения политикой содержания)
+                response['is_safe_alternative'] = True
+                response['message'] = 'Создано символическое изображение на основе дневникового текста вместо прямой иллюстрации'
+                if image_result.get('predicted_policy_risk') is not None:
+                    response['predicted_policy_risk'] = image_result['predicted_policy_risk']
+            return response
+        
+        error_message = image_result.get('error', 'Неизвестная ошибка при генерации изображения')
+        print(f"Ошибка генерации изображения: {error_message}")
+        
+        # Проверяем, связана ли ошибка с политикой содержания
+        if 'type' in image_result and image_result['type'] == 'content_policy_violation':
+            # Если тип уже определен в image_result, используем его напрямую
+            return {
+                'success': False,
+                'error': error_message,
+                'type': 'content_policy_violation',
+                'can_regenerate_safe': image_result.get('can_regenerate_safe', True),
+                'technical_error': image_result.get('technical_error', '')
+            }
+        elif any(term in error_message.lower() for term in 
+              ["content_policy_violation", "policy", "violates", "content policy", "насилия", "насилие"]):
+            # Если ошибка похожа на нарушение политики содержания
+            return {
+                'success': False,
+                'error': "Текст содержит описания, которые невозможно визуализировать согласно политике OpenAI.",
+                'type': 'content_policy_violation',
+                'can_regenerate_safe': True,
+                'technical_error': error_message
+            }
+        else:
+            # Другие типы ошибок
+            return {
+                'success': False,
+                'error': error_message
+            }
+    except Exception as img_error:
+        print(f"Исключение при генерации изображения: {str(img_error)}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'success': False,
+            'error': f"Ошибка: {str(img_error)}"
+        }
+
+def build_music_response(music_result):
+    """
+    Преобразует результат генерации музыки в формат ответа /analyze.
+    
+    Args:
+        music_result (dict): Результат generate_music
+        
+    Returns:
+        dict: Данные для поля generated_music
+    """
+    try:
+        print(f"Генерация музыки завершена: {music_result.get('success', False)}")
+        
+        if not music_result.get('success', False):
+            error_msg = music_result.get('error', 'Неизвестная ошибка при генерации музыки')
+            print(f"Ошибка генерации музыки: {error_msg}")
+            return {
+                'success': False,
+                'error': error_msg
+            }
+        
+        return {
+            'success': True,
+            'music_description': music_result.get('music_description', ''),
+            'audio_url': music_result.get('audio_url', ''),
+            'stream_url': music_result.get('stream_url', ''),
+            'embed_url': music_result.get('embed_url', ''),
+            'task_id': music_result.get('task_id', ''),
+            'status': music_result.get('status', 'unknown'),
+            'local_path': music_result.get('local_path', '')
+        }
+    except Exception as music_error:
+        print(f"Исключение при генерации музыки: {str(music_error)}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'success': False,
+            'error': f"Ошибка: {str(music_error)}"
+        }
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -482,6 +830,7 @@ def share_analysis():
         diary_text = data.get('diary_text', '')
         emotion_analysis = data.get('emotion_analysis', '')
         generated_literary_work = data.get('generated_literary_work', '')
+        image_url = data.get('image_url', '')
         
         if not diary_text or not emotion_analysis or not generated_literary_work:
             return jsonify({'error': 'Не все данные для публикации были предоставлены'}), 400
@@ -521,6 +870,10 @@ def share_analysis():
 ### Литературная интерпретация:
 {generated_literary_work}"""
         
+        # Ссылка на сгенерированную иллюстрацию: на странице темы она показывается миниатюрой
+        if image_url.startswith(('/static/generated_images/', '/images/')):
+            content += f"\n\n### Иллюстрация:\n{image_url}"
+        
         # Создаем первое сообщение в теме
         message = Message(content=content, topic=topic, author=current_user)
         db.session.add(message)
@@ -544,6 +897,57 @@ def introduction():
 def documentation():
     return render_template('documentation.html')
 
+@app.route('/analysis_cache/stats')
+def analysis_cache_stats():
+    """
+    Возвращает счетчики попаданий и промахов кэша анализа эмоций.
+    """
+    return jsonify(analysis_cache.stats())
+
+# Ссылки на сгенерированные изображения в тексте сообщений форума
+_MESSAGE_IMAGE_REFERENCE = re.compile(r'(?:/static/generated_images/|/images/\w+/)([\w\-]+\.(?:png|jpe?g))')
+
+@app.template_filter('message_images')
+def message_images(content):
+    """
+    Изображения, на которые ссылается сообщение форума: для каждого — миниатюра,
+    srcset из WebP-копий и ссылка на полноразмерную WebP-копию.
+    """
+    images = []
+    seen = set()
+    for match in _MESSAGE_IMAGE_REFERENCE.finditer(content or ''):
+        filename = match.group(1)
+        if filename in seen or not is_original(filename):
+            continue
+        seen.add(filename)
+        urls = derivative_urls(os.path.join(GENERATED_IMAGES_ROOT, filename))
+        images.append({
+            'src': urls['derivatives'][str(max(DERIVATIVE_WIDTHS))],
+            'srcset': urls['srcset'],
+            'href': urls['derivatives'][FULL_VARIANT]
+        })
+    return images
+
+@app.route('/images/<variant>/<filename>')
+def image_variant(variant, filename):
+    """
+    Отдает WebP-копию или миниатюру сгенерированного изображения.
+    Пока производная создается в фоне, отдается оригинал с коротким временем кэширования;
+    недостающие производные ставятся в очередь при первом обращении.
+    """
+    allowed_variants = {FULL_VARIANT} | {str(width) for width in DERIVATIVE_WIDTHS}
+    if variant not in allowed_variants or not is_original(filename):
+        abort(404)
+    derivative = variant_path(filename, variant)
+    if os.path.exists(os.path.join(GENERATED_IMAGES_ROOT, derivative)):
+        # Имена файлов не меняются при изменении содержимого, поэтому производные можно кэшировать надолго
+        return send_from_directory(GENERATED_IMAGES_ROOT, derivative, max_age=30 * 24 * 3600)
+    # Производной нет (старое изображение или очередь пропала при перезапуске): создаем ее в фоне
+    original = os.path.join(GENERATED_IMAGES_ROOT, filename)
+    if os.path.exists(original):
+        schedule_derivatives(original)
+    return send_from_directory(GENERATED_IMAGES_ROOT, filename, max_age=60)
+
 @app.route('/generate_image', methods=['POST'])
 def generate_image():
     try:
@@ -559,7 +963,7 @@ def generate_image():
         emotion_analysis = data.get('emotion_analysis', None)
         
         print(f"Получен текст длиной {len(text)} символов")
-        analyzer = WarDiaryAnalyzer()
+        analyzer = get_analyzer()
         
         # Генерация изображения
         image_result = analyzer.generate_image_from_diary(text, emotion_analysis)
@@ -592,7 +996,8 @@ def generate_image():
         response_data = {
             'success': True,
             'image_url': image_url,
-            'external_url': image_result.get('image_url', '')
+            'external_url': image_result.get('image_url', ''),
+            **derivative_urls(local_path)
         }
         
         print("=== Обработка запроса /generate_image успешно завершена ===")
@@ -618,17 +1023,26 @@ def generate_safe_image():
         if not diary_text:
             return jsonify({'success': False, 'error': 'Текст дневника не указан'}), 400
         
-        # Создаем анализатор
-        analyzer = WarDiaryAnalyzer()
-        
-        # Проводим эмоциональный анализ для лучшей генерации
-        emotions = analyzer.analyze_emotions(diary_text)
-        
-        # Логируем начало безопасной генерации
-        print(f"Начинаем генерацию БЕЗОПАСНОГО символического изображения по запросу пользователя")
+        # Используем общий анализатор
+        analyzer = get_analyzer()
         
-        # Генерируем символическое изображение
-        result = analyzer.generate_safe_image_from_diary(diary_text, emotions)
+        # Безопасная версия могла быть сгенерирована заранее (режим SPECULATIVE_SAFE_IMAGE)
+        result = analyzer.get_speculative_safe_image(diary_text)
+        if result is not None:
+            print("Используется заранее сгенерированное безопасное изображение")
+        else:
+            # Используем анализ эмоций, уже выполненный в /analyze; без него проводим анализ заново
+            emotions = analyzer.get_registered_analysis(request.form.get('analysis_id', ''), diary_text)
+            if emotions is None:
+                emotions = analyzer.analyze_emotions(diary_text)
+            else:
+                print("Используется ранее выполненный анализ эмоций")
+            
+            # Логируем начало безопасной генерации
+            print(f"Начинаем генерацию БЕЗОПАСНОГО символического изображения по запросу пользователя")
+            
+            # Генерируем символическое изображение
+            result = analyzer.generate_safe_image_from_diary(diary_text, emotions)
         
         print(f"Результат генерации безопасного изображения: {result}")
         
@@ -650,7 +1064,8 @@ def generate_safe_image():
                 'image_url': display_url,
                 'external_url': image_url,  # Сохраняем внешний URL как запасной вариант
                 'is_safe_alternative': True,
-                'message': 'Создано символическое изображение на основе дневникового текста вместо прямой иллюстрации'
+                'message': 'Создано символическое изображение на основе дневникового текста вместо прямой иллюстрации',
+                **derivative_urls(local_path)
             })
         else:
             # Если произошла ошибка
@@ -686,7 +1101,7 @@ def generate_music():
         emotion_analysis = data.get('emotion_analysis', None)
         
         print(f"Получен текст длиной {len(text)} символов")
-        analyzer = WarDiaryAnalyzer()
+        analyzer = get_analyzer()
         
         # Генерация музыки (только отправка задачи, не ожидание результата)
         # Используем внешний URL, если он указан, или request.host_url в противном случае
@@ -716,10 +1131,115 @@ def generate_music():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def music_status_payload(task_id):
+    """
+    Формирует ответ о статусе задачи генерации музыки по метаданным
+    (общий для /check_music_status и уведомлений о готовности музыки).
+    """
+    metadata = metadata_store.load(task_id)
+    if metadata is not None:
+        try:
+            # Проверка наличия локального аудиофайла
+            local_audio_path = metadata.get('local_audio_path', '')
+            local_audio_url = None
+            
+            if local_audio_path and os.path.exists(local_audio_path) and os.path.getsize(local_audio_path) > 0:
+                audio_filename = os.path.basename(local_audio_path)
+                local_audio_url = f"/static/generated_music/audio/{audio_filename}"
+                print(f"Локальный аудиофайл найден: {local_audio_url}")
+                
+                # Если файл существует, возвращаем успешный ответ с данными
+                return {
+                    'success': True,
+                    'status': 'complete',
+                    'local_audio_url': local_audio_url,
+                    'is_music_ready': True,
+                    'tracks': metadata.get('tracks', []),
+                    'music_description': metadata.get('music_description', 'Сгенерированная музыка'),
+                    'style': metadata.get('style', ''),
+                    'mood': metadata.get('mood', '')
+                }
+            
+            # Проверяем наличие аудио URL в метаданных (которые могли быть обновлены callback'ом)
+            audio_url = metadata.get('audio_url', '')
+            stream_url = metadata.get('stream_url', '')
+            embed_url = metadata.get('embed_url', '')
+            
+            # Если есть какой-либо URL аудио, считаем, что музыка готова
+            if audio_url or stream_url or embed_url or metadata.get('status') == 'complete':
+                print(f"Найдены URL'ы аудио, но локальный файл отсутствует")
+                
+                # Формируем прокси URL для аудиофайла, если он не был скачан локально
+                proxy_url = proxy_url_for(audio_url, task_id) if audio_url else ""
+                
+                return {
+                    'success': True,
+                    'status': 'complete',
+                    'is_music_ready': True,
+                    'audio_url': audio_url,
+                    'stream_url': stream_url,
+                    'embed_url': embed_url,
+                    'proxy_url': proxy_url,
+                    'local_audio_url': local_audio_url,
+                    'tracks': metadata.get('tracks', []),
+                    'music_description': metadata.get('music_description', 'Сгенерированная музыка')
+                }
+            
+            # Если файлов нет, но есть последние данные коллбэка, проверяем их
+            if 'last_callback' in metadata and metadata['last_callback']:
+                callback_data = metadata['last_callback']
+                if isinstance(callback_data, dict):
+                    # Проверяем данные из callback на наличие URL'ов
+                    data_field = callback_data.get('data', {})
+                    
+                    # Извлекаем URL'ы аудио из разных возможных мест в callback данных
+                    audio_url = data_field.get('audio_url') or callback_data.get('audio_url') or ''
+                    stream_url = data_field.get('stream_url') or callback_data.get('stream_url') or ''
+                    
+                    if audio_url or stream_url:
+                        print(f"Найдены URL'ы аудио в callback данных")
+                        proxy_url = proxy_url_for(audio_url, task_id) if audio_url else ""
+                        
+                        return {
+                            'success': True,
+                            'status': 'complete',
+                            'is_music_ready': True,
+                            'audio_url': audio_url,
+                            'stream_url': stream_url,
+                            'proxy_url': proxy_url,
+                            'music_description': metadata.get('music_description', 'Сгенерированная музыка')
+                        }
+        except Exception as e:
+            print(f"Ошибка при разборе метаданных: {str(e)}")
+    
+    # Музыка еще не готова: статус (в процессе, ошибка, таймаут) по метаданным
+    analyzer = get_analyzer()
+    status_response = analyzer._check_music_generation_status(task_id, metadata)
+    
+    # Если задача завершена, отмечаем готовность музыки
+    if status_response.get('status') == 'complete' and (status_response.get('audio_url') or status_response.get('stream_url')):
+        print(f"Задача {task_id} завершена по метаданным")
+        status_response['is_music_ready'] = True
+        
+        # Добавляем прокси URL для аудио
+        if status_response.get('audio_url'):
+            status_response['proxy_url'] = proxy_url_for(status_response['audio_url'], task_id)
+    
+    return status_response
+
+def is_music_status_final(status):
+    """
+    Проверяет, что статус окончательный: музыка готова, произошла ошибка или истекло время ожидания.
+    """
+    return bool(status.get('status') in ('complete', 'error', 'timeout') or status.get('is_music_ready')
+                or status.get('audio_url') or status.get('stream_url') or status.get('local_audio_url'))
+
 @app.route('/check_music_status')
 def check_music_status():
     """
     Проверяет статус задачи генерации музыки.
+    Только читает метаданные: их обновляют коллбэк Suno и фоновый опрос (music_poller),
+    поэтому запрос не ждет ответа Suno и не занимает поток.
     """
     try:
         # Получаем task_id из параметров запроса
@@ -727,97 +1247,7 @@ def check_music_status():
         if not task_id:
             return jsonify({'success': False, 'error': 'Не указан task_id', 'status': 'error'}), 200
         print(f"Получен запрос на проверку статуса для задачи: {task_id}")
-        metadata_path = os.path.join('static', 'generated_music', f"music_metadata_{task_id}.json")
-        if os.path.exists(metadata_path):
-            try:
-                with open(metadata_path, 'r', encoding='utf-8') as f:
-                    metadata = json.load(f)
-                
-                # Проверка наличия локального аудиофайла
-                local_audio_path = metadata.get('local_audio_path', '')
-                local_audio_url = None
-                
-                if local_audio_path and os.path.exists(local_audio_path) and os.path.getsize(local_audio_path) > 0:
-                    audio_filename = os.path.basename(local_audio_path)
-                    local_audio_url = f"/static/generated_music/audio/{audio_filename}"
-                    print(f"Локальный аудиофайл найден: {local_audio_url}")
-                    
-                    # Если файл существует, возвращаем успешный ответ с данными
-                    return jsonify({
-                        'success': True,
-                        'status': 'complete',
-                        'local_audio_url': local_audio_url,
-                        'is_music_ready': True,
-                        'music_description': metadata.get('music_description', 'Сгенерированная музыка'),
-                        'style': metadata.get('style', ''),
-                        'mood': metadata.get('mood', '')
-                    }), 200
-                
-                # Проверяем наличие аудио URL в метаданных (которые могли быть обновлены callback'ом)
-                audio_url = metadata.get('audio_url', '')
-                stream_url = metadata.get('stream_url', '')
-                embed_url = metadata.get('embed_url', '')
-                
-                # Если есть какой-либо URL аудио, считаем, что музыка готова
-                if audio_url or stream_url or embed_url or metadata.get('status') == 'complete':
-                    print(f"Найдены URL'ы аудио, но локальный файл отсутствует")
-                    
-                    # Формируем прокси URL для аудиофайла, если он не был скачан локально
-                    proxy_url = f"/proxy_audio?url={urllib.parse.quote(audio_url)}" if audio_url else ""
-                    
-                    return jsonify({
-                        'success': True,
-                        'status': 'complete',
-                        'is_music_ready': True,
-                        'audio_url': audio_url,
-                        'stream_url': stream_url,
-                        'embed_url': embed_url,
-                        'proxy_url': proxy_url,
-                        'local_audio_url': local_audio_url,
-                        'music_description': metadata.get('music_description', 'Сгенерированная музыка')
-                    }), 200
-                
-                # Если файлов нет, но есть последние данные коллбэка, проверяем их
-                if 'last_callback' in metadata and metadata['last_callback']:
-                    callback_data = metadata['last_callback']
-                    if isinstance(callback_data, dict):
-                        # Проверяем данные из callback на наличие URL'ов
-                        data_field = callback_data.get('data', {})
-                        
-                        # Извлекаем URL'ы аудио из разных возможных мест в callback данных
-                        audio_url = data_field.get('audio_url') or callback_data.get('audio_url') or ''
-                        stream_url = data_field.get('stream_url') or callback_data.get('stream_url') or ''
-                        
-                        if audio_url or stream_url:
-                            print(f"Найдены URL'ы аудио в callback данных")
-                            proxy_url = f"/proxy_audio?url={urllib.parse.quote(audio_url)}" if audio_url else ""
-                            
-                            return jsonify({
-                                'success': True,
-                                'status': 'complete',
-                                'is_music_ready': True,
-                                'audio_url': audio_url,
-                                'stream_url': stream_url,
-                                'proxy_url': proxy_url,
-                                'music_description': metadata.get('music_description', 'Сгенерированная музыка')
-                            }), 200
-            except Exception as e:
-                print(f"Ошибка при чтении метаданных: {str(e)}")
-                # Продолжаем выполнение, чтобы проверить статус через API
-        
-        # Если не удалось получить данные из локального файла, проверяем через API
-        analyzer = WarDiaryAnalyzer()
-        status_response = analyzer._check_music_generation_status(task_id)
-        
-        # Если получен успешный статус от API, обновляем его
-        if status_response.get('status') == 'complete' and (status_response.get('audio_url') or status_response.get('stream_url')):
-            print(f"API вернул статус complete для задачи {task_id}")
-            status_response['is_music_ready'] = True
-            
-            # Добавляем прокси URL для аудио
-            if status_response.get('audio_url'):
-                status_response['proxy_url'] = f"/proxy_audio?url={urllib.parse.quote(status_response['audio_url'])}"
-        
+        status_response = music_status_payload(task_id)
         print(f"Возвращаем статус: {status_response.get('status')}")
         return jsonify(status_response), 200
     except Exception as e:
@@ -831,6 +1261,59 @@ def check_music_status():
             'message': f"Ошибка при проверке статуса: {str(e)}",
         }), 200
 
+# Ожидание готовности музыки: одно открытое соединение вместо периодических запросов /check_music_status.
+# Каждый открытый SSE-поток занимает поток сервера Werkzeug, поэтому поток живет не дольше,
+# чем фоновый опрос ждет задачу (после этого статус все равно окончательный)
+MUSIC_WAIT_MAX_SECONDS = 60
+MUSIC_STREAM_MAX_SECONDS = MUSIC_MAX_WAIT_SECONDS
+MUSIC_STREAM_HEARTBEAT_SECONDS = 15
+
+@app.route('/music_status/wait')
+def music_status_wait():
+    """
+    Долгий запрос: возвращает статус, как только задача завершится, или текущий статус по таймауту.
+    Параметры: task_id, timeout (секунды, не больше MUSIC_WAIT_MAX_SECONDS).
+    """
+    task_id = request.args.get('task_id')
+    if not task_id:
+        return jsonify({'success': False, 'error': 'Не указан task_id', 'status': 'error'}), 200
+    timeout = min(request.args.get('timeout', 30, type=float), MUSIC_WAIT_MAX_SECONDS)
+    
+    version = music_events.version(task_id)
+    status = music_status_payload(task_id)
+    if not is_music_status_final(status):
+        if music_events.wait(task_id, version, timeout) is not None:
+            status = music_status_payload(task_id)
+    return jsonify(status), 200
+
+@app.route('/music_status/stream')
+def music_status_stream():
+    """
+    SSE-поток статуса задачи генерации музыки: событие music_status отправляется сразу,
+    при каждом изменении статуса (коллбэк Suno, фоновый опрос) и раз в
+    MUSIC_STREAM_HEARTBEAT_SECONDS секунд; поток закрывается после окончательного статуса.
+    """
+    task_id = request.args.get('task_id')
+    if not task_id:
+        return jsonify({'success': False, 'error': 'Не указан task_id', 'status': 'error'}), 400
+    
+    def generate():
+        deadline = time.time() + MUSIC_STREAM_MAX_SECONDS
+        version = music_events.version(task_id)
+        while True:
+            status = music_status_payload(task_id)
+            yield sse_event('music_status', status)
+            if is_music_status_final(status) or time.time() >= deadline:
+                return
+            event = music_events.wait(task_id, version, MUSIC_STREAM_HEARTBEAT_SECONDS)
+            if event is not None:
+                version = event[0]
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/music_callback', methods=['POST'])
 def music_callback():
     """
@@ -875,89 +1358,9 @@ def music_callback():
         
         print(f"Обработка callback для task_id: {task_id}, тип: {callback_type}")
         
-        # Путь к файлу метаданных
-        metadata_path = os.path.join('static', 'generated_music', f"music_metadata_{task_id}.json")
-        
-        # Проверяем существование файла метаданных
-        if not os.path.exists(metadata_path):
-            print(f"Файл метаданных не найден: {metadata_path}")
-            # Если файл не существует, создаем новый с базовой информацией
-            metadata = {
-                'task_id': task_id,
-                'status': 'unknown',
-                'created_at': datetime.now().isoformat(),
-                'last_update': datetime.now().isoformat(),
-                'callback_received': True,
-                'callback_data': callback_data
-            }
-        else:
-            # Загружаем текущие метаданные
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-        
-        # Обновляем метаданные на основе типа callback
-        if callback_type:
-            metadata['status'] = callback_type
-        else:
-            # Если нет типа, смотрим на код ответа
-            if data.get('code') == 200:
-                metadata['status'] = 'complete'
-            else:
-                metadata['status'] = 'updated'
-        
-        metadata['last_update'] = datetime.now().isoformat()
-        metadata['callback_received'] = True
-        
-        # Тщательно проверяем все возможные структуры данных в callback
-        
-        # Вариант 1: Структура с callbackType и массивом data
-        if callback_type == 'complete' and 'data' in callback_data and isinstance(callback_data['data'], list):
-            tracks_data = callback_data.get('data', [])
-            print(f"Обнаружена структура callback type 1: массив треков в data")
-            
-            if tracks_data and isinstance(tracks_data, list) and len(tracks_data) > 0:
-                process_track_data(metadata, tracks_data[0], task_id)
-        
-        # Вариант 2: Структура с tracks массивом напрямую
-        elif 'tracks' in callback_data and isinstance(callback_data['tracks'], list):
-            tracks_data = callback_data.get('tracks', [])
-            print(f"Обнаружена структура callback type 2: массив в tracks")
-            
-            if tracks_data and len(tracks_data) > 0:
-                process_track_data(metadata, tracks_data[0], task_id)
-        
-        # Вариант 3: Структура с data объектом, содержащим информацию о треке
-        elif 'data' in callback_data and isinstance(callback_data['data'], dict):
-            print(f"Обнаружена структура callback type 3: объект в data")
-            process_track_data(metadata, callback_data['data'], task_id)
-        
-        # Вариант 4: Данные о треке находятся непосредственно в callback_data
-        elif any(key in callback_data for key in ['audio_url', 'audioUrl', 'stream_url', 'streamUrl']):
-            print(f"Обнаружена структура callback type 4: данные трека в корне callback_data")
-            process_track_data(metadata, callback_data, task_id)
-            
-        # Вариант 5: Данные находятся в родительском объекте data
-        elif any(key in data for key in ['audio_url', 'audioUrl', 'stream_url', 'streamUrl']):
-            print(f"Обнаружена структура callback type 5: данные трека в корне data")
-            process_track_data(metadata, data, task_id)
-        
-        # Если callback сообщает об ошибке, сохраняем информацию об ошибке
-        if callback_type == 'error' or data.get('code') != 200:
-            metadata['status'] = 'error'
-            metadata['error'] = (callback_data.get('message') or 
-                               callback_data.get('msg') or 
-                               data.get('msg') or 
-                               'Неизвестная ошибка')
-            print(f"Получена ошибка для задачи {task_id}: {metadata['error']}")
-        
-        # Сохраняем оригинальные данные callback для отладки
-        metadata['last_callback'] = data
-        
-        # Сохраняем обновленные метаданные
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-            
-        return jsonify({'success': True, 'message': f'Callback обработан для task_id: {task_id}'}), 200
+        # Метаданные изменяются под блокировкой задачи: фоновый опрос может обновлять их одновременно
+        with metadata_store.lock(task_id):
+            return apply_music_callback(data, callback_data, callback_type, task_id)
     
     except Exception as e:
         print(f"Ошибка при обработке callback: {str(e)}")
@@ -966,14 +1369,128 @@ def music_callback():
         
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def process_track_data(metadata, track, task_id):
+def extract_callback_tracks(data, callback_data, callback_type):
+    """
+    Извлекает список треков из callback Suno с учетом всех известных структур данных.
+    
+    Returns:
+        list: Данные треков (пустой список, если треков нет)
+    """
+    # Вариант 1: Структура с callbackType и массивом data
+    if callback_type == 'complete' and 'data' in callback_data and isinstance(callback_data['data'], list):
+        print(f"Обнаружена структура callback type 1: массив треков в data")
+        return [track for track in callback_data['data'] if isinstance(track, dict)]
+    
+    # Вариант 2: Структура с tracks массивом напрямую
+    if 'tracks' in callback_data and isinstance(callback_data['tracks'], list):
+        print(f"Обнаружена структура callback type 2: массив в tracks")
+        return [track for track in callback_data['tracks'] if isinstance(track, dict)]
+    
+    # Вариант 3: Структура с data объектом, содержащим информацию о треке
+    if 'data' in callback_data and isinstance(callback_data['data'], dict):
+        print(f"Обнаружена структура callback type 3: объект в data")
+        return [callback_data['data']]
+    
+    # Вариант 4: Данные о треке находятся непосредственно в callback_data
+    if any(key in callback_data for key in ['audio_url', 'audioUrl', 'stream_url', 'streamUrl']):
+        print(f"Обнаружена структура callback type 4: данные трека в корне callback_data")
+        return [callback_data]
+    
+    # Вариант 5: Данные находятся в родительском объекте data
+    if any(key in data for key in ['audio_url', 'audioUrl', 'stream_url', 'streamUrl']):
+        print(f"Обнаружена структура callback type 5: данные трека в корне data")
+        return [data]
+    
+    return []
+
+def callback_track_id(track, track_index):
+    """
+    Идентификатор трека из callback (номер трека, если Suno не передал id).
+    """
+    return str(track.get('id') or track.get('audioId') or track.get('audio_id') or track_index)
+
+def apply_music_callback(data, callback_data, callback_type, task_id):
+    """
+    Обновляет метаданные задачи по данным коллбэка Suno.
+    Повторный callback (та же задача, тип и треки) не меняет метаданные и не запускает загрузки.
+    """
+    tracks = extract_callback_tracks(data, callback_data, callback_type)
+    callback_kind = callback_type or str(data.get('code'))
+    callback_keys = [f"{callback_kind}:{callback_track_id(track, index)}" for index, track in enumerate(tracks)]
+    callback_keys = callback_keys or [f"{callback_kind}:"]
+    
+    metadata = metadata_store.load(task_id)
+    
+    if metadata is not None and set(callback_keys) <= set(metadata.get('processed_callbacks', [])):
+        print(f"Повторный callback {callback_kind} для задачи {task_id} пропущен")
+        return jsonify({'success': True, 'message': f'Callback уже обработан для task_id: {task_id}'}), 200
+    
+    # Промежуточный callback, пришедший после завершения, не должен затирать готовые треки
+    if metadata is not None and metadata.get('status') == 'complete' and callback_type in ('text', 'first'):
+        print(f"Запоздавший callback {callback_type} для завершенной задачи {task_id} пропущен")
+        return jsonify({'success': True, 'message': f'Callback уже обработан для task_id: {task_id}'}), 200
+    
+    # Проверяем существование метаданных
+    if metadata is None:
+        print(f"Метаданные не найдены для задачи: {task_id}")
+        # Если файл не существует, создаем новый с базовой информацией
+        metadata = {
+            'task_id': task_id,
+            'status': 'unknown',
+            'created_at': datetime.now().isoformat(),
+            'last_update': datetime.now().isoformat(),
+            'callback_received': True,
+            'callback_data': callback_data
+        }
+    
+    # Обновляем метаданные на основе типа callback
+    if callback_type:
+        metadata['status'] = callback_type
+    else:
+        # Если нет типа, смотрим на код ответа
+        if data.get('code') == 200:
+            metadata['status'] = 'complete'
+        else:
+            metadata['status'] = 'updated'
+    
+    metadata['last_update'] = datetime.now().isoformat()
+    metadata['callback_received'] = True
+    
+    # Все треки обрабатываются сразу: второй трек готов одновременно с первым
+    for track_index, track in enumerate(tracks):
+        process_track_data(metadata, track, task_id, track_index)
+    
+    # Если callback сообщает об ошибке, сохраняем информацию об ошибке
+    if callback_type == 'error' or data.get('code') != 200:
+        metadata['status'] = 'error'
+        metadata['error'] = (callback_data.get('message') or 
+                           callback_data.get('msg') or 
+                           data.get('msg') or 
+                           'Неизвестная ошибка')
+        print(f"Получена ошибка для задачи {task_id}: {metadata['error']}")
+    
+    # Сохраняем оригинальные данные callback для отладки
+    metadata['last_callback'] = data
+    processed = metadata.get('processed_callbacks', [])
+    metadata['processed_callbacks'] = processed + [key for key in callback_keys if key not in processed]
+    
+    # Сохраняем обновленные метаданные и будим ожидающих статус задачи
+    metadata_store.save(task_id, metadata)
+    music_events.publish(task_id, {'status': metadata.get('status')})
+        
+    return jsonify({'success': True, 'message': f'Callback обработан для task_id: {task_id}'}), 200
+
+def process_track_data(metadata, track, task_id, track_index=0):
     """
     Обрабатывает данные трека и обновляет метаданные.
+    Данные каждого трека сохраняются в metadata['tracks']; поля первого трека
+    также записываются в корень метаданных, как и раньше.
     
     Args:
         metadata (dict): Словарь метаданных для обновления
         track (dict): Данные трека из callback
         task_id (str): Идентификатор задачи
+        track_index (int): Номер трека в callback
     """
     # Получаем URL-адреса аудио с проверкой разных возможных полей
     audio_url = (track.get('audio_url') or 
@@ -1006,112 +1523,48 @@ def process_track_data(metadata, track, task_id):
     # Создаем ссылку для проксирования, если аудио URL существует
     proxy_url = ''
     if audio_url:
-        proxy_url = f"/proxy_audio?url={quote(audio_url)}"
-    
-    # Переменные для отслеживания локальных путей и URL-адресов
-    local_audio_path = ''
-    local_audio_url = ''
-    
-    # Пытаемся скачать аудиофайл, если есть URL
-    if audio_url or stream_url:
-        # Создаем директорию для аудиофайлов, если она не существует
-        audio_dir = os.path.join('static', 'generated_music', 'audio')
-        os.makedirs(audio_dir, exist_ok=True)
-        
-        # Формируем имя файла и путь для сохранения
-        audio_filename = f"music_{task_id}.mp3"
-        full_audio_path = os.path.join(audio_dir, audio_filename)
-        
-        # Формируем URL для доступа из браузера (в любом случае)
-        local_audio_url = f"/static/generated_music/audio/{audio_filename}"
-        
-        # URL для скачивания (предпочитаем audio_url, если есть)
-        download_url = audio_url if audio_url else stream_url
-        
-        if download_url:
-            try:
-                print(f"Начинаем скачивание аудиофайла с URL: {download_url}")
-                
-                # Скачиваем с увеличенным таймаутом и обработкой ошибок
-                session = requests.Session()
-                session.mount('https://', requests.adapters.HTTPAdapter(max_retries=3))
-                
-                response = session.get(download_url, stream=True, timeout=60)
-                response.raise_for_status()  # Проверка на ошибки HTTP
-                
-                # Сохраняем файл
-                with open(full_audio_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                
-                # Проверяем, что файл был скачан успешно
-                if os.path.exists(full_audio_path) and os.path.getsize(full_audio_path) > 0:
-                    print(f"Аудиофайл успешно скачан и сохранен: {full_audio_path}")
-                    local_audio_path = full_audio_path
-                    # URL установлен выше, проверяем что он соответствует пути
-                    print(f"Сформирован URL для аудио: {local_audio_url}")
-                else:
-                    print(f"Ошибка: файл не был скачан или имеет нулевой размер")
-                    
-                    # Пробуем альтернативный способ скачивания
-                    print("Пробуем альтернативный способ скачивания...")
-                    import urllib.request
-                    
-                    try:
-                        urllib.request.urlretrieve(download_url, full_audio_path)
-                        
-                        if os.path.exists(full_audio_path) and os.path.getsize(full_audio_path) > 0:
-                            print(f"Аудиофайл успешно скачан альтернативным способом: {full_audio_path}")
-                            local_audio_path = full_audio_path
-                            # URL установлен выше
-                        else:
-                            print("Альтернативное скачивание тоже не удалось: файл имеет нулевой размер")
-                    except Exception as e:
-                        print(f"Альтернативное скачивание тоже не удалось: {str(e)}")
-            except Exception as e:
-                print(f"Ошибка при скачивании аудиофайла: {str(e)}")
-                import traceback
-                traceback.print_exc()
-    
-    # Скачиваем изображение обложки, если URL существует
-    local_image_path = ''
-    local_image_url = ''
-    
-    if image_url:
-        try:
-            # Создаем директорию для изображений
-            image_dir = os.path.join('static', 'generated_music', 'covers')
-            os.makedirs(image_dir, exist_ok=True)
-            
-            # Формируем имя файла и путь
-            image_filename = f"cover_{task_id}.jpg"
-            local_image_path = os.path.join(image_dir, image_filename)
-            local_image_url = f"/static/generated_music/covers/{image_filename}"
-            
-            # Скачиваем изображение
-            print(f"Начинаем скачивание обложки с URL: {image_url}")
-            response = requests.get(image_url, stream=True, timeout=30)
-            response.raise_for_status()
-            
-            # Сохраняем файл
-            with open(local_image_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            
-            # Проверяем результат
-            if os.path.exists(local_image_path) and os.path.getsize(local_image_path) > 0:
-                print(f"Обложка успешно скачана: {local_image_path}")
-            else:
-                print(f"Ошибка: изображение не было скачано или имеет нулевой размер")
-                local_image_path = ''
-                local_image_url = ''
-        except Exception as e:
-            print(f"Ошибка при скачивании обложки: {str(e)}")
-            local_image_path = ''
-            local_image_url = ''
+        proxy_url = proxy_url_for(audio_url, task_id)
     
+    # Файлы скачиваются в фоне (asset_fetcher), чтобы Suno сразу получил ответ на коллбэк.
+    # Если файлы уже скачаны по предыдущему коллбэку, сохраняем ссылки на них
+    tracks = metadata.setdefault('tracks', [])
+    while len(tracks) <= track_index:
+        tracks.append({})
+    previous = tracks[track_index] or (metadata if track_index == 0 else {})
+    local_audio_path = previous.get('local_audio_path', '')
+    local_audio_url = previous.get('local_audio_url', '')
+    if not (local_audio_path and os.path.exists(local_audio_path)):
+        local_audio_path = local_audio_url = ''
+    local_image_path = previous.get('local_image_path', '')
+    local_image_url = previous.get('local_image_url', '')
+    if not (local_image_path and os.path.exists(local_image_path)):
+        local_image_path = local_image_url = ''
+
+    track_info = {
+        'track_id': callback_track_id(track, track_index),
+        'audio_url': audio_url,
+        'stream_url': stream_url,
+        'image_url': image_url,
+        'embed_url': embed_url,
+        'proxy_url': proxy_url,
+        'local_audio_path': local_audio_path,
+        'local_image_path': local_image_path,
+        'local_audio_url': local_audio_url,
+        'local_image_url': local_image_url,
+        'duration': track.get('duration', 0),
+        'tags': track.get('tags', ''),
+        'title': track.get('title', '')
+    }
+    tracks[track_index] = track_info
+
+    # Скачиваем только готовый MP3: запись потока (stream_url) может оказаться неполной,
+    # а уже скачанный файл не перекачивается. Треки и обложки скачиваются параллельно
+    asset_fetcher.fetch_track_assets(task_id, audio_url, image_url, track_index)
+
+    if track_index:
+        print(f"Обновлены метаданные трека {track_index + 1} для задачи: {task_id}")
+        return
+
     # Создаем описание музыки на основе метаданных
     music_description = ''
     if 'style' in metadata:
@@ -1148,59 +1601,69 @@ def process_track_data(metadata, track, task_id):
     else:
         metadata['is_music_ready'] = False
 
+def find_task_track(url, task_id):
+    """
+    Ищет в метаданных задачи трек с указанным адресом аудио.
+    
+    Returns:
+        dict or None: Данные трека
+    """
+    metadata = metadata_store.load(task_id) if task_id else None
+    if not metadata:
+        return None
+    for track in [metadata] + list(metadata.get('tracks') or []):
+        if url in (track.get('audio_url'), track.get('stream_url')):
+            return track
+    return None
+
+def find_local_audio(track):
+    """
+    Возвращает путь к скачанному файлу трека в static/generated_music/audio или None.
+    """
+    local_path = (track or {}).get('local_audio_path', '')
+    if local_path and os.path.exists(local_path):
+        media_retention.record_access(local_path)
+        return local_path
+    return None
+
 @app.route('/proxy_audio')
 def proxy_audio():
     """
-    Проксирование запросов к аудиофайлам для обхода CORS и других ограничений.
+    Потоковое проксирование аудиофайлов для обхода CORS с поддержкой запросов Range.
+    Уже скачанный файл задачи или файл из дискового кэша прокси отдается с диска;
+    иначе аудио передается клиенту по частям и одновременно сохраняется в кэш.
     """
-    try:
-        url = request.args.get('url')
-        if not url:
-            return "URL parameter is required", 400
-        
-        print(f"Проксирование аудио из URL: {url}")
-        
-        # Настройки запроса
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'audio/*, */*',
-            'Connection': 'keep-alive'
-        }
-        timeout = 60  # Увеличиваем тайм-аут до 60 секунд
-        
-        # Используем requests для получения содержимого файла
-        # Отключаем стриминг и получаем весь файл сразу - решение проблемы с потоком
-        response = requests.get(url, headers=headers, timeout=timeout, stream=False)
-        response.raise_for_status()
-        
-        # Получаем данные аудиофайла полностью в память
-        audio_data = response.content
-        
-        # Определяем тип контента
-        content_type = response.headers.get('Content-Type', 'audio/mpeg')
-        if 'audio' not in content_type:
-            content_type = 'audio/mpeg'  # Устанавливаем по умолчанию audio/mpeg
-        
-        # Формируем ответ с правильными заголовками
-        flask_response = Response(audio_data)
-        flask_response.headers['Content-Type'] = content_type
-        flask_response.headers['Content-Length'] = str(len(audio_data))
-        flask_response.headers['Content-Disposition'] = 'inline; filename="audio.mp3"'
-        flask_response.headers['Accept-Ranges'] = 'bytes'
-        flask_response.headers['X-Proxy-Status'] = 'Success'
+    url = request.args.get('url')
+    if not url:
+        return "URL parameter is required", 400
+    # Проксируются только адреса CDN Suno и адреса, записанные в метаданных задачи:
+    # иначе прокси позволял бы скачивать и кэшировать произвольное содержимое, в том числе внутренние адреса
+    track = find_task_track(url, request.args.get('task_id'))
+    if not url.startswith(('http://', 'https://')) or (track is None and not is_allowed_url(url)):
+        return "Unsupported URL", 400
+    
+    # Локальный файл: send_file сам обрабатывает Range и условные запросы
+    local_path = find_local_audio(track) or audio_cache.lookup(url)
+    if local_path:
+        flask_response = send_file(os.path.abspath(local_path), mimetype='audio/mpeg',
+                                   conditional=True, max_age=24 * 3600)
+        flask_response.headers['X-Proxy-Status'] = 'Local'
         flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        
-        print(f"Успешно получен аудиофайл, размер: {len(audio_data)} байт, тип: {content_type}")
-        
         return flask_response
-        
+    
+    try:
+        print(f"Проксирование аудио из URL: {url}")
+        status_code, headers, chunks = audio_cache.open_remote(url, request.headers.get('Range'))
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при проксировании аудио: {str(e)}")
         error_message = f"Ошибка при получении аудио: {str(e)}"
-        return jsonify({'error': error_message}), 500
-    except Exception as e:
-        print(f"Неизвестная ошибка при проксировании аудио: {str(e)}")
-        return jsonify({'error': f"Неизвестная ошибка: {str(e)}"}), 500
+        return jsonify({'error': error_message}), 502
+    
+    flask_response = Response(chunks, status=status_code, headers=headers, direct_passthrough=True)
+    flask_response.headers['Content-Disposition'] = 'inline; filename="audio.mp3"'
+    flask_response.headers['X-Proxy-Status'] = 'Success'
+    flask_response.headers['Access-Control-Allow-Origin'] = '*'
+    return flask_response
 
 @app.route('/forum')
 def forum():
@@ -1293,6 +1756,13 @@ def submit_detailed_feedback():
             'error': f'Не удалось сохранить оценку: {str(e)}'
         }), 500
 
+# Фоновые службы запускаются при старте рабочего процесса, а не только при первом запросе.
+# Родительский процесс перезагрузчика Werkzeug (без WERKZEUG_RUN_MAIN) только следит за файлами
+# и лишних потоков не создает; WSGI-серверы включают запуск через BACKGROUND_SERVICES_ON_START=1
+if (os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+        or os.environ.get('BACKGROUND_SERVICES_ON_START', '0').lower() in ('1', 'true', 'yes')):
+    start_background_services()
+
 if __name__ == '__main__':
     print("\n=== Запуск сервера ===")
     print(f"API ключ OpenAI: {'настроен' if os.environ.get('OPENAI_API_KEY') else 'НЕ НАСТРОЕН'}")
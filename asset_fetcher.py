@@ -0,0 +1,177 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import requests.adapters
+
+from media_storage import GENERATED_MUSIC_DIR, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
+from music_metadata import metadata_store
+from notifications import music_events
+
+AUDIO_DIR = os.path.join(GENERATED_MUSIC_DIR, 'audio')
+COVERS_DIR = os.path.join(GENERATED_MUSIC_DIR, 'covers')
+
+ASSET_FETCH_WORKERS = int(os.environ.get('ASSET_FETCH_WORKERS', 4))
+ASSET_FETCH_ATTEMPTS = int(os.environ.get('ASSET_FETCH_ATTEMPTS', 4))
+
+
+def download_resumable(session, url, path, timeout=None, attempts=ASSET_FETCH_ATTEMPTS):
+    """
+    Скачивает файл с докачкой: данные пишутся в <path>.part, при обрыве следующая
+    попытка запрашивает только недостающую часть (заголовок Range). Готовый файл
+    атомарно переименовывается в path.
+
+    Args:
+        session (requests.Session): Сессия для HTTP-запросов
+        url (str): Адрес файла
+        path (str): Итоговый путь файла
+        timeout (int, optional): Таймаут соединения и чтения в секундах
+        attempts (int): Количество попыток
+
+    Returns:
+        str: Путь к скачанному файлу
+
+    Raises:
+        Exception: Последняя ошибка, если все попытки не удались
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part_path = path + '.part'
+    last_error = None
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(min(2 ** attempt, 30))
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=timeout or DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 416 and offset:
+                    # Часть уже скачана полностью
+                    break
+                response.raise_for_status()
+                # 206 — сервер продолжает с offset; 200 — докачка не поддерживается, начинаем заново
+                mode = 'ab' if offset and response.status_code == 206 else 'wb'
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+            break
+        except Exception as e:
+            last_error = e
+            print(f"Ошибка при скачивании {url} (попытка {attempt + 1}/{attempts}): {str(e)}")
+    else:
+        raise last_error
+
+    if not os.path.exists(part_path) or os.path.getsize(part_path) == 0:
+        raise ValueError(f"Получен пустой файл: {url}")
+    os.chmod(part_path, 0o644)
+    os.replace(part_path, path)
+    return path
+
+
+def track_asset_location(task_id, kind, track_index=0):
+    """
+    Путь к локальному файлу трека и URL для браузера.
+    Первый трек сохраняет прежние имена файлов (music_<task_id>.mp3, cover_<task_id>.jpg).
+
+    Args:
+        task_id (str): Идентификатор задачи
+        kind (str): 'audio' или 'image'
+        track_index (int): Номер трека в задаче
+
+    Returns:
+        tuple: (путь к файлу, URL файла)
+    """
+    suffix = f"_{track_index + 1}" if track_index else ''
+    if kind == 'audio':
+        filename = f"music_{task_id}{suffix}.mp3"
+        return os.path.join(AUDIO_DIR, filename), f"/static/generated_music/audio/{filename}"
+    filename = f"cover_{task_id}{suffix}.jpg"
+    return os.path.join(COVERS_DIR, filename), f"/static/generated_music/covers/{filename}"
+
+
+class AssetFetcher:
+    """
+    Фоновое скачивание аудио и обложек сгенерированной музыки.
+
+    Обработчик коллбэка Suno только ставит загрузки в очередь и сразу отвечает.
+    Аудио и обложка скачиваются параллельно ограниченным пулом потоков;
+    повторные коллбэки для той же задачи не запускают повторную загрузку.
+    После завершения метаданные задачи дополняются локальными путями.
+    """
+
+    def __init__(self, workers=None, store=None):
+        self.store = store or metadata_store
+        self._executor = ThreadPoolExecutor(max_workers=int(workers or ASSET_FETCH_WORKERS),
+                                            thread_name_prefix='asset-fetcher')
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=int(workers or ASSET_FETCH_WORKERS),
+                                                max_retries=3)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def fetch_track_assets(self, task_id, audio_url=None, image_url=None, track_index=0):
+        """
+        Ставит в очередь скачивание аудио и обложки трека.
+
+        Args:
+            task_id (str): Идентификатор задачи
+            audio_url (str, optional): Адрес MP3
+            image_url (str, optional): Адрес обложки
+            track_index (int): Номер трека в задаче (Suno обычно возвращает два трека)
+        """
+        if audio_url:
+            path, public_url = track_asset_location(task_id, 'audio', track_index)
+            self._submit(task_id, 'audio', track_index, audio_url, path, public_url)
+        if image_url:
+            path, public_url = track_asset_location(task_id, 'image', track_index)
+            self._submit(task_id, 'image', track_index, image_url, path, public_url)
+
+    def _submit(self, task_id, kind, track_index, url, path, public_url):
+        key = (task_id, kind, track_index)
+        with self._pending_lock:
+            if key in self._pending:
+                return
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                # Файл уже скачан по предыдущему коллбэку: только обновляем метаданные
+                self._record(key, path, public_url)
+                return
+            self._pending.add(key)
+        self._executor.submit(self._fetch, key, url, path, public_url)
+
+    def _fetch(self, key, url, path, public_url):
+        task_id, kind, track_index = key
+        try:
+            started = time.time()
+            download_resumable(self.session, url, path)
+            print(f"Скачан файл {os.path.basename(path)} для задачи {task_id} за {time.time() - started:.1f} с")
+            self._record(key, path, public_url)
+        except Exception as e:
+            print(f"Не удалось скачать {kind} трека {track_index} для задачи {task_id}: {str(e)}")
+        finally:
+            with self._pending_lock:
+                self._pending.discard(key)
+
+    def _record(self, key, path, public_url):
+        task_id, kind, track_index = key
+        fields = {f'local_{kind}_path': path, f'local_{kind}_url': public_url}
+
+        def apply(metadata):
+            tracks = metadata.get('tracks') or []
+            if track_index < len(tracks):
+                tracks[track_index].update(fields)
+            # Поля первого трека дублируются в корне метаданных для совместимости
+            if track_index == 0:
+                metadata.update(fields)
+
+        # Блокировка задачи: коллбэк, который еще обрабатывается, не перезапишет локальные пути
+        with self.store.lock(task_id):
+            self.store.update(task_id, apply)
+        music_events.publish(task_id, {'asset': kind, 'track': track_index})
+
+
+# Общий экземпляр для обработчика коллбэков
+asset_fetcher = AssetFetcher()
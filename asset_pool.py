@@ -0,0 +1,107 @@
+import os
+import random
+import threading
+
+from media_storage import GENERATED_IMAGES_DIR
+
+ASSET_POOL_VARIANTS = int(os.environ.get('ASSET_POOL_VARIANTS', 3))
+
+
+class AssetPool:
+    """
+    Пул заранее сгенерированных изображений для постоянного промпта.
+
+    Варианты хранятся рядом с остальными изображениями под именами
+    <name>_<хеш>.png и отдаются мгновенно, без обращения к API.
+    Пополняется в фоне при запуске приложения или командой
+    `python asset_pool.py`.
+    """
+
+    def __init__(self, name, prompt, directory=None, variants=None):
+        self.name = name
+        self.prompt = prompt
+        self.directory = directory or GENERATED_IMAGES_DIR
+        self.variants = int(variants if variants is not None else ASSET_POOL_VARIANTS)
+        self._fill_lock = threading.Lock()
+
+    def paths(self):
+        """
+        Возвращает пути всех готовых вариантов.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        prefix = f"{self.name}_"
+        return sorted(os.path.join(self.directory, filename) for filename in os.listdir(self.directory)
+                      if filename.startswith(prefix) and filename.endswith('.png'))
+
+    def pick(self):
+        """
+        Возвращает путь к случайному готовому варианту или None, если пул пуст.
+        """
+        paths = self.paths()
+        return random.choice(paths) if paths else None
+
+    def fill(self, generate):
+        """
+        Догенерирует недостающие варианты.
+
+        Args:
+            generate (callable): Функция generate(prompt, image_prefix=...) -> dict в формате
+                WarDiaryAnalyzer.generate_image (нужны success и local_path); файл сразу
+                сохраняется под именем варианта пула, WebP-копии создаются для него же
+
+        Returns:
+            int: Количество добавленных вариантов
+        """
+        if not self._fill_lock.acquire(blocking=False):
+            print(f"Пул {self.name} уже пополняется")
+            return 0
+        added = 0
+        try:
+            missing = self.variants - len(self.paths())
+            for attempt in range(max(0, missing)):
+                print(f"Генерация варианта {attempt + 1}/{missing} для пула {self.name}...")
+                try:
+                    result = generate(self.prompt, image_prefix=self.name)
+                except Exception as e:
+                    print(f"Ошибка при генерации варианта для пула {self.name}: {str(e)}")
+                    continue
+                result = result if isinstance(result, dict) else {}
+                local_path = result.get('local_path')
+                if not result.get('success') or not local_path or not os.path.exists(local_path):
+                    print(f"Не удалось сгенерировать вариант для пула {self.name}: {result.get('error', '')}")
+                    continue
+                added += 1
+            if added:
+                print(f"Пул {self.name} пополнен: {added} вариантов")
+            return added
+        finally:
+            self._fill_lock.release()
+
+    def fill_in_background(self, generate):
+        """
+        Запускает пополнение пула в фоновом потоке, если в нем не хватает вариантов.
+        """
+        if len(self.paths()) >= self.variants:
+            return
+        threading.Thread(target=self.fill, args=(generate,), name=f'asset-pool-{self.name}', daemon=True).start()
+
+
+def main():
+    import argparse
+    from war_diary_analyzer import get_analyzer, safe_image_pool
+
+    parser = argparse.ArgumentParser(description='Предварительная генерация изображений для запасных промптов')
+    parser.add_argument('--status', action='store_true', help='Только показать количество готовых вариантов')
+    args = parser.parse_args()
+
+    pool = safe_image_pool
+    if not args.status:
+        pool.fill(get_analyzer().generate_image)
+    print(f"Пул {pool.name}: {len(pool.paths())} из {pool.variants} вариантов")
+    for path in pool.paths():
+        print(f"  {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlencode, urlsplit
+
+import requests
+import requests.adapters
+
+from analysis_cache import INSTANCE_DIR
+from media_storage import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
+
+DEFAULT_AUDIO_CACHE_DIR = os.path.join(INSTANCE_DIR, 'audio_proxy_cache')
+AUDIO_PROXY_CACHE_MB = int(os.environ.get('AUDIO_PROXY_CACHE_MB', 512))
+# Домены, с которых прокси скачивает аудио (CDN Suno и файловые серверы apibox); поддомены разрешены
+AUDIO_PROXY_ALLOWED_HOSTS = tuple(
+    host.strip().lower().lstrip('.') for host in
+    os.environ.get('AUDIO_PROXY_ALLOWED_HOSTS', 'suno.ai,suno.com,erweima.ai,api.box').split(',')
+    if host.strip()
+)
+
+PROXY_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'audio/*, */*'
+}
+# Заголовки ответа источника, которые передаются клиенту
+FORWARDED_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Last-Modified', 'ETag')
+
+
+def proxy_url_for(audio_url, task_id=None):
+    """
+    Ссылка на /proxy_audio. task_id позволяет прокси отдать уже скачанный локальный файл задачи.
+    """
+    params = {'url': audio_url}
+    if task_id:
+        params['task_id'] = task_id
+    return f"/proxy_audio?{urlencode(params)}"
+
+
+def is_allowed_url(url, allowed_hosts=AUDIO_PROXY_ALLOWED_HOSTS):
+    """
+    Проверяет, что адрес указывает на разрешенный для проксирования хост.
+
+    Args:
+        url (str): Адрес аудиофайла
+        allowed_hosts (tuple): Разрешенные домены
+
+    Returns:
+        bool: True, если схема http(s), а хост совпадает с разрешенным доменом или его поддоменом
+    """
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+    except ValueError:
+        return False
+    if parts.scheme not in ('http', 'https') or not host:
+        return False
+    return any(host == allowed or host.endswith('.' + allowed) for allowed in allowed_hosts)
+
+
+class AudioProxyCache:
+    """
+    Дисковый кэш аудио для /proxy_audio с ограничением по размеру (instance/audio_proxy_cache).
+
+    Файл попадает в кэш, когда прокси целиком передает его клиенту (запись идет параллельно
+    с отправкой), после чего запросы с Range обслуживаются с диска. При превышении лимита
+    удаляются файлы, к которым дольше всего не обращались (время доступа — mtime файла).
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or os.environ.get('AUDIO_PROXY_CACHE_DIR', DEFAULT_AUDIO_CACHE_DIR)
+        self.max_bytes = max_bytes if max_bytes is not None else AUDIO_PROXY_CACHE_MB * 1024 * 1024
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def path_for(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.mp3')
+
+    def lookup(self, url):
+        """
+        Возвращает путь к закэшированному файлу (и отмечает обращение) или None.
+        """
+        path = self.path_for(url)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def open_remote(self, url, range_header=None):
+        """
+        Открывает потоковый запрос к источнику, передавая ему заголовок Range клиента.
+
+        Args:
+            url (str): Адрес аудиофайла
+            range_header (str, optional): Заголовок Range из запроса клиента
+
+        Returns:
+            tuple: (код ответа, заголовки для клиента, генератор блоков)
+        """
+        headers = dict(PROXY_HEADERS)
+        # "bytes=0-" равносилен запросу всего файла: такой ответ можно сохранить в кэш
+        partial = bool(range_header) and range_header.strip() != 'bytes=0-'
+        if partial:
+            headers['Range'] = range_header
+        response = self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code >= 400 and response.status_code != 416:
+            response.close()
+            response.raise_for_status()
+
+        forwarded = {name: response.headers[name] for name in FORWARDED_HEADERS if name in response.headers}
+        if 'audio' not in forwarded.get('Content-Type', ''):
+            forwarded['Content-Type'] = 'audio/mpeg'
+        forwarded.setdefault('Accept-Ranges', 'bytes')
+
+        if response.status_code == 200 and not partial:
+            chunks = self._write_through(url, response)
+        else:
+            chunks = self._relay(response)
+        return response.status_code, forwarded, chunks
+
+    @staticmethod
+    def _relay(response):
+        try:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
+
+    def _write_through(self, url, response):
+        """
+        Отдает блоки клиенту и одновременно пишет их во временный файл кэша.
+        Файл попадает в кэш, только если получен целиком.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        expected = response.headers.get('Content-Length')
+        fd, temp_path = tempfile.mkstemp(prefix='.audio_', suffix='.part', dir=self.directory)
+        size = 0
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    temp_file.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            complete = size > 0 and (expected is None or int(expected) == size)
+        finally:
+            # Клиент мог отключиться раньше: неполный файл не сохраняем
+            response.close()
+            if complete and size <= self.max_bytes:
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, self.path_for(url))
+                self._evict()
+            elif os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.mp3'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, filename))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+            total = sum(size for _, size, _ in entries)
+            for _, size, filename in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                    total -= size
+                except OSError:
+                    pass
+
+
+# Общий экземпляр для /proxy_audio
+audio_cache = AudioProxyCache()
@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from war_diary_analyzer import get_analyzer
+import emotion_lexicon
+
+# Размер пачки для векторизованного словарного анализа
+LEXICON_BATCH_SIZE = 512
+
+
+def iter_diaries(source):
+    """
+    Перебирает дневники из каталога с файлами *.txt или из JSONL-файла.
+
+    Для каталога идентификатором служит имя файла без расширения, для JSONL —
+    поле id (или номер строки, если поле отсутствует).
+
+    Yields:
+        tuple: (идентификатор, текст дневника)
+    """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if not name.lower().endswith('.txt') or not os.path.isfile(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                yield os.path.splitext(name)[0], f.read()
+        return
+
+    with open(source, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Строка {line_number} пропущена: некорректный JSON ({str(e)})")
+                continue
+            text = record.get('text') or record.get('diary_text')
+            if not text:
+                print(f"Строка {line_number} пропущена: нет поля text")
+                continue
+            yield str(record.get('id', line_number)), text
+
+
+def load_completed_ids(output_path):
+    """
+    Читает уже записанные результаты и возвращает идентификаторы успешно
+    обработанных дневников. Выходной файл одновременно служит контрольной точкой:
+    при повторном запуске эти дневники пропускаются, а завершившиеся ошибкой — повторяются.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла оборваться при аварийном завершении
+                continue
+            if record.get('status') == 'ok':
+                completed.add(str(record.get('id')))
+    return completed
+
+
+def process_one(analyzer, diary_id, text, with_literary):
+    """
+    Анализирует один дневник и возвращает запись для выходного JSONL.
+    """
+    start_time = time.time()
+    record = {'id': diary_id, 'chars': len(text)}
+    try:
+        # Без словарной замены: ошибка API записывается как ошибка и повторяется при возобновлении
+        emotion_analysis = analyzer.analyze_emotions(text, allow_fallback=False)
+        record['emotion_analysis'] = emotion_analysis
+        if emotion_analysis.get('error'):
+            record['status'] = 'error'
+            record['error'] = emotion_analysis['error']
+        else:
+            record['status'] = 'ok'
+            if with_literary:
+                record['generated_literary_work'] = analyzer.generate_literary_work(text, emotion_analysis)
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
+    record['latency'] = round(time.time() - start_time, 3)
+    return record
+
+
+def percentile(values, fraction):
+    """
+    Возвращает перцентиль (метод ближайшего ранга) для непустого списка.
+    """
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_batch(source, output_path, concurrency=4, with_literary=False, limit=None, lexicon=False):
+    """
+    Обрабатывает корпус дневников с ограничением параллелизма и
+    дописывает результаты в JSONL по мере готовности.
+
+    В режиме lexicon вместо запросов к GPT используется словарный анализ,
+    который считается пачками одной матричной операцией.
+
+    Returns:
+        dict: Итоговая статистика запуска
+    """
+    analyzer = None if lexicon else get_analyzer()
+    completed = load_completed_ids(output_path)
+    if completed:
+        print(f"Найдено {len(completed)} уже обработанных дневников, они будут пропущены")
+
+    latencies = []
+    counts = {'ok': 0, 'error': 0, 'skipped': 0}
+    start_time = time.time()
+
+    # В работе держим не больше 2 × concurrency дневников, чтобы не читать весь архив в память
+    max_in_flight = concurrency * 2
+    in_flight = set()
+
+    def write_record(record):
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+        latencies.append(record['latency'])
+        counts[record['status']] += 1
+        done_total = counts['ok'] + counts['error']
+        if done_total % (LEXICON_BATCH_SIZE if lexicon else 10) == 0:
+            elapsed = time.time() - start_time
+            print(f"Обработано {done_total} дневников ({done_total / elapsed * 60:.1f} в минуту)")
+
+    def drain(futures):
+        for future in futures:
+            write_record(future.result())
+
+    def score_lexicon_batch(batch):
+        batch_start = time.time()
+        results = emotion_lexicon.score_many([text for _, text in batch])
+        latency = (time.time() - batch_start) / len(batch)
+        for (diary_id, text), result in zip(batch, results):
+            write_record({'id': diary_id, 'chars': len(text), 'emotion_analysis': result,
+                          'status': 'ok', 'latency': round(latency, 6)})
+
+    # Оборванная последняя строка не должна склеиться со следующей записью
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+    submitted = 0
+    with open(output_path, 'a', encoding='utf-8') as out, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+        try:
+            lexicon_batch = []
+            for diary_id, text in iter_diaries(source):
+                if diary_id in completed:
+                    counts['skipped'] += 1
+                    continue
+                if limit is not None and submitted >= limit:
+                    break
+                if lexicon:
+                    lexicon_batch.append((diary_id, text))
+                    submitted += 1
+                    if len(lexicon_batch) >= LEXICON_BATCH_SIZE:
+                        score_lexicon_batch(lexicon_batch)
+                        lexicon_batch = []
+                    continue
+                if len(in_flight) >= max_in_flight:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    drain(finished)
+                in_flight.add(executor.submit(process_one, analyzer, diary_id, text, with_literary))
+                submitted += 1
+            if lexicon_batch:
+                score_lexicon_batch(lexicon_batch)
+            finished, in_flight = wait(in_flight)
+            drain(finished)
+        except KeyboardInterrupt:
+            print("Прерывание: дожидаемся уже запущенных дневников, остальные будут обработаны при следующем запуске")
+            for future in in_flight:
+                future.cancel()
+            drain([future for future in in_flight if not future.cancelled()])
+
+    elapsed = time.time() - start_time
+    processed = counts['ok'] + counts['error']
+    stats = {
+        'processed': processed,
+        'ok': counts['ok'],
+        'errors': counts['error'],
+        'skipped': counts['skipped'],
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_per_minute': round(processed / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        'latency_p50': percentile(latencies, 0.5) if latencies else None,
+        'latency_p95': percentile(latencies, 0.95) if latencies else None
+    }
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пакетный анализ корпуса военных дневников')
+    parser.add_argument('source', help='Каталог с файлами *.txt или JSONL-файл с полями id и text')
+    parser.add_argument('-o', '--output', default='batch_results.jsonl',
+                        help='Выходной JSONL-файл (он же контрольная точка для возобновления)')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=int(os.environ.get('BATCH_CONCURRENCY', 4)),
+                        help='Максимальное число одновременно обрабатываемых дневников')
+    parser.add_argument('--literary', action='store_true',
+                        help='Дополнительно генерировать литературное произведение')
+    parser.add_argument('--lexicon', action='store_true',
+                        help='Быстрый словарный анализ без обращения к OpenAI')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Обработать не больше указанного числа новых дневников')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f"Источник не найден: {args.source}")
+        sys.exit(1)
+
+    stats = run_batch(args.source, args.output, max(1, args.concurrency), args.literary, args.limit,
+                      args.lexicon)
+
+    print("\n=== Итоги пакетного анализа ===")
+    print(f"Обработано: {stats['processed']} (успешно: {stats['ok']}, с ошибкой: {stats['errors']}), "
+          f"пропущено ранее обработанных: {stats['skipped']}")
+    print(f"Время: {stats['elapsed_seconds']} с, производительность: {stats['throughput_per_minute']} дневников/мин")
+    if stats['latency_p50'] is not None:
+        print(f"Задержка p50: {stats['latency_p50']:.3f} с, p95: {stats['latency_p95']:.3f} с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import re
+import time
+
+# Слова, которые могут вызвать фильтрацию содержимого: промпт смягчается
+RISKY_WORDS = [
+    "война", "военный", "битва", "сражение", "атака", "бой", "труп",
+    "оружие", "убитый", "раненый", "насилие", "кровь", "взрыв", "бомба",
+    "war", "battle", "violence", "dead", "kill", "blood", "weapon", "gun",
+    "attack", "corpse", "victim", "bomb", "explosive", "combat", "fight"
+]
+
+# Явные описания насилия: генерация изображения по такому тексту сразу отклоняется
+EXTREMELY_VIOLENT_WORDS = [
+    "кровь", "пытки", "пытка", "расстрел", "убил", "пули", "труп",
+    "изуродован", "оторвало", "blood", "torture", "shot", "killed", "bullets",
+    "corpse", "mutilated", "dismembered", "gore", "visceral"
+]
+
+RISKY = 'risky'
+EXTREME_VIOLENCE = 'extreme_violence'
+
+
+def _trie_pattern(node):
+    """
+    Рекурсивно превращает префиксное дерево в регулярное выражение.
+    Необязательные группы жадные, поэтому в каждой позиции находится самое длинное слово.
+    """
+    terminal = '' in node
+    branches = [re.escape(char) + _trie_pattern(child)
+                for char, child in sorted(node.items()) if char != '']
+    if not branches:
+        return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if terminal:
+        # Составное тело нужно сгруппировать, иначе "?" относится только к последнему символу
+        return ('(?:' + body + ')?') if len(body) > 1 else body + '?'
+    return body
+
+
+class KeywordScreener:
+    """
+    Предкомпилированный поиск множества ключевых слов за один проход по тексту.
+
+    Слова объединяются в префиксное дерево и компилируются в одно регулярное
+    выражение внутри опережающей проверки, поэтому находятся и перекрывающиеся
+    вхождения. Как и прежние проверки `word in text.lower()`, слова ищутся как
+    подстроки без учета регистра.
+    """
+
+    def __init__(self, categories):
+        """
+        Args:
+            categories (dict): Категория -> список слов
+        """
+        self._all_categories = frozenset(categories)
+        term_categories = {}
+        for category, words in categories.items():
+            for word in words:
+                term_categories.setdefault(word.lower(), set()).add(category)
+
+        # Найденное самое длинное слово означает, что в той же позиции
+        # встретились и все его префиксы, поэтому их категории объединяются
+        self._categories = {}
+        for term in term_categories:
+            merged = set()
+            for prefix_length in range(1, len(term) + 1):
+                merged |= term_categories.get(term[:prefix_length], set())
+            self._categories[term] = frozenset(merged)
+
+        trie = {}
+        for term in term_categories:
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[''] = True
+        self._regex = re.compile('(?=(' + _trie_pattern(trie) + '))') if trie else None
+
+    def scan(self, text):
+        """
+        Находит все вхождения ключевых слов.
+
+        Args:
+            text (str): Проверяемый текст
+
+        Returns:
+            list: Совпадения вида {'term', 'start', 'end', 'categories'}; смещения
+                  относятся к тексту в нижнем регистре (для кириллицы и латиницы они совпадают с исходными)
+        """
+        if not text or self._regex is None:
+            return []
+        hits = []
+        for match in self._regex.finditer(text.lower()):
+            term = match.group(1)
+            hits.append({
+                'term': term,
+                'start': match.start(),
+                'end': match.start() + len(term),
+                'categories': sorted(self._categories[term])
+            })
+        return hits
+
+    def categories(self, text):
+        """
+        Возвращает множество категорий, слова из которых встречаются в тексте.
+        Просмотр прекращается, как только найдены все категории.
+        """
+        found = set()
+        if not text or self._regex is None:
+            return found
+        for match in self._regex.finditer(text.lower()):
+            found |= self._categories[match.group(1)]
+            if found == self._all_categories:
+                break
+        return found
+
+
+# Общий экземпляр для всех мест проверки текста перед генерацией изображений
+content_screener = KeywordScreener({
+    RISKY: RISKY_WORDS,
+    EXTREME_VIOLENCE: EXTREMELY_VIOLENT_WORDS,
+})
+
+
+def _benchmark(size=100_000, iterations=20):
+    """
+    Сравнивает однопроходный поиск с прежними проверками `any(word in text.lower() ...)`.
+    """
+    clean = ("Сегодня весь день шли по раскисшей дороге. Писал письмо маме, "
+             "вспоминал дом и сад. Вечером у костра пели песни. ")
+    noisy = clean + "Ночью началась атака, кровь на снегу. "
+    for label, sentence in (("без совпадений", clean), ("с совпадениями", noisy)):
+        text = (sentence * (size // len(sentence) + 1))[:size]
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            # Прежний код: две проверки, каждая понижает регистр и сканирует текст для каждого слова
+            any(word in text.lower() for word in EXTREMELY_VIOLENT_WORDS)
+            any(word in text.lower() for word in RISKY_WORDS)
+        naive = (time.perf_counter() - start) / iterations
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            content_screener.categories(text)
+        compiled = (time.perf_counter() - start) / iterations
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            hits = content_screener.scan(text)
+        full_scan = (time.perf_counter() - start) / iterations
+
+        print(f"Текст {len(text) // 1000} КБ ({label}): any() {naive * 1000:.2f} мс, "
+              f"categories() {compiled * 1000:.2f} мс, scan() {full_scan * 1000:.2f} мс "
+              f"({len(hits)} совпадений)")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,170 @@
+import re
+from collections import Counter, OrderedDict
+
+# Строка, начинающаяся с даты, обычно открывает новую дневниковую запись:
+# "15 августа 1943 года", "12.05.1942", "1943-08-15", "August 15, 1943"
+_MONTHS = (r'января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря|'
+           r'january|february|march|april|may|june|july|august|september|october|november|december')
+DATE_LINE_RE = re.compile(
+    r'^\s*(?:\d{1,2}\s+(?:' + _MONTHS + r')(?:\s+\d{4})?'
+    r'|\d{1,2}[./]\d{1,2}[./]\d{2,4}'
+    r'|\d{4}-\d{2}-\d{2}'
+    r'|(?:' + _MONTHS + r')\s+\d{1,2},?\s+\d{4})',
+    re.IGNORECASE
+)
+
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+')
+
+THEMATIC_KEYS = ['military_characters', 'battle_locations', 'war_equipment',
+                 'frontline_life', 'historical_events']
+
+
+def _split_long_paragraph(paragraph, max_chars):
+    """
+    Делит слишком длинный абзац по границам предложений, а при необходимости — жестко.
+    """
+    parts = []
+    current = ''
+    for sentence in _SENTENCE_END_RE.split(paragraph):
+        while len(sentence) > max_chars:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            parts.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_diary_into_chunks(text, max_chars=6000):
+    """
+    Делит длинный дневник на фрагменты не длиннее max_chars.
+
+    Границы фрагментов выбираются по абзацам; строка с датой начинает новый
+    фрагмент, если текущий уже заполнен хотя бы наполовину, чтобы записи
+    разных дней по возможности не смешивались.
+
+    Args:
+        text (str): Текст дневника
+        max_chars (int): Максимальная длина фрагмента
+
+    Returns:
+        list: Список фрагментов текста
+    """
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n', text.replace('\r\n', '\n')) if p.strip()]
+    # Даты внутри абзаца без пустой строки тоже считаем началом новой записи
+    blocks = []
+    for paragraph in paragraphs:
+        current = []
+        for line in paragraph.split('\n'):
+            if DATE_LINE_RE.match(line) and current:
+                blocks.append('\n'.join(current))
+                current = []
+            current.append(line)
+        if current:
+            blocks.append('\n'.join(current))
+
+    chunks = []
+    current = ''
+    for block in blocks:
+        pieces = _split_long_paragraph(block, max_chars) if len(block) > max_chars else [block]
+        for piece in pieces:
+            starts_entry = bool(DATE_LINE_RE.match(piece))
+            too_long = current and len(current) + 2 + len(piece) > max_chars
+            entry_boundary = current and starts_entry and len(current) >= max_chars // 2
+            if too_long or entry_boundary:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _dedupe(values, limit):
+    """
+    Убирает повторы без учета регистра, упорядочивая по частоте упоминания.
+    """
+    counts = Counter()
+    first_seen = OrderedDict()
+    for value in values:
+        if not isinstance(value, str) or not value.strip():
+            continue
+        key = value.strip().lower()
+        counts[key] += 1
+        first_seen.setdefault(key, value.strip())
+    ordered = sorted(first_seen, key=lambda key: -counts[key])
+    return [first_seen[key] for key in ordered[:limit]]
+
+
+def merge_emotion_analyses(analyses, weights, max_emotions=8):
+    """
+    Объединяет результаты анализа фрагментов в один результат той же схемы.
+
+    Интенсивность эмоции — средневзвешенная по фрагментам, где она встречается
+    (вес — длина фрагмента); порядок эмоций определяется суммарным вкладом
+    intensity × вес, так что эмоции, проходящие через весь дневник, оказываются выше.
+
+    Args:
+        analyses (list): Результаты analyze_emotions для каждого фрагмента
+        weights (list): Веса фрагментов (обычно длины текста)
+        max_emotions (int): Максимальное количество эмоций в результате
+
+    Returns:
+        dict: Объединенный результат анализа эмоций
+    """
+    scores = {}
+    present_weight = {}
+    names = {}
+    motives = []
+    thematic = {key: [] for key in THEMATIC_KEYS}
+    dominant = None
+
+    for analysis, weight in zip(analyses, weights):
+        emotions = analysis.get('primary_emotions') or []
+        for item in emotions:
+            if not isinstance(item, dict) or not item.get('emotion'):
+                continue
+            try:
+                intensity = float(item.get('intensity', 5))
+            except (TypeError, ValueError):
+                intensity = 5.0
+            key = str(item['emotion']).strip().lower()
+            names.setdefault(key, str(item['emotion']).strip())
+            scores[key] = scores.get(key, 0.0) + intensity * weight
+            present_weight[key] = present_weight.get(key, 0.0) + weight
+
+        motives.extend(analysis.get('hidden_motives') or [])
+        for key in THEMATIC_KEYS:
+            thematic[key].extend((analysis.get('thematic_analysis') or {}).get(key) or [])
+
+        # Тон и отношение берем из фрагмента с наибольшим эмоциональным вкладом
+        contribution = weight * max([e.get('intensity', 0) for e in emotions
+                                     if isinstance(e, dict) and isinstance(e.get('intensity'), (int, float))] or [0])
+        if dominant is None or contribution > dominant[0]:
+            dominant = (contribution, analysis)
+
+    ranked = sorted(scores, key=lambda key: -scores[key])[:max_emotions]
+    primary_emotions = [
+        {
+            'emotion': names[key],
+            'intensity': max(1, min(10, round(scores[key] / present_weight[key])))
+        }
+        for key in ranked
+    ]
+
+    dominant_analysis = dominant[1] if dominant else {}
+    return {
+        'primary_emotions': primary_emotions,
+        'emotional_tone': dominant_analysis.get('emotional_tone', 'неизвестно'),
+        'hidden_motives': _dedupe(motives, 10),
+        'attitude': dominant_analysis.get('attitude', 'неизвестно'),
+        'thematic_analysis': {key: _dedupe(values, 15) for key, values in thematic.items()}
+    }
@@ -0,0 +1,230 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from diary_chunking import THEMATIC_KEYS
+
+# Канонические идентификаторы эмоций и их названия для отображения
+EMOTION_LABELS = {
+    'fear': 'страх',
+    'sadness': 'грусть',
+    'despair': 'отчаяние',
+    'hope': 'надежда',
+    'joy': 'радость',
+    'pride': 'гордость',
+    'determination': 'решимость',
+}
+EMOTION_IDS = list(EMOTION_LABELS)
+
+# Названия эмоций (в том числе те, что возвращает GPT), сводимые к каноническому идентификатору
+EMOTION_SYNONYMS = {
+    'fear': ['страх', 'ужас', 'тревога', 'тревожность', 'паника', 'испуг', 'беспокойство',
+             'fear', 'anxiety', 'panic', 'terror', 'dread'],
+    'sadness': ['грусть', 'печаль', 'скорбь', 'тоска', 'горе', 'меланхолия',
+                'sadness', 'grief', 'sorrow', 'melancholy'],
+    'despair': ['отчаяние', 'безысходность', 'безнадежность', 'despair', 'hopelessness'],
+    'hope': ['надежда', 'вера', 'hope', 'faith'],
+    'joy': ['радость', 'счастье', 'облегчение', 'joy', 'happiness', 'relief'],
+    'pride': ['гордость', 'отвага', 'мужество', 'героизм', 'храбрость',
+              'pride', 'courage', 'bravery', 'valor', 'heroism'],
+    'determination': ['решимость', 'стойкость', 'упорство', 'determination', 'resolve', 'conviction'],
+}
+
+# Слова-маркеры эмоций в тексте дневника (дополнительно к названиям эмоций)
+EMOTION_CUES = {
+    'fear': ['страшно', 'страшный', 'страшная', 'боюсь', 'бояться', 'боялся', 'боялись', 'испугался',
+             'испугались', 'жутко', 'жуткий', 'тревожно', 'опасность', 'afraid', 'scared', 'frightened'],
+    'sadness': ['грустно', 'печально', 'тоскливо', 'слезы', 'слёзы', 'плакал', 'плакали', 'плачу',
+                'погиб', 'погибли', 'потеряли', 'похоронили', 'убит', 'убиты', 'sad', 'tears', 'mourning'],
+    'despair': ['безнадежно', 'обреченность', 'hopeless'],
+    'hope': ['надеюсь', 'надеемся', 'надеяться', 'верю', 'верим', 'веры', 'мечтаю', 'дождемся',
+             'победа', 'победу', 'hoping', 'believe'],
+    'joy': ['рад', 'рада', 'рады', 'радостно', 'счастлив', 'счастливы', 'улыбка', 'улыбались',
+            'смеялись', 'happy', 'glad'],
+    'pride': ['горжусь', 'гордимся', 'гордый', 'подвиг', 'герой', 'герои', 'храбро', 'proud', 'brave', 'hero'],
+    'determination': ['держимся', 'выстоим', 'выстоять', 'выдержим', 'решили',
+                      'steadfast', 'determined'],
+}
+
+# Общий тон по доминирующей эмоции
+EMOTION_TONES = {
+    'fear': 'тревожный, напряженный',
+    'sadness': 'печальный, скорбный',
+    'despair': 'мрачный, безысходный',
+    'hope': 'сдержанный, с надеждой на лучшее',
+    'joy': 'светлый, радостный',
+    'pride': 'торжественный, героический',
+    'determination': 'собранный, решительный',
+}
+
+# Слово перед маркером, отменяющее его ("не боюсь", "без страха")
+NEGATIONS = {'не', 'нет', 'ни', 'без', 'not', 'no', 'never', 'without'}
+
+# Окончания для упрощенного стемминга русских слов (сначала самые длинные).
+# Основа должна оставаться не короче четырех букв, чтобы "страх" и "рад" не теряли смысл
+_RU_REFLEXIVE = ('ся', 'сь')
+_RU_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'его', 'ого', 'ему', 'ому', 'ыми', 'ими', 'иях', 'ях', 'ах',
+    'ов', 'ев', 'ей', 'ий', 'ый', 'ой', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ым', 'им',
+    'ом', 'ем', 'ую', 'юю', 'ать', 'ять', 'еть', 'ить', 'уть', 'ыть', 'ешь', 'ет', 'ете', 'ут', 'ют', 'ат', 'ят', 'ишь',
+    'ит', 'ите', 'ла', 'ло', 'ли', 'ия', 'ию', 'ии', 'л', 'а', 'я', 'о', 'е', 'и',
+    'ы', 'у', 'ю', 'ь', 'й'
+], key=len, reverse=True)
+_EN_ENDINGS = ('ing', 'ed', 'es', 's')
+
+_WORD_RE = re.compile(r'[а-яёa-z]+')
+_CYRILLIC_RE = re.compile(r'[а-я]')
+
+# Насыщение шкалы интенсивности: маркеров на 1000 слов, при которых интенсивность ~7 из 10
+INTENSITY_SATURATION = 25.0
+MAX_EMOTIONS = 5
+
+
+@lru_cache(maxsize=50000)
+def stem(word):
+    """
+    Упрощенный стемминг: отбрасывает возвратную частицу и одно окончание,
+    оставляя основу не короче четырех букв (для английских слов — трех).
+    """
+    word = word.lower().replace('ё', 'е')
+    if _CYRILLIC_RE.search(word):
+        for suffix in _RU_REFLEXIVE:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+                word = word[:-len(suffix)]
+                break
+        endings, min_stem = _RU_ENDINGS, 4
+    else:
+        endings, min_stem = _EN_ENDINGS, 3
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= min_stem:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    """
+    Разбивает текст на слова в нижнем регистре.
+    """
+    return _WORD_RE.findall(text.lower().replace('ё', 'е'))
+
+
+def _build_index(*sources):
+    index = {}
+    for source in sources:
+        for emotion_id, words in source.items():
+            for word in words:
+                for token in tokenize(word):
+                    index.setdefault(stem(token), emotion_id)
+    return index
+
+
+_SYNONYM_INDEX = _build_index(EMOTION_SYNONYMS)
+_CUE_INDEX = _build_index(EMOTION_SYNONYMS, EMOTION_CUES)
+
+# Словарь основ и матрица весов "основа × эмоция" для векторизованного подсчета
+_VOCAB = {term: i for i, term in enumerate(sorted(_CUE_INDEX))}
+_WEIGHTS = np.zeros((len(_VOCAB), len(EMOTION_IDS)), dtype=np.float32)
+for _term, _column in _VOCAB.items():
+    # Прямое название эмоции весит больше, чем косвенный маркер
+    _WEIGHTS[_column, EMOTION_IDS.index(_CUE_INDEX[_term])] = 1.5 if _term in _SYNONYM_INDEX else 1.0
+
+
+def canonical_emotion(name):
+    """
+    Сводит название эмоции (русское или английское, в любой форме) к каноническому идентификатору.
+
+    Args:
+        name (str): Название эмоции, например "Страх", "тревожность" или "Fear"
+
+    Returns:
+        str or None: Идентификатор из EMOTION_LABELS или None, если эмоция неизвестна
+    """
+    if not isinstance(name, str):
+        return None
+    for token in tokenize(name):
+        emotion_id = _SYNONYM_INDEX.get(stem(token))
+        if emotion_id:
+            return emotion_id
+    return None
+
+
+def _count_matrix(texts):
+    """
+    Строит матрицу "текст × основа" с количеством маркеров и вектор длин текстов в словах.
+    """
+    counts = np.zeros((len(texts), len(_VOCAB)), dtype=np.float32)
+    totals = np.zeros(len(texts), dtype=np.float32)
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        tokens = tokenize(text or '')
+        totals[row] = len(tokens)
+        previous = None
+        for token in tokens:
+            column = _VOCAB.get(stem(token))
+            if column is not None and previous not in NEGATIONS:
+                rows.append(row)
+                columns.append(column)
+            previous = token
+    if rows:
+        np.add.at(counts, (np.array(rows), np.array(columns)), 1.0)
+    return counts, totals
+
+
+def score_matrix(texts):
+    """
+    Возвращает матрицу интенсивностей "текст × эмоция" (0 — эмоция не найдена, иначе 1–10).
+
+    Интенсивность зависит от плотности маркеров на 1000 слов и насыщается,
+    поэтому длинный текст с редкими упоминаниями получает низкие значения.
+    """
+    counts, totals = _count_matrix(texts)
+    hits = counts @ _WEIGHTS
+    density = hits / np.maximum(totals, 1.0)[:, None] * 1000.0
+    intensity = 1.0 + 9.0 * (1.0 - np.exp(-density / INTENSITY_SATURATION))
+    return np.where(hits > 0, np.clip(np.rint(intensity), 1, 10), 0).astype(np.int32)
+
+
+def _result_from_row(row):
+    order = np.argsort(-row, kind='stable')
+    primary_emotions = [
+        {'emotion': EMOTION_LABELS[EMOTION_IDS[i]], 'intensity': int(row[i])}
+        for i in order[:MAX_EMOTIONS] if row[i] > 0
+    ]
+    dominant = EMOTION_IDS[order[0]] if row[order[0]] > 0 else None
+    return {
+        'primary_emotions': primary_emotions,
+        'emotional_tone': EMOTION_TONES[dominant] if dominant else 'нейтральный',
+        'hidden_motives': [],
+        'attitude': 'неизвестно',
+        'thematic_analysis': {key: [] for key in THEMATIC_KEYS},
+        'source': 'lexicon'
+    }
+
+
+def score_many(texts):
+    """
+    Словарный анализ эмоций для набора текстов одной матричной операцией.
+
+    Args:
+        texts (list): Тексты дневников
+
+    Returns:
+        list: Результаты в формате analyze_emotions (с полем source='lexicon')
+    """
+    if not texts:
+        return []
+    return [_result_from_row(row) for row in score_matrix(list(texts))]
+
+
+def analyze(text):
+    """
+    Быстрый локальный анализ эмоций одного текста без обращения к API.
+
+    Args:
+        text (str): Текст дневника
+
+    Returns:
+        dict: Результат в формате analyze_emotions (с полем source='lexicon')
+    """
+    return score_many([text])[0]
@@ -0,0 +1,193 @@
+import os
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from media_storage import GENERATED_IMAGES_DIR
+
+# Ширины миниатюр; полноразмерная копия в WebP создается всегда
+DERIVATIVE_WIDTHS = (256, 512)
+FULL_VARIANT = 'full'
+WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', 80))
+ORIGINAL_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Производные создаются в фоне, вне обработки запроса
+_derivative_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('IMAGE_DERIVATIVE_WORKERS', 1)),
+                                          thread_name_prefix='image-derivatives')
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def derivative_path(original_path, width=None):
+    """
+    Возвращает путь к производному файлу рядом с оригиналом:
+    image_x.png -> image_x.webp (полный размер) или image_x_256.webp.
+    """
+    base = os.path.splitext(original_path)[0]
+    return f"{base}.webp" if width is None else f"{base}_{width}.webp"
+
+
+def variant_path(original_path, variant):
+    """
+    Путь к варианту изображения по имени варианта ('full' или ширина в виде строки).
+    """
+    return derivative_path(original_path, None if variant == FULL_VARIANT else int(variant))
+
+
+def is_original(filename):
+    return filename.lower().endswith(ORIGINAL_EXTENSIONS) and not filename.startswith('.')
+
+
+def _save_webp(image, path):
+    # Пишем во временный файл и атомарно переименовываем, чтобы не отдать недописанный файл
+    fd, temp_path = tempfile.mkstemp(suffix='.webp.part', dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    try:
+        image.save(temp_path, 'WEBP', quality=WEBP_QUALITY, method=4)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def create_derivatives(original_path):
+    """
+    Создает WebP-копию и миниатюры для изображения (уже существующие файлы пропускаются).
+
+    Args:
+        original_path (str): Путь к исходному изображению
+
+    Returns:
+        list: Пути созданных файлов
+    """
+    targets = [(None, derivative_path(original_path))]
+    targets += [(width, derivative_path(original_path, width)) for width in DERIVATIVE_WIDTHS]
+    targets = [(width, path) for width, path in targets if not os.path.exists(path)]
+    if not targets:
+        return []
+
+    created = []
+    with Image.open(original_path) as source:
+        image = source.convert('RGBA' if 'A' in source.getbands() or source.mode == 'P' else 'RGB')
+        for width, path in targets:
+            if width is None:
+                variant = image
+            else:
+                variant = image.copy()
+                variant.thumbnail((width, width), Image.LANCZOS)
+            _save_webp(variant, path)
+            created.append(path)
+    return created
+
+
+def _run_scheduled(original_path):
+    try:
+        created = create_derivatives(original_path)
+        if created:
+            print(f"Созданы производные изображения для {os.path.basename(original_path)}: {len(created)}")
+    except Exception as e:
+        print(f"Ошибка при создании производных изображения {original_path}: {str(e)}")
+    finally:
+        with _pending_lock:
+            _pending.discard(original_path)
+
+
+def schedule_derivatives(original_path):
+    """
+    Ставит создание производных в фоновую очередь (повторные вызовы для того же файла игнорируются).
+    """
+    if not original_path:
+        return
+    with _pending_lock:
+        if original_path in _pending:
+            return
+        _pending.add(original_path)
+    _derivative_executor.submit(_run_scheduled, original_path)
+
+
+def derivative_urls(local_path):
+    """
+    Формирует URL производных изображения для ответа API и атрибута srcset.
+    URL ведут на маршрут /images/<вариант>/<файл>, который отдает оригинал,
+    пока производная еще не создана. Ширины в srcset берутся из размера оригинала
+    (миниатюры не увеличиваются, поэтому узкий оригинал дает узкие миниатюры).
+
+    Args:
+        local_path (str): Путь к оригиналу (например, static/generated_images/image_x.png)
+
+    Returns:
+        dict: {'derivatives': {...}, 'srcset': str} или пустой словарь
+    """
+    if not local_path:
+        return {}
+    filename = os.path.basename(local_path.replace('\\', '/'))
+    urls = {str(width): f"/images/{width}/{filename}" for width in DERIVATIVE_WIDTHS}
+    urls[FULL_VARIANT] = f"/images/{FULL_VARIANT}/{filename}"
+    original_width = image_width(local_path)
+    if original_width is None:
+        # Размер неизвестен: ширина полной копии не указывается, в srcset только миниатюры
+        srcset = ', '.join(f"{urls[str(width)]} {width}w" for width in DERIVATIVE_WIDTHS)
+    else:
+        entries = {}
+        for width in DERIVATIVE_WIDTHS:
+            entries.setdefault(min(width, original_width), urls[str(width)])
+        entries[original_width] = urls[FULL_VARIANT]
+        srcset = ', '.join(f"{url} {width}w" for width, url in sorted(entries.items()))
+    return {'derivatives': urls, 'srcset': srcset}
+
+
+def image_width(path):
+    """
+    Ширина изображения в пикселях (читается только заголовок файла) или None.
+    """
+    try:
+        with Image.open(path) as image:
+            return image.width
+    except Exception:
+        return None
+
+
+def backfill(directory=GENERATED_IMAGES_DIR):
+    """
+    Создает производные для всех уже сохраненных изображений, у которых их нет.
+    """
+    originals = sorted(name for name in os.listdir(directory) if is_original(name))
+    processed = 0
+    original_bytes = 0
+    derivative_bytes = {}
+    for name in originals:
+        path = os.path.join(directory, name)
+        try:
+            create_derivatives(path)
+        except Exception as e:
+            print(f"Пропущен {name}: {str(e)}")
+            continue
+        processed += 1
+        original_bytes += os.path.getsize(path)
+        for variant in [FULL_VARIANT] + [str(width) for width in DERIVATIVE_WIDTHS]:
+            derivative = variant_path(path, variant)
+            if os.path.exists(derivative):
+                derivative_bytes[variant] = derivative_bytes.get(variant, 0) + os.path.getsize(derivative)
+
+    print(f"Обработано изображений: {processed} из {len(originals)}")
+    if processed:
+        print(f"Оригиналы: {original_bytes / 1024:.0f} КБ")
+        for variant, size in sorted(derivative_bytes.items()):
+            print(f"Вариант {variant}: {size / 1024:.0f} КБ "
+                  f"(в {original_bytes / max(size, 1):.1f} раз меньше)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Создание WebP-копий и миниатюр для сгенерированных изображений')
+    parser.add_argument('--dir', default=GENERATED_IMAGES_DIR, help='Каталог с изображениями')
+    args = parser.parse_args()
+    backfill(args.dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+import os
+import json
+import uuid
+import sqlite3
+import threading
+import time
+import traceback
+
+from analysis_cache import INSTANCE_DIR
+
+DEFAULT_JOBS_PATH = os.path.join(INSTANCE_DIR, 'jobs.db')
+
+# Задача считается брошенной, если ее аренда не продлевалась дольше этого времени
+# (например, процесс был перезапущен посреди выполнения)
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 90))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+
+
+class JobQueue:
+    """
+    Персистентная очередь задач генерации на основе таблицы SQLite.
+
+    HTTP-обработчики только ставят задачи в очередь, а выполняет их
+    ограниченный пул фоновых потоков. Задачи переживают перезапуск процесса:
+    незавершенные задачи с истекшей арендой возвращаются в очередь, а задачи
+    завершившегося процесса этого хоста — сразу при запуске очереди.
+    """
+
+    def __init__(self, db_path=None, workers=None):
+        self.db_path = db_path or os.environ.get('JOBS_DB_PATH', DEFAULT_JOBS_PATH)
+        self.workers = int(workers if workers is not None
+                           else os.environ.get('GENERATION_JOB_WORKERS', 2))
+        self.worker_id = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+        self._handlers = {}
+        self._active = set()
+        self._active_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS generation_jobs (
+                    id TEXT PRIMARY KEY,
+                    job_type TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    result TEXT,
+                    checkpoint TEXT,
+                    error TEXT,
+                    stage TEXT,
+                    progress INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker_id TEXT,
+                    lease_expires REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_generation_jobs_status "
+                         "ON generation_jobs (status, created_at)")
+            # Базы, созданные до появления сохранения промежуточных результатов
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(generation_jobs)")}
+            if 'checkpoint' not in columns:
+                conn.execute("ALTER TABLE generation_jobs ADD COLUMN checkpoint TEXT")
+        finally:
+            conn.close()
+
+    def register_handler(self, job_type, handler):
+        """
+        Регистрирует обработчик для типа задач.
+
+        Обработчик вызывается как handler(payload, report_progress, checkpoint) и возвращает
+        словарь с результатом. report_progress(stage, progress, checkpoint=None) обновляет статус
+        задачи и, если передан checkpoint, сохраняет промежуточные результаты. При повторном
+        выполнении (после падения процесса) обработчик получает последний сохраненный checkpoint
+        (при первом выполнении — пустой словарь) и может пропустить уже выполненные шаги.
+        """
+        self._handlers[job_type] = handler
+
+    def enqueue(self, job_type, payload):
+        """
+        Ставит задачу в очередь.
+
+        Args:
+            job_type (str): Тип задачи (должен быть зарегистрирован обработчик)
+            payload (dict): Входные данные задачи (сериализуются в JSON)
+
+        Returns:
+            str: Идентификатор задачи
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("""
+                INSERT INTO generation_jobs (id, job_type, status, payload, stage, created_at, updated_at)
+                VALUES (?, ?, 'queued', ?, 'queued', ?, ?)
+            """, (job_id, job_type, json.dumps(payload, ensure_ascii=False), now, now))
+        finally:
+            conn.close()
+        print(f"Задача {job_id} ({job_type}) поставлена в очередь")
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """
+        Возвращает состояние задачи или None, если задача не найдена.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM generation_jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {
+            'job_id': row['id'],
+            'job_type': row['job_type'],
+            'status': row['status'],
+            'stage': row['stage'],
+            'progress': row['progress'],
+            'attempts': row['attempts'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            # Промежуточные результаты незавершенной задачи
+            'partial': json.loads(row['checkpoint']) if row['checkpoint'] and row['status'] != 'completed' else None,
+            'error': row['error'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+
+    def start(self):
+        """
+        Запускает фоновые потоки-исполнители (однократно для процесса).
+        """
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        self._requeue_orphaned()
+        self._requeue_expired()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f'job-worker-{i}', daemon=True).start()
+        threading.Thread(target=self._maintenance_loop, name='job-maintenance', daemon=True).start()
+        print(f"Запущено исполнителей очереди задач: {self.workers}")
+
+    def _claim_next(self):
+        """
+        Атомарно забирает следующую задачу из очереди.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("""
+                SELECT id, job_type, payload, checkpoint FROM generation_jobs
+                WHERE status = 'queued' ORDER BY created_at LIMIT 1
+            """).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute("""
+                UPDATE generation_jobs
+                SET status = 'running', stage = 'started', attempts = attempts + 1,
+                    worker_id = ?, lease_expires = ?, updated_at = ?
+                WHERE id = ?
+            """, (self.worker_id, now + JOB_LEASE_SECONDS, now, row['id']))
+            conn.execute('COMMIT')
+            return (row['id'], row['job_type'], json.loads(row['payload']),
+                    json.loads(row['checkpoint']) if row['checkpoint'] else {})
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _update(self, job_id, running_only=False, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        condition = " AND status = 'running'" if running_only else ''
+        conn = self._connect()
+        try:
+            conn.execute(f"UPDATE generation_jobs SET {columns} WHERE id = ?{condition}",
+                         (*fields.values(), job_id))
+        finally:
+            conn.close()
+
+    def _worker_loop(self):
+        while True:
+            try:
+                claimed = self._claim_next()
+            except Exception as e:
+                print(f"Ошибка при получении задачи из очереди: {str(e)}")
+                claimed = None
+            if claimed is None:
+                self._wakeup.wait(timeout=2)
+                self._wakeup.clear()
+                continue
+            self._run_job(*claimed)
+
+    def _run_job(self, job_id, job_type, payload, checkpoint):
+        handler = self._handlers.get(job_type)
+        if handler is None:
+            self._update(job_id, status='failed', error=f"Нет обработчика для задач типа {job_type}",
+                         lease_expires=None)
+            return
+
+        def report_progress(stage, progress, checkpoint=None):
+            fields = {'stage': stage, 'progress': int(progress), 'lease_expires': time.time() + JOB_LEASE_SECONDS}
+            if checkpoint is not None:
+                fields['checkpoint'] = json.dumps(checkpoint, ensure_ascii=False, default=str)
+            self._update(job_id, running_only=True, **fields)
+
+        with self._active_lock:
+            self._active.add(job_id)
+        print(f"Выполнение задачи {job_id} ({job_type})")
+        try:
+            if checkpoint:
+                print(f"Задача {job_id} продолжается с сохраненного состояния: {', '.join(checkpoint)}")
+            result = handler(payload, report_progress, checkpoint)
+            self._update(job_id, status='completed', stage='done', progress=100,
+                         result=json.dumps(result, ensure_ascii=False), error=None, lease_expires=None)
+            print(f"Задача {job_id} завершена")
+        except Exception as e:
+            print(f"Ошибка при выполнении задачи {job_id}: {str(e)}")
+            traceback.print_exc()
+            self._update(job_id, status='failed', stage='failed', error=str(e), lease_expires=None)
+        finally:
+            with self._active_lock:
+                self._active.discard(job_id)
+
+    def _maintenance_loop(self):
+        while True:
+            time.sleep(max(5, JOB_LEASE_SECONDS // 3))
+            try:
+                self._renew_leases()
+                self._requeue_expired()
+            except Exception as e:
+                print(f"Ошибка обслуживания очереди задач: {str(e)}")
+
+    def _renew_leases(self):
+        with self._active_lock:
+            active = list(self._active)
+        if not active:
+            return
+        conn = self._connect()
+        try:
+            conn.executemany("UPDATE generation_jobs SET lease_expires = ? WHERE id = ? AND status = 'running'",
+                             [(time.time() + JOB_LEASE_SECONDS, job_id) for job_id in active])
+        finally:
+            conn.close()
+
+    def _is_orphaned(self, worker_id):
+        """
+        Проверяет, что исполнитель задачи точно не работает: это процесс с тем же
+        идентификатором, что и только что запущенный (PID переиспользован), или
+        завершившийся процесс на этом же хосте. Задачи других хостов ждут истечения аренды.
+        """
+        if worker_id == self.worker_id:
+            return True
+        host, _, pid = (worker_id or '').rpartition(':')
+        if host != self.worker_id.rpartition(':')[0] or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            # Процесс существует, но принадлежит другому пользователю
+            return False
+        return False
+
+    def _requeue_orphaned(self):
+        """
+        При запуске сразу возвращает в очередь задачи упавших процессов этого хоста,
+        не дожидаясь истечения их аренды (до JOB_LEASE_SECONDS).
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, worker_id FROM generation_jobs WHERE status = 'running'").fetchall()
+            orphaned = [row['id'] for row in rows if self._is_orphaned(row['worker_id'])]
+            now = time.time()
+            conn.executemany("""
+                UPDATE generation_jobs SET lease_expires = ?, updated_at = ?
+                WHERE id = ? AND status = 'running'
+            """, [(now - 1, now, job_id) for job_id in orphaned])
+        finally:
+            conn.close()
+        if orphaned:
+            print(f"Найдено задач завершившихся процессов: {len(orphaned)}")
+
+    def _requeue_expired(self):
+        """
+        Возвращает в очередь задачи, чья аренда истекла (исполнитель завершился,
+        не закончив работу). Задачи, исчерпавшие число попыток, помечаются как failed.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("""
+                UPDATE generation_jobs
+                SET status = 'failed', stage = 'failed', lease_expires = NULL, updated_at = ?,
+                    error = 'Превышено число попыток выполнения задачи'
+                WHERE status = 'running' AND lease_expires < ? AND attempts >= ?
+            """, (now, now, JOB_MAX_ATTEMPTS))
+            resumed = conn.execute("""
+                UPDATE generation_jobs
+                SET status = 'queued', stage = 'resumed', worker_id = NULL, lease_expires = NULL, updated_at = ?
+                WHERE status = 'running' AND lease_expires < ?
+            """, (now, now)).rowcount
+        finally:
+            conn.close()
+        if resumed:
+            print(f"Возобновлено незавершенных задач: {resumed}")
+            self._wakeup.set()
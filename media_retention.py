@@ -0,0 +1,300 @@
+import os
+import re
+import time
+import sqlite3
+import argparse
+import threading
+
+from analysis_cache import INSTANCE_DIR
+from media_storage import GENERATED_IMAGES_DIR, GENERATED_MUSIC_DIR
+from image_derivatives import DERIVATIVE_WIDTHS
+
+DEFAULT_MEDIA_DB_PATH = os.path.join(INSTANCE_DIR, 'media_index.db')
+DEFAULT_FORUM_DB_PATH = os.path.join(INSTANCE_DIR, 'forum.db')
+LITERARY_WORKS_DIR = os.path.join(INSTANCE_DIR, 'generated_literary_works')
+
+# Каталоги со сгенерированными файлами (сканируются без вложенных каталогов)
+MEDIA_ROOTS = (
+    GENERATED_IMAGES_DIR,
+    os.path.join(GENERATED_MUSIC_DIR, 'audio'),
+    os.path.join(GENERATED_MUSIC_DIR, 'covers'),
+    GENERATED_MUSIC_DIR,
+    LITERARY_WORKS_DIR,
+)
+
+MEDIA_MAX_MB = int(os.environ.get('MEDIA_MAX_MB', 2048))
+# 0 — без ограничения по возрасту
+MEDIA_MAX_AGE_DAYS = float(os.environ.get('MEDIA_MAX_AGE_DAYS', 90))
+MEDIA_GC_INTERVAL = float(os.environ.get('MEDIA_GC_INTERVAL', 300))
+# Сколько групп файлов удаляется за один проход
+MEDIA_GC_BATCH = int(os.environ.get('MEDIA_GC_BATCH', 100))
+# Как часто ссылки из сообщений форума перечитываются полностью (изменения и удаления сообщений)
+MEDIA_REFERENCE_REFRESH = float(os.environ.get('MEDIA_REFERENCE_REFRESH', 3600))
+
+# Файлы запасного пула безопасных изображений (asset_pool.py) не удаляются никогда
+PROTECTED_PREFIXES = ('safe_pool_',)
+
+_DERIVATIVE_SUFFIX = re.compile(r'_(?:%s)$' % '|'.join(str(width) for width in DERIVATIVE_WIDTHS))
+_MEDIA_REFERENCE = re.compile(r'generated_(?:images|music/audio|music/covers)/([\w\-]+)|/images/\w+/([\w\-]+)')
+_TASK_REFERENCE = re.compile(r'task_id=([\w\-]+)')
+
+
+def group_stem(filename):
+    """
+    Общее имя группы файлов: оригинал изображения и его WebP-копии (image_x.png, image_x.webp,
+    image_x_256.webp), текст и метаданные литературного произведения удаляются вместе.
+    """
+    stem = filename.split('.', 1)[0]
+    return _DERIVATIVE_SUFFIX.sub('', stem)
+
+
+def referenced_stems(content):
+    """
+    Имена групп файлов, на которые ссылается текст сообщения.
+    Ссылка на аудио задачи защищает и ее обложку.
+    """
+    stems = set()
+    for match in _MEDIA_REFERENCE.finditer(content or ''):
+        stems.add(group_stem(match.group(1) or match.group(2)))
+    for match in _TASK_REFERENCE.finditer(content or ''):
+        stems.add(f"music_{match.group(1)}")
+    for stem in list(stems):
+        if stem.startswith('music_'):
+            stems.add('cover_' + stem[len('music_'):])
+    return stems
+
+
+class MediaRetention:
+    """
+    Ограничение объема и срока хранения сгенерированных файлов.
+
+    Индекс файлов с временем последнего обращения хранится в SQLite (instance/media_index.db).
+    Фоновый проход выполняется небольшими шагами: за раз сканируется один каталог и удаляется
+    не больше MEDIA_GC_BATCH групп файлов, начиная с тех, к которым дольше всего не обращались,
+    пока не выполнены ограничения по объему и возрасту. Файлы, на которые ссылаются сообщения
+    форума, и файлы пула безопасных изображений не удаляются.
+    """
+
+    def __init__(self, db_path=None, roots=MEDIA_ROOTS, max_bytes=None, max_age_days=None, forum_db_path=None):
+        self.db_path = db_path or os.environ.get('MEDIA_INDEX_DB_PATH', DEFAULT_MEDIA_DB_PATH)
+        self.forum_db_path = forum_db_path or os.environ.get('FORUM_DB_PATH', DEFAULT_FORUM_DB_PATH)
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.max_bytes = max_bytes if max_bytes is not None else MEDIA_MAX_MB * 1024 * 1024
+        self.max_age_seconds = (MEDIA_MAX_AGE_DAYS if max_age_days is None else max_age_days) * 24 * 3600
+        self._accessed = {}
+        self._lock = threading.Lock()
+        self._next_root = 0
+        self._references = set()
+        self._last_message_id = 0
+        self._references_loaded_at = 0
+        self._started = False
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS media_files (
+                    path TEXT PRIMARY KEY,
+                    root TEXT NOT NULL,
+                    group_key TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_media_files_group ON media_files (group_key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_media_files_root ON media_files (root)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def record_access(self, path):
+        """
+        Отмечает обращение к файлу. Запись в индекс выполняется фоновым проходом,
+        поэтому вызов в обработчике запроса ничего не пишет на диск.
+        """
+        with self._lock:
+            self._accessed[os.path.normpath(path)] = time.time()
+
+    def _flush_access(self, conn):
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        pending = {}
+        for path, when in accessed.items():
+            cursor = conn.execute("UPDATE media_files SET last_access = MAX(last_access, ?) WHERE path = ?",
+                                  (when, path))
+            # Файл еще не попал в индекс: обращение учитывается после сканирования его каталога
+            if not cursor.rowcount and os.path.dirname(path) in self.roots and os.path.exists(path):
+                pending[path] = when
+        if pending:
+            with self._lock:
+                for path, when in pending.items():
+                    self._accessed[path] = max(when, self._accessed.get(path, 0))
+
+    def _scan_step(self, conn):
+        """
+        Сканирует один каталог (по кругу) и синхронизирует с ним индекс.
+        Новые файлы получают время последнего обращения по времени изменения.
+        """
+        root = self.roots[self._next_root % len(self.roots)]
+        self._next_root += 1
+        found = {}
+        if os.path.isdir(root):
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    # Скрытые и недописанные файлы (.part) принадлежат идущим загрузкам
+                    if entry.name.startswith('.') or entry.name.endswith('.part') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    found[os.path.join(root, entry.name)] = (stat.st_size, stat.st_mtime)
+
+        indexed = {row[0] for row in conn.execute("SELECT path FROM media_files WHERE root = ?", (root,))}
+        conn.executemany("DELETE FROM media_files WHERE path = ?", [(path,) for path in indexed - set(found)])
+        conn.executemany("INSERT OR IGNORE INTO media_files (path, root, group_key, size, last_access) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(path, root, os.path.join(root, group_stem(os.path.basename(path))), size, mtime)
+                          for path, (size, mtime) in found.items() if path not in indexed])
+        conn.executemany("UPDATE media_files SET size = ? WHERE path = ?",
+                         [(size, path) for path, (size, _) in found.items() if path in indexed])
+        return root, len(found)
+
+    def _load_references(self):
+        """
+        Дополняет набор защищенных групп ссылками из новых сообщений форума;
+        раз в MEDIA_REFERENCE_REFRESH секунд набор перечитывается полностью.
+        """
+        if time.time() - self._references_loaded_at > MEDIA_REFERENCE_REFRESH:
+            self._references = set()
+            self._last_message_id = 0
+            self._references_loaded_at = time.time()
+        if not os.path.exists(self.forum_db_path):
+            return
+        conn = sqlite3.connect(f"file:{self.forum_db_path}?mode=ro", uri=True, timeout=30)
+        try:
+            rows = conn.execute("SELECT id, content FROM message WHERE id > ? ORDER BY id",
+                                (self._last_message_id,)).fetchall()
+        finally:
+            conn.close()
+        for message_id, content in rows:
+            self._references |= referenced_stems(content)
+            self._last_message_id = message_id
+
+    def is_protected(self, group_key):
+        stem = os.path.basename(group_key)
+        return stem.startswith(PROTECTED_PREFIXES) or stem in self._references
+
+    def _evict(self, conn):
+        groups = conn.execute("SELECT group_key, MAX(last_access), SUM(size) FROM media_files "
+                              "GROUP BY group_key ORDER BY MAX(last_access)").fetchall()
+        total = sum(size for _, _, size in groups)
+        cutoff = time.time() - self.max_age_seconds if self.max_age_seconds > 0 else None
+        removed_groups = 0
+        removed_bytes = 0
+        for group_key, last_access, size in groups:
+            if removed_groups >= MEDIA_GC_BATCH:
+                break
+            # Группы отсортированы по времени обращения: дальше только более свежие
+            if total <= self.max_bytes and (cutoff is None or last_access >= cutoff):
+                break
+            if self.is_protected(group_key):
+                continue
+            for (path,) in conn.execute("SELECT path FROM media_files WHERE group_key = ?", (group_key,)).fetchall():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Не удалось удалить {path}: {str(e)}")
+                    continue
+                conn.execute("DELETE FROM media_files WHERE path = ?", (path,))
+            total -= size
+            removed_groups += 1
+            removed_bytes += size
+        return removed_groups, removed_bytes
+
+    def collect(self):
+        """
+        Один шаг сборки мусора: сканирование одного каталога, запись обращений, удаление.
+
+        Returns:
+            dict: Статистика шага
+        """
+        conn = self._connect()
+        try:
+            root, scanned = self._scan_step(conn)
+            self._flush_access(conn)
+            conn.commit()
+            try:
+                self._load_references()
+            except Exception as e:
+                # Без списка ссылок из форума удалять файлы небезопасно
+                print(f"Не удалось прочитать ссылки из сообщений форума, удаление пропущено: {str(e)}")
+                return {'root': root, 'scanned': scanned, 'removed_groups': 0, 'removed_bytes': 0}
+            removed_groups, removed_bytes = self._evict(conn)
+            conn.commit()
+        finally:
+            conn.close()
+        if removed_groups:
+            print(f"Удалено сгенерированных файлов: {removed_groups} групп, {removed_bytes / 1024 / 1024:.1f} МБ")
+        return {'root': root, 'scanned': scanned, 'removed_groups': removed_groups, 'removed_bytes': removed_bytes}
+
+    def stats(self):
+        """
+        Объем и количество файлов в индексе по каталогам.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT root, COUNT(*), COALESCE(SUM(size), 0), MIN(last_access) "
+                                "FROM media_files GROUP BY root").fetchall()
+        finally:
+            conn.close()
+        return {root: {'files': count, 'bytes': size, 'oldest_access': oldest} for root, count, size, oldest in rows}
+
+    def start(self, interval=MEDIA_GC_INTERVAL):
+        """
+        Запускает фоновый поток, выполняющий collect раз в interval секунд.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, args=(interval,), name='media-retention', daemon=True).start()
+        print("Фоновая очистка сгенерированных файлов запущена")
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                print(f"Ошибка при очистке сгенерированных файлов: {str(e)}")
+            time.sleep(interval)
+
+
+# Общий экземпляр; запускается в start_background_services приложения
+media_retention = MediaRetention()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ограничение объема и срока хранения сгенерированных файлов')
+    parser.add_argument('command', choices=['status', 'gc'],
+                        help='status — объем по каталогам; gc — полный проход по всем каталогам')
+    args = parser.parse_args()
+    if args.command == 'gc':
+        for _ in media_retention.roots:
+            result = media_retention.collect()
+            print(f"{result['root']}: файлов {result['scanned']}, удалено групп {result['removed_groups']}")
+        # Дальше только удаление, пока ограничения не выполнены
+        while media_retention.collect()['removed_groups']:
+            pass
+    for root, info in sorted(media_retention.stats().items()):
+        print(f"{root}: {info['files']} файлов, {info['bytes'] / 1024 / 1024:.1f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import base64
+import hashlib
+import tempfile
+
+# Каталоги для сгенерированных файлов (пути относительно корня приложения, как и раньше)
+GENERATED_IMAGES_DIR = os.path.join('static', 'generated_images')
+GENERATED_MUSIC_DIR = os.path.join('static', 'generated_music')
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = int(os.environ.get('MEDIA_DOWNLOAD_TIMEOUT', 60))
+
+
+def store_stream(chunks, directory, prefix, extension):
+    """
+    Записывает поток байтов во временный файл и атомарно переименовывает его
+    в файл с именем по SHA-256 содержимого. Одинаковые файлы хранятся один раз,
+    а параллельные запросы не перезаписывают чужие файлы.
+
+    Args:
+        chunks (iterable): Последовательность блоков bytes
+        directory (str): Каталог для сохранения
+        prefix (str): Префикс имени файла (например, 'image')
+        extension (str): Расширение с точкой (например, '.png')
+
+    Returns:
+        str or None: Путь к сохраненному файлу или None, если данных нет
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    # Временный файл создается в том же каталоге, чтобы os.replace был атомарным
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{prefix}_', suffix='.part', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                temp_file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        if size == 0:
+            os.remove(temp_path)
+            return None
+
+        path = os.path.join(directory, f"{prefix}_{digest.hexdigest()[:32]}{extension}")
+        if os.path.exists(path):
+            # Такой файл уже есть: сохраняем одну копию
+            os.remove(temp_path)
+        else:
+            # mkstemp создает файл с правами 0600, а статические файлы должны быть доступны для чтения
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        return path
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def iter_base64_chunks(data, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Декодирует base64-строку блоками примерно по chunk_size байт,
+    не создавая полную декодированную копию в памяти.
+
+    Args:
+        data (str): Данные в base64 (без переводов строк)
+        chunk_size (int): Размер декодированного блока в байтах
+
+    Yields:
+        bytes: Декодированные блоки
+    """
+    # Длина фрагмента кратна 4 символам, поэтому каждый фрагмент декодируется независимо
+    step = max(1, chunk_size // 3) * 4
+    for start in range(0, len(data), step):
+        yield base64.b64decode(data[start:start + step])
+
+
+def download_to_storage(session, url, directory, prefix, extension, timeout=None):
+    """
+    Скачивает файл потоково (память не зависит от размера файла) через
+    переданную сессию с пулом соединений и сохраняет его через store_stream.
+
+    Args:
+        session (requests.Session): Сессия для HTTP-запросов
+        url (str): Адрес файла
+        directory (str): Каталог для сохранения
+        prefix (str): Префикс имени файла
+        extension (str): Расширение с точкой
+        timeout (int, optional): Таймаут соединения и чтения в секундах
+
+    Returns:
+        str or None: Путь к сохраненному файлу или None, если получены пустые данные
+    """
+    with session.get(url, stream=True, timeout=timeout or DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        return store_stream(response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+                            directory, prefix, extension)
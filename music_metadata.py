@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+
+from analysis_cache import INSTANCE_DIR
+from media_storage import GENERATED_MUSIC_DIR
+
+DEFAULT_MUSIC_DB_PATH = os.path.join(INSTANCE_DIR, 'music_tasks.db')
+
+# Статусы, при которых задача генерации музыки еще не завершена
+PENDING_STATUSES = ('processing', 'text', 'first')
+
+LEGACY_PREFIX = 'music_metadata_'
+LEGACY_SUFFIX = '.json'
+# Перенесенные файлы убираются из публично доступного static/ в instance/
+LEGACY_ARCHIVE_DIR = os.path.join(INSTANCE_DIR, 'legacy_music_metadata')
+
+
+class MusicMetadataStore:
+    """
+    Хранилище метаданных задач генерации музыки в таблице SQLite (instance/music_tasks.db).
+
+    Каждая задача — одна строка: статус в отдельной индексированной колонке,
+    остальные метаданные — компактный JSON. Чтение статуса — один запрос по ключу,
+    незавершенные задачи выбираются по индексу статуса. Изменение статуса через
+    compare_and_set выполняется одной транзакцией и только из ожидаемого состояния,
+    поэтому коллбэк, фоновый опрос и проверка таймаута не перезаписывают друг друга.
+    """
+
+    def __init__(self, db_path=None, legacy_directory=None, legacy_archive_directory=None):
+        self.db_path = db_path or os.environ.get('MUSIC_DB_PATH', DEFAULT_MUSIC_DB_PATH)
+        self.legacy_directory = legacy_directory or GENERATED_MUSIC_DIR
+        self.legacy_archive_directory = legacy_archive_directory or LEGACY_ARCHIVE_DIR
+        # task_id -> [RLock, число потоков, которые держат или ждут блокировку]
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS music_tasks (
+                    task_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_music_tasks_status "
+                         "ON music_tasks (status, updated_at)")
+            # Служебные отметки хранилища (например, завершение переноса старых JSON-файлов)
+            conn.execute("CREATE TABLE IF NOT EXISTS music_store_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        finally:
+            conn.close()
+
+    @contextmanager
+    def lock(self, task_id):
+        """
+        Блокировка задачи внутри процесса для длинной последовательности чтение-изменение-запись
+        (обработка коллбэка). Отдельные изменения атомарны и без нее.
+        Блокировка удаляется из словаря, когда ее больше никто не держит и не ждет.
+        """
+        with self._locks_lock:
+            entry = self._locks.setdefault(task_id, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[task_id]
+
+    def load(self, task_id):
+        """
+        Возвращает метаданные задачи или None, если задачи нет.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data FROM music_tasks WHERE task_id = ?", (task_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0])
+        except Exception as e:
+            print(f"Ошибка при чтении метаданных задачи {task_id}: {str(e)}")
+            return None
+
+    def status(self, task_id):
+        """
+        Возвращает только статус задачи (None, если задачи нет).
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT status FROM music_tasks WHERE task_id = ?", (task_id,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    @staticmethod
+    def _row(task_id, metadata):
+        metadata['task_id'] = metadata.get('task_id') or task_id
+        now = time.time()
+        return (task_id, metadata.get('status') or 'unknown',
+                json.dumps(metadata, ensure_ascii=False, separators=(',', ':')), now, now)
+
+    def save(self, task_id, metadata):
+        """
+        Сохраняет метаданные задачи целиком (создает задачу, если ее нет).
+        """
+        row = self._row(task_id, metadata)
+        conn = self._connect()
+        try:
+            conn.execute("""
+                INSERT INTO music_tasks (task_id, status, data, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(task_id) DO UPDATE SET
+                    status = excluded.status, data = excluded.data, updated_at = excluded.updated_at
+            """, row)
+        finally:
+            conn.close()
+
+    def _modify(self, task_id, changes, expected_statuses=None):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT status, data FROM music_tasks WHERE task_id = ?",
+                                   (task_id,)).fetchone()
+                if expected_statuses is not None and (row is None or row[0] not in expected_statuses):
+                    conn.execute('ROLLBACK')
+                    return None
+                metadata = json.loads(row[1]) if row else {'task_id': task_id}
+                if callable(changes):
+                    changes(metadata)
+                else:
+                    metadata.update(changes)
+                values = self._row(task_id, metadata)
+                if row is None:
+                    conn.execute("INSERT INTO music_tasks (task_id, status, data, created_at, updated_at) "
+                                 "VALUES (?, ?, ?, ?, ?)", values)
+                else:
+                    conn.execute("UPDATE music_tasks SET status = ?, data = ?, updated_at = ? WHERE task_id = ?",
+                                 (values[1], values[2], values[4], task_id))
+                conn.execute('COMMIT')
+                return metadata
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+    def update(self, task_id, changes):
+        """
+        Атомарно дополняет метаданные задачи полями из changes (задача создается, если ее нет).
+        changes может быть функцией, изменяющей словарь метаданных на месте
+        (для вложенных полей, например списка треков).
+
+        Returns:
+            dict: Обновленные метаданные
+        """
+        return self._modify(task_id, changes)
+
+    def compare_and_set(self, task_id, expected_statuses, changes):
+        """
+        Атомарно применяет changes, только если текущий статус задачи входит в expected_statuses.
+
+        Args:
+            task_id (str): Идентификатор задачи
+            expected_statuses (iterable): Статусы, из которых допустим переход
+            changes (dict): Новые значения полей (обычно включают 'status')
+
+        Returns:
+            dict or None: Обновленные метаданные или None, если статус уже изменился
+        """
+        return self._modify(task_id, changes, tuple(expected_statuses))
+
+    def pending_task_ids(self):
+        """
+        Возвращает идентификаторы незавершенных задач (по индексу статуса).
+        """
+        placeholders = ', '.join('?' for _ in PENDING_STATUSES)
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT task_id FROM music_tasks WHERE status IN ({placeholders}) "
+                                f"ORDER BY updated_at", PENDING_STATUSES).fetchall()
+        finally:
+            conn.close()
+        return [row[0] for row in rows]
+
+    def import_legacy_files(self, directory=None, delete=False, archive_directory=None):
+        """
+        Однократно переносит старые файлы music_metadata_<task_id>.json в таблицу.
+        Уже существующие в таблице задачи не перезаписываются.
+
+        Args:
+            directory (str, optional): Каталог с файлами (по умолчанию static/generated_music)
+            delete (bool): Удалять перенесенные файлы из публично доступного каталога
+            archive_directory (str, optional): Перемещать перенесенные (и нечитаемые) файлы в этот каталог
+
+        Returns:
+            int: Количество перенесенных задач
+        """
+        directory = directory or self.legacy_directory
+        imported = 0
+        conn = self._connect()
+        try:
+            for filename in self._legacy_files(directory):
+                task_id = filename[len(LEGACY_PREFIX):-len(LEGACY_SUFFIX)]
+                path = os.path.join(directory, filename)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        metadata = json.load(f)
+                except Exception as e:
+                    print(f"Пропущен {filename}: {str(e)}")
+                    metadata = None
+                if metadata is not None:
+                    row = list(self._row(task_id, metadata))
+                    row[3] = row[4] = os.path.getmtime(path)
+                    cursor = conn.execute("INSERT OR IGNORE INTO music_tasks (task_id, status, data, created_at, updated_at) "
+                                          "VALUES (?, ?, ?, ?, ?)", row)
+                    imported += cursor.rowcount
+                if archive_directory:
+                    # Нечитаемый файл тоже убираем из static/: он может содержать данные задачи
+                    os.makedirs(archive_directory, exist_ok=True)
+                    os.replace(path, os.path.join(archive_directory, filename))
+                elif delete and metadata is not None:
+                    os.remove(path)
+        finally:
+            conn.close()
+        return imported
+
+    @staticmethod
+    def _legacy_files(directory):
+        if not os.path.isdir(directory):
+            return []
+        return sorted(filename for filename in os.listdir(directory)
+                      if filename.startswith(LEGACY_PREFIX) and filename.endswith(LEGACY_SUFFIX))
+
+    def import_legacy_files_once(self):
+        """
+        Переносит старые файлы при первом запуске и перемещает их из публично доступного
+        static/generated_music в instance/legacy_music_metadata. Отметка в таблице
+        music_store_meta ставится, только когда в каталоге не осталось старых файлов;
+        после этого каталог больше не читается.
+
+        Returns:
+            int: Количество перенесенных задач (0, если перенос уже выполнен)
+        """
+        conn = self._connect()
+        try:
+            done = conn.execute("SELECT value FROM music_store_meta WHERE key = 'legacy_import_done'").fetchone()
+        finally:
+            conn.close()
+        if done:
+            return 0
+        try:
+            imported = self.import_legacy_files(archive_directory=self.legacy_archive_directory)
+        except OSError as e:
+            print(f"Перенос старых файлов метаданных не завершен: {str(e)}")
+            return 0
+        if self._legacy_files(self.legacy_directory):
+            print("В каталоге остались старые файлы метаданных, перенос будет повторен при следующем запуске")
+            return imported
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO music_store_meta (key, value) VALUES ('legacy_import_done', ?)",
+                         (str(time.time()),))
+        finally:
+            conn.close()
+        return imported
+
+
+# Общий экземпляр для приложения и анализатора
+metadata_store = MusicMetadataStore()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Хранилище метаданных задач генерации музыки')
+    parser.add_argument('command', choices=['import', 'pending'],
+                        help='import — перенести старые JSON-файлы в SQLite; pending — незавершенные задачи')
+    parser.add_argument('--dir', default=GENERATED_MUSIC_DIR, help='Каталог со старыми файлами метаданных')
+    parser.add_argument('--delete', action='store_true', help='Удалить перенесенные файлы')
+    args = parser.parse_args()
+    if args.command == 'import':
+        print(f"Перенесено задач: {metadata_store.import_legacy_files(args.dir, delete=args.delete)}")
+    else:
+        for task_id in metadata_store.pending_task_ids():
+            print(task_id)
+
+
+if __name__ == "__main__":
+    main()
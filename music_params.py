@@ -0,0 +1,128 @@
+from emotion_lexicon import canonical_emotion
+
+# Параметры по умолчанию, если эмоции не определены или не распознаны
+DEFAULT_MUSIC_PARAMS = ("Orchestral", "dramatic", "moderate", "orchestra and piano")
+DEFAULT_STYLE = "Dramatic Film Score"
+DEFAULT_MOOD = "dramatic"
+DEFAULT_INSTRUMENTS = "full orchestra with piano accents"
+
+# Музыкальные параметры для канонических эмоций (идентификаторы из emotion_lexicon).
+# tempo применяется, если средняя интенсивность всех эмоций выше tempo_min_intensity
+# (None — без порога), иначе темп определяется по средней интенсивности. priority разрешает равенство весов:
+# чем меньше число, тем важнее эмоция (так же, как в прежних цепочках проверок).
+# Чтобы добавить эмоцию, достаточно добавить строку в эту таблицу и слова в emotion_lexicon.
+MUSIC_TABLE = {
+    'fear': {
+        'priority': 0,
+        'style': "Cinematic Suspense",
+        'mood': "tense",
+        'tempo': "fast-paced and intense",
+        'tempo_min_intensity': 7,
+        'instruments': "low strings and percussion",
+    },
+    'sadness': {
+        'priority': 1,
+        'style': "Neoclassical Piano",
+        'mood': "melancholic",
+        'tempo': "slow and contemplative",
+        'tempo_min_intensity': None,
+        'instruments': "cello and piano",
+    },
+    'despair': {
+        'priority': 2,
+        'style': "Neoclassical Piano",
+        'mood': "melancholic",
+        'tempo': "slow and contemplative",
+        'tempo_min_intensity': None,
+        'instruments': "cello and piano",
+    },
+    'hope': {
+        'priority': 3,
+        'style': "Uplifting Orchestral",
+        'mood': "hopeful",
+        'tempo': None,
+        'tempo_min_intensity': None,
+        'instruments': "strings and woodwinds",
+    },
+    'joy': {
+        'priority': 4,
+        'style': "Uplifting Orchestral",
+        'mood': "hopeful",
+        'tempo': None,
+        'tempo_min_intensity': None,
+        'instruments': "strings and woodwinds",
+    },
+    'pride': {
+        'priority': 5,
+        'style': "Epic Orchestral",
+        'mood': "heroic",
+        'tempo': "steady and powerful",
+        'tempo_min_intensity': None,
+        'instruments': "brass and timpani",
+    },
+    'determination': {
+        'priority': 6,
+        'style': "Dramatic Orchestral",
+        'mood': DEFAULT_MOOD,
+        'tempo': None,
+        'tempo_min_intensity': None,
+        'instruments': "brass and strings",
+    },
+}
+
+
+def _intensity(value):
+    return float(value) if isinstance(value, (int, float)) else 5.0
+
+
+def determine_music_params(emotion_analysis):
+    """
+    Определяет музыкальные параметры за один проход по эмоциям.
+
+    Вес каждой канонической эмоции — сумма интенсивностей ее упоминаний;
+    стиль, настроение, инструменты и темп берутся из строки таблицы для
+    эмоции с наибольшим весом.
+
+    Args:
+        emotion_analysis (dict): Результат анализа эмоций
+
+    Returns:
+        tuple: (стиль, настроение, темп, инструменты)
+    """
+    if not isinstance(emotion_analysis, dict):
+        return DEFAULT_MUSIC_PARAMS
+    primary_emotions = emotion_analysis.get('primary_emotions')
+    if not isinstance(primary_emotions, list) or not primary_emotions:
+        return DEFAULT_MUSIC_PARAMS
+
+    weights = {}
+    intensities = []
+    named = 0
+    for item in primary_emotions:
+        if not isinstance(item, dict) or 'emotion' not in item:
+            continue
+        named += 1
+        intensity = _intensity(item.get('intensity'))
+        if isinstance(item.get('intensity'), (int, float)):
+            intensities.append(intensity)
+        emotion_id = canonical_emotion(item['emotion'])
+        if emotion_id in MUSIC_TABLE:
+            weights[emotion_id] = weights.get(emotion_id, 0.0) + intensity
+
+    if not named:
+        return DEFAULT_MUSIC_PARAMS
+
+    avg_intensity = sum(intensities) / len(intensities) if intensities else 5
+    default_tempo = "dynamic with building tension" if avg_intensity > 7 else "moderate with emotional depth"
+
+    if not weights:
+        return DEFAULT_STYLE, DEFAULT_MOOD, default_tempo, DEFAULT_INSTRUMENTS
+
+    dominant = max(weights, key=lambda emotion_id: (weights[emotion_id], -MUSIC_TABLE[emotion_id]['priority']))
+    row = MUSIC_TABLE[dominant]
+    threshold = row['tempo_min_intensity']
+    if row['tempo'] and (threshold is None or avg_intensity > threshold):
+        tempo = row['tempo']
+    else:
+        tempo = default_tempo
+    return row['style'], row['mood'], tempo, row['instruments']
@@ -0,0 +1,183 @@
+import os
+import heapq
+import random
+import threading
+import time
+from datetime import datetime
+
+from music_metadata import metadata_store, PENDING_STATUSES
+from notifications import music_events
+
+# Первая проверка не раньше чем через 10 секунд: раньше Suno обычно не знает о задаче
+MUSIC_POLL_INITIAL_DELAY = float(os.environ.get('MUSIC_POLL_INITIAL_DELAY', 10))
+MUSIC_POLL_MAX_DELAY = float(os.environ.get('MUSIC_POLL_MAX_DELAY', 60))
+# Задача считается неудачной после стольких ошибок API подряд
+MUSIC_POLL_MAX_ERRORS = int(os.environ.get('MUSIC_POLL_MAX_ERRORS', 5))
+# Максимальное время ожидания результата (как и прежде, 15 минут)
+MUSIC_MAX_WAIT_SECONDS = 15 * 60
+
+
+def backoff_delay(attempt):
+    """
+    Экспоненциальная задержка перед следующей проверкой со случайным разбросом ±20%,
+    чтобы проверки разных задач не совпадали по времени.
+    """
+    delay = min(MUSIC_POLL_MAX_DELAY, MUSIC_POLL_INITIAL_DELAY * (2 ** attempt))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class MusicStatusPoller:
+    """
+    Единственный фоновый поток, опрашивающий Suno о незавершенных задачах генерации музыки.
+
+    Задачи хранятся в куче по времени следующей проверки; интервал растет экспоненциально.
+    Результаты записываются в хранилище метаданных, поэтому /check_music_status только
+    читает метаданные и не блокирует поток запроса. Опрос задачи прекращается, как только
+    она завершена (в том числе коллбэком), завершилась ошибкой или превышено время ожидания.
+    """
+
+    def __init__(self, store=None, check=None):
+        """
+        Args:
+            store (MusicMetadataStore, optional): Хранилище метаданных
+            check (callable, optional): Функция check(task_id) -> dict в формате
+                WarDiaryAnalyzer._check_music_status_via_api (по умолчанию — общий анализатор)
+        """
+        self.store = store or metadata_store
+        self._check = check
+        self._heap = []
+        self._tracked = {}
+        self._condition = threading.Condition()
+        self._started = False
+
+    def _check_status(self, task_id):
+        if self._check is None:
+            from war_diary_analyzer import get_analyzer
+            self._check = get_analyzer()._check_music_status_via_api
+        return self._check(task_id)
+
+    def track(self, task_id, delay=None):
+        """
+        Добавляет задачу в опрос (повторные вызовы для отслеживаемой задачи игнорируются).
+        """
+        if not task_id:
+            return
+        with self._condition:
+            if task_id in self._tracked:
+                return
+            self._tracked[task_id] = {'attempt': 0, 'errors': 0}
+            heapq.heappush(self._heap, (time.time() + (MUSIC_POLL_INITIAL_DELAY if delay is None else delay), task_id))
+            self._condition.notify()
+
+    def is_tracked(self, task_id):
+        with self._condition:
+            return task_id in self._tracked
+
+    def start(self):
+        """
+        Запускает поток опроса и возобновляет опрос незавершенных задач из метаданных.
+        """
+        with self._condition:
+            if self._started:
+                return
+            self._started = True
+        for task_id in self.store.pending_task_ids():
+            self.track(task_id, delay=random.uniform(0, MUSIC_POLL_INITIAL_DELAY))
+        threading.Thread(target=self._run, name='music-status-poller', daemon=True).start()
+        print("Фоновый опрос статуса музыки запущен")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(timeout)
+                _, task_id = heapq.heappop(self._heap)
+            try:
+                finished = self._poll(task_id)
+            except Exception as e:
+                print(f"Ошибка при опросе статуса задачи {task_id}: {str(e)}")
+                finished = False
+            with self._condition:
+                state = self._tracked.get(task_id)
+                if state is None:
+                    continue
+                if finished:
+                    del self._tracked[task_id]
+                else:
+                    state['attempt'] += 1
+                    heapq.heappush(self._heap, (time.time() + backoff_delay(state['attempt']), task_id))
+
+    def _poll(self, task_id):
+        """
+        Выполняет одну проверку задачи и записывает результат в метаданные.
+
+        Returns:
+            bool: True, если опрос задачи можно прекратить
+        """
+        metadata = self.store.load(task_id)
+        if metadata is None:
+            print(f"Метаданные задачи {task_id} не найдены, опрос прекращен")
+            return True
+        if not self._is_pending(metadata):
+            return True
+
+        created_at = datetime.fromisoformat(metadata.get('created_at', datetime.now().isoformat()))
+        if (datetime.now() - created_at).total_seconds() > MUSIC_MAX_WAIT_SECONDS:
+            print(f"Превышено время ожидания для задачи {task_id}")
+            self._apply(task_id, {'status': 'timeout'})
+            return True
+
+        api_status = self._check_status(task_id) or {}
+        now = datetime.now().isoformat()
+
+        if api_status.get('success') and api_status.get('is_complete') and api_status.get('audio_url'):
+            print(f"Задача {task_id} завершена по данным API")
+            self._apply(task_id, {
+                'status': 'complete',
+                'audio_url': api_status.get('audio_url', ''),
+                'stream_url': api_status.get('stream_url', ''),
+                'api_status': api_status.get('api_status', ''),
+                'api_data': api_status.get('data', {}),
+                'last_update': now
+            })
+            return True
+
+        with self._condition:
+            state = self._tracked.get(task_id, {'errors': 0})
+            if api_status.get('success'):
+                state['errors'] = 0
+            else:
+                state['errors'] += 1
+            errors = state['errors']
+
+        if errors >= MUSIC_POLL_MAX_ERRORS:
+            print(f"API вернул ошибку для задачи {task_id} {errors} раз подряд, задача отмечена как неудачная")
+            self._apply(task_id, {
+                'status': 'error',
+                'api_status': 'error',
+                'error_message': api_status.get('error', "Ошибка API Suno при генерации музыки"),
+                'api_data': api_status.get('data', {}),
+                'last_update': now
+            })
+            return True
+
+        self.store.compare_and_set(task_id, PENDING_STATUSES,
+                                   {'api_status': api_status.get('api_status', 'unknown'), 'last_poll': now})
+        return False
+
+    def _is_pending(self, metadata):
+        if metadata.get('status') not in PENDING_STATUSES:
+            return False
+        return not (metadata.get('audio_url') or metadata.get('stream_url') or metadata.get('local_audio_path'))
+
+    def _apply(self, task_id, changes):
+        # Коллбэк мог успеть завершить задачу между проверкой и записью: статус меняется
+        # только из незавершенного состояния
+        metadata = self.store.compare_and_set(task_id, PENDING_STATUSES, changes)
+        if metadata is not None:
+            music_events.publish(task_id, {'status': metadata.get('status')})
+
+
+# Общий экземпляр; запускается в start_background_services приложения
+music_poller = MusicStatusPoller()
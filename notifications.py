@@ -0,0 +1,89 @@
+import threading
+import time
+
+# Сколько хранится последнее событие ключа, если его никто не ждет
+NOTIFICATION_TTL_SECONDS = 3600
+
+
+class NotificationRegistry:
+    """
+    Реестр уведомлений внутри процесса, сгруппированных по ключу (например, task_id).
+
+    Публикующая сторона (коллбэк, фоновый опрос) вызывает publish, а обработчики
+    долгих запросов и SSE ждут в wait без периодических проверок: поток просыпается
+    только при новом событии своего ключа или по таймауту.
+    """
+
+    def __init__(self, ttl_seconds=NOTIFICATION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = {'version': 0, 'payload': None, 'updated': time.time(),
+                     'waiters': 0, 'condition': threading.Condition(self._lock)}
+            self._entries[key] = entry
+        return entry
+
+    def _prune(self, now):
+        stale = [key for key, entry in self._entries.items()
+                 if not entry['waiters'] and now - entry['updated'] > self.ttl_seconds]
+        for key in stale:
+            del self._entries[key]
+
+    def publish(self, key, payload=None):
+        """
+        Публикует событие для ключа и будит всех, кто его ждет.
+
+        Returns:
+            int: Номер версии события
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entry(key)
+            entry['version'] += 1
+            entry['payload'] = payload
+            entry['updated'] = now
+            entry['condition'].notify_all()
+            self._prune(now)
+            return entry['version']
+
+    def version(self, key):
+        """
+        Текущая версия ключа (0, если событий еще не было).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['version'] if entry else 0
+
+    def wait(self, key, since_version, timeout):
+        """
+        Ждет событие с версией больше since_version.
+
+        Args:
+            key (str): Ключ события
+            since_version (int): Последняя известная ожидающему версия
+            timeout (float): Максимальное время ожидания в секундах
+
+        Returns:
+            tuple or None: (версия, данные события) или None, если событий не было
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            entry = self._entry(key)
+            entry['waiters'] += 1
+            try:
+                while entry['version'] <= since_version:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    entry['condition'].wait(remaining)
+                return entry['version'], entry['payload']
+            finally:
+                entry['waiters'] -= 1
+
+
+# События готовности музыки по task_id: публикуются при изменении статуса задачи
+music_events = NotificationRegistry()
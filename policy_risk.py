@@ -0,0 +1,347 @@
+import os
+import time
+import zlib
+import sqlite3
+import argparse
+import threading
+
+import numpy as np
+
+from analysis_cache import INSTANCE_DIR
+from emotion_lexicon import tokenize, stem
+from content_screening import content_screener
+
+DEFAULT_OUTCOMES_PATH = os.path.join(INSTANCE_DIR, 'policy_risk.db')
+DEFAULT_MODEL_PATH = os.path.join(INSTANCE_DIR, 'policy_risk_model.npz')
+
+# Размер пространства признаков (хеширование основ и биграмм основ)
+N_FEATURES = 2 ** 16
+FEATURE_VERSION = 1
+
+# Запрос с вероятностью отклонения не ниже порога сразу направляется на безопасный путь
+POLICY_RISK_THRESHOLD = float(os.environ.get('POLICY_RISK_THRESHOLD', 0.8))
+POLICY_RISK_LOGGING = os.environ.get('POLICY_RISK_LOGGING', '1').lower() not in ('0', 'false', 'no')
+POLICY_RISK_ROUTING = os.environ.get('POLICY_RISK_ROUTING', '1').lower() not in ('0', 'false', 'no')
+
+# Исходы хранят полный текст промптов (фрагменты дневников), поэтому хранятся ограниченно:
+# не больше POLICY_RISK_MAX_ROWS последних записей и не дольше POLICY_RISK_MAX_AGE_DAYS дней
+POLICY_RISK_MAX_ROWS = int(os.environ.get('POLICY_RISK_MAX_ROWS', 20000))
+POLICY_RISK_MAX_AGE_DAYS = float(os.environ.get('POLICY_RISK_MAX_AGE_DAYS', 90))
+
+# Минимальное количество исходов каждого класса для обучения
+MIN_SAMPLES_PER_CLASS = 10
+
+
+def _hash(feature):
+    return zlib.crc32(feature.encode('utf-8')) % N_FEATURES
+
+
+def extract_features(text, enhanced_prompt=None):
+    """
+    Превращает промпт и обогащенный промпт в набор индексов признаков.
+
+    Признаки: основы слов и биграммы основ (отдельно для исходного и обогащенного
+    промпта) и найденные ключевые слова из списков content_screening.
+
+    Args:
+        text (str): Промпт, переданный в generate_image (содержит текст дневника)
+        enhanced_prompt (str, optional): Обогащенный промпт, отправляемый в DALL-E
+
+    Returns:
+        numpy.ndarray: Отсортированные уникальные индексы признаков
+    """
+    features = set()
+    for namespace, source in (('t', text), ('e', enhanced_prompt)):
+        if not source:
+            continue
+        stems = [stem(token) for token in tokenize(source)]
+        features.update(f"{namespace}:{item}" for item in stems)
+        features.update(f"{namespace}2:{left} {right}" for left, right in zip(stems, stems[1:]))
+        for hit in content_screener.scan(source):
+            features.add(f"{namespace}w:{hit['term']}")
+            features.update(f"{namespace}c:{category}" for category in hit['categories'])
+    return np.array(sorted({_hash(feature) for feature in features}), dtype=np.int64)
+
+
+def _design(feature_rows):
+    """
+    Разреженное представление выборки: пары (строка, признак) для двоичных признаков.
+    """
+    rows = np.concatenate([np.full(len(columns), i, dtype=np.int64)
+                           for i, columns in enumerate(feature_rows)] or [np.zeros(0, dtype=np.int64)])
+    columns = np.concatenate(list(feature_rows) or [np.zeros(0, dtype=np.int64)])
+    return rows, columns
+
+
+def _scores(weights, bias, rows, columns, n_samples):
+    return np.bincount(rows, weights=weights[columns], minlength=n_samples) + bias
+
+
+def _sigmoid(values):
+    return 1.0 / (1.0 + np.exp(-np.clip(values, -30, 30)))
+
+
+def fit_logistic(feature_rows, labels, iterations=300, learning_rate=0.5, l2=1e-4):
+    """
+    Обучает логистическую регрессию градиентным спуском (numpy, разреженные двоичные признаки).
+    Классы взвешиваются обратно их частоте, так как отклонений обычно намного меньше.
+
+    Args:
+        feature_rows (list): Индексы признаков для каждого примера (результат extract_features)
+        labels (numpy.ndarray): 1 — запрос отклонен политикой, 0 — изображение создано
+
+    Returns:
+        tuple: (веса признаков, смещение)
+    """
+    labels = np.asarray(labels, dtype=np.float64)
+    n_samples = len(labels)
+    rows, columns = _design(feature_rows)
+    positives = max(labels.sum(), 1.0)
+    negatives = max(n_samples - labels.sum(), 1.0)
+    sample_weights = np.where(labels > 0, n_samples / (2 * positives), n_samples / (2 * negatives))
+
+    weights = np.zeros(N_FEATURES, dtype=np.float64)
+    bias = 0.0
+    for _ in range(iterations):
+        errors = (_sigmoid(_scores(weights, bias, rows, columns, n_samples)) - labels) * sample_weights
+        gradient = np.bincount(columns, weights=errors[rows], minlength=N_FEATURES) / n_samples
+        weights -= learning_rate * (gradient + l2 * weights)
+        bias -= learning_rate * errors.mean()
+    return weights, bias
+
+
+class PolicyRiskModel:
+    """
+    Локальная оценка вероятности того, что DALL-E отклонит запрос по политике содержания.
+
+    Исходы реальных запросов к DALL-E (отклонен или нет, сколько длился вызов)
+    записываются в SQLite, модель обучается командой `python policy_risk.py train`
+    и сохраняется в instance/policy_risk_model.npz. Пока модель не обучена,
+    predict возвращает None и запросы идут как раньше.
+    """
+
+    def __init__(self, db_path=None, model_path=None, threshold=None):
+        self.db_path = db_path or os.environ.get('POLICY_RISK_DB_PATH', DEFAULT_OUTCOMES_PATH)
+        self.model_path = model_path or os.environ.get('POLICY_RISK_MODEL_PATH', DEFAULT_MODEL_PATH)
+        self.threshold = float(threshold if threshold is not None else POLICY_RISK_THRESHOLD)
+        self._lock = threading.Lock()
+        self._weights = None
+        self._bias = 0.0
+        self._model_mtime = None
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._lock, self._connect() as conn:
+            # rejected: 1/0 — исход вызова DALL-E, NULL — запрос остановлен моделью до вызова
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS policy_outcomes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    prompt TEXT NOT NULL,
+                    enhanced_prompt TEXT,
+                    rejected INTEGER,
+                    latency REAL,
+                    risk REAL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_policy_outcomes_created ON policy_outcomes (created_at)")
+
+    def _insert(self, prompt, enhanced_prompt, rejected, latency, risk):
+        if not POLICY_RISK_LOGGING:
+            return
+        try:
+            with self._lock, self._connect() as conn:
+                cursor = conn.execute("INSERT INTO policy_outcomes (prompt, enhanced_prompt, rejected, latency, risk, created_at) "
+                                      "VALUES (?, ?, ?, ?, ?, ?)",
+                                      (prompt, enhanced_prompt, rejected, latency, risk, time.time()))
+                self._prune(conn, cursor.lastrowid)
+        except Exception as e:
+            print(f"Ошибка при записи исхода запроса к DALL-E: {str(e)}")
+
+    @staticmethod
+    def _prune(conn, last_id):
+        # Удаление по первичному ключу и индексу времени: запись остается дешевой
+        conn.execute("DELETE FROM policy_outcomes WHERE id <= ?", (last_id - POLICY_RISK_MAX_ROWS,))
+        if POLICY_RISK_MAX_AGE_DAYS > 0:
+            conn.execute("DELETE FROM policy_outcomes WHERE created_at < ?",
+                         (time.time() - POLICY_RISK_MAX_AGE_DAYS * 24 * 3600,))
+
+    def record_outcome(self, prompt, enhanced_prompt, rejected, latency):
+        """
+        Записывает исход вызова DALL-E для последующего обучения.
+
+        Args:
+            prompt (str): Промпт, переданный в generate_image
+            enhanced_prompt (str): Итоговый промпт, отправленный в DALL-E
+            rejected (bool): Отклонен ли запрос политикой содержания
+            latency (float): Длительность вызова DALL-E в секундах
+        """
+        self._insert(prompt, enhanced_prompt, int(bool(rejected)), float(latency), None)
+
+    def record_routed(self, prompt, enhanced_prompt, risk):
+        """
+        Записывает запрос, который модель направила на безопасный путь без вызова DALL-E.
+        """
+        self._insert(prompt, enhanced_prompt, None, None, float(risk))
+
+    def load_samples(self):
+        """
+        Возвращает размеченные исходы: список (id, prompt, enhanced_prompt, rejected, latency).
+        """
+        with self._lock, self._connect() as conn:
+            return conn.execute("SELECT id, prompt, enhanced_prompt, rejected, latency FROM policy_outcomes "
+                                "WHERE rejected IS NOT NULL ORDER BY id").fetchall()
+
+    def _load_model(self):
+        # Модель перечитывается, если файл обновлен командой train
+        try:
+            mtime = os.path.getmtime(self.model_path)
+        except OSError:
+            self._weights = None
+            self._model_mtime = None
+            return
+        if mtime == self._model_mtime:
+            return
+        try:
+            with np.load(self.model_path) as data:
+                if int(data['feature_version']) != FEATURE_VERSION or data['weights'].shape[0] != N_FEATURES:
+                    print("Модель риска политики содержания обучена на других признаках, переобучите ее")
+                    self._weights = None
+                else:
+                    self._weights = data['weights']
+                    self._bias = float(data['bias'])
+        except Exception as e:
+            print(f"Ошибка при загрузке модели риска политики содержания: {str(e)}")
+            self._weights = None
+        self._model_mtime = mtime
+
+    def save(self, weights, bias):
+        os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
+        temp_path = self.model_path + '.part.npz'
+        np.savez(temp_path, weights=weights.astype(np.float32), bias=np.float64(bias),
+                 feature_version=np.int64(FEATURE_VERSION))
+        os.replace(temp_path, self.model_path)
+
+    def predict(self, prompt, enhanced_prompt=None):
+        """
+        Оценивает вероятность отклонения запроса политикой содержания.
+
+        Returns:
+            float or None: Вероятность от 0 до 1 или None, если модель не обучена
+        """
+        self._load_model()
+        weights = self._weights
+        if weights is None:
+            return None
+        columns = extract_features(prompt, enhanced_prompt)
+        return float(_sigmoid(weights[columns].sum() + self._bias))
+
+    def should_route_safe(self, prompt, enhanced_prompt=None):
+        """
+        Решает, нужно ли сразу направить запрос на безопасный путь.
+
+        Returns:
+            tuple: (True, если риск не ниже порога; оценка риска или None)
+        """
+        if not POLICY_RISK_ROUTING:
+            return False, None
+        risk = self.predict(prompt, enhanced_prompt)
+        return risk is not None and risk >= self.threshold, risk
+
+
+# Общий экземпляр для генерации изображений
+policy_risk_model = PolicyRiskModel()
+
+
+def _evaluate(model, samples, holdout_every=5):
+    """
+    Обучает модель на части исходов и оценивает ее на отложенных (каждый holdout_every-й).
+    """
+    features = [extract_features(prompt, enhanced) for _, prompt, enhanced, _, _ in samples]
+    labels = np.array([rejected for _, _, _, rejected, _ in samples], dtype=np.float64)
+    latencies = np.array([latency or 0.0 for _, _, _, _, latency in samples], dtype=np.float64)
+    holdout = np.array([sample_id % holdout_every == 0 for sample_id, _, _, _, _ in samples])
+    train_index = np.flatnonzero(~holdout)
+    test_index = np.flatnonzero(holdout)
+    if not len(test_index) or len(np.unique(labels[train_index])) < 2:
+        print("Недостаточно данных для отложенной оценки")
+        return
+
+    weights, bias = fit_logistic([features[i] for i in train_index], labels[train_index])
+    test_rows, test_columns = _design([features[i] for i in test_index])
+    probabilities = _sigmoid(_scores(weights, bias, test_rows, test_columns, len(test_index)))
+    predicted = probabilities >= model.threshold
+    actual = labels[test_index] > 0
+
+    true_positive = int(np.sum(predicted & actual))
+    false_positive = int(np.sum(predicted & ~actual))
+    false_negative = int(np.sum(~predicted & actual))
+    accuracy = float(np.mean(predicted == actual))
+    baseline = float(max(actual.mean(), 1 - actual.mean()))
+    precision = true_positive / max(true_positive + false_positive, 1)
+    recall = true_positive / max(true_positive + false_negative, 1)
+    saved = float(latencies[test_index][predicted & actual].sum())
+
+    print(f"Отложенная выборка: {len(test_index)} запросов, отклонено {int(actual.sum())}")
+    print(f"Точность (accuracy): {accuracy:.3f} (всегда один класс: {baseline:.3f})")
+    print(f"Precision: {precision:.3f}, recall: {recall:.3f} при пороге {model.threshold}")
+    print(f"Сэкономлено ожидания DALL-E: {saved:.1f} с на {true_positive} отклоненных запросах; "
+          f"лишний безопасный путь: {false_positive} запросов")
+
+
+def train(model=policy_risk_model):
+    samples = model.load_samples()
+    rejected = sum(1 for sample in samples if sample[3])
+    print(f"Размеченных исходов: {len(samples)}, отклонено политикой: {rejected}")
+    if rejected < MIN_SAMPLES_PER_CLASS or len(samples) - rejected < MIN_SAMPLES_PER_CLASS:
+        print(f"Для обучения нужно не менее {MIN_SAMPLES_PER_CLASS} исходов каждого класса")
+        return False
+
+    _evaluate(model, samples)
+
+    # Итоговая модель обучается на всех исходах
+    features = [extract_features(prompt, enhanced) for _, prompt, enhanced, _, _ in samples]
+    labels = np.array([sample[3] for sample in samples], dtype=np.float64)
+    weights, bias = fit_logistic(features, labels)
+    model.save(weights, bias)
+    print(f"Модель сохранена: {model.model_path}")
+    return True
+
+
+def report(model=policy_risk_model):
+    """
+    Показывает накопленные исходы и экономию от запросов, остановленных моделью.
+    """
+    with model._lock, model._connect() as conn:
+        labelled, rejected, rejected_latency = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(rejected), 0), AVG(CASE WHEN rejected = 1 THEN latency END) "
+            "FROM policy_outcomes WHERE rejected IS NOT NULL").fetchone()
+        routed = conn.execute("SELECT COUNT(*) FROM policy_outcomes WHERE rejected IS NULL").fetchone()[0]
+    print(f"Вызовов DALL-E записано: {labelled}, отклонено политикой: {rejected}")
+    if rejected_latency is not None:
+        print(f"Среднее ожидание до отказа DALL-E: {rejected_latency:.1f} с")
+    print(f"Направлено моделью на безопасный путь: {routed}")
+    if routed and rejected_latency is not None:
+        print(f"Оценка сэкономленного времени: {routed * rejected_latency:.0f} с")
+    print(f"Модель: {'обучена' if os.path.exists(model.model_path) else 'не обучена'}, порог {model.threshold}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Модель риска отклонения запросов к DALL-E политикой содержания')
+    parser.add_argument('command', choices=['train', 'report'],
+                        help='train — обучить модель и оценить ее на отложенных данных; report — статистика')
+    args = parser.parse_args()
+    if args.command == 'train':
+        train()
+    else:
+        report()
+
+
+if __name__ == "__main__":
+    main()
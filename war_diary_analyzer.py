@@ -4,9 +4,26 @@ from openai import OpenAI       # Импортируем только новую
 import json
 import base64  # Добавляем для работы с изображениями
 import requests  # Добавляем для работы с API
+import requests.adapters
+import httpx
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import io  # Добавляем для работы с файлами
 from datetime import datetime  # Добавляем для работы с датами
 import time  # Добавляем для работы с временем
+import uuid
+from analysis_cache import ResultCache, make_cache_key
+from diary_chunking import split_diary_into_chunks, merge_emotion_analyses
+import emotion_lexicon
+from content_screening import content_screener, RISKY, EXTREME_VIOLENCE
+from music_params import determine_music_params, DEFAULT_MUSIC_PARAMS
+from media_storage import download_to_storage, store_stream, iter_base64_chunks, GENERATED_IMAGES_DIR
+from image_derivatives import schedule_derivatives
+from asset_pool import AssetPool
+from policy_risk import policy_risk_model
+from music_metadata import metadata_store
+from music_poller import music_poller
+from notifications import music_events
 
 # Улучшенная загрузка переменных окружения
 env_path = find_dotenv()
@@ -25,51 +42,296 @@ if env_path:
 else:
     print("Файл .env не найден, переменные окружения не загружены")
 
+# Модель и версия промпта анализа эмоций входят в ключ кэша:
+# при изменении промпта увеличьте версию, чтобы старые результаты не использовались
+EMOTION_ANALYSIS_MODEL = "gpt-4"
+EMOTION_PROMPT_VERSION = "1"
+
+# Таймаут запроса анализа эмоций; при ошибке или таймауте используется словарный анализ
+EMOTION_ANALYSIS_TIMEOUT = int(os.environ.get('EMOTION_ANALYSIS_TIMEOUT', 120))
+LEXICON_FALLBACK_ENABLED = os.environ.get('LEXICON_FALLBACK', '1').lower() not in ('0', 'false', 'no')
+# Сколько ждать ответа GPT, прежде чем отдать словарный анализ; запрос к API при этом
+# продолжается в фоне, и его результат попадает в кэш для следующих запросов
+LEXICON_FALLBACK_DEADLINE = float(os.environ.get('LEXICON_FALLBACK_DEADLINE', 30))
+emotion_analysis_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('EMOTION_ANALYSIS_WORKERS', 8)),
+                                               thread_name_prefix='emotion-analysis')
+
+# Персистентный кэш результатов анализа эмоций (instance/analysis_cache.db)
+analysis_cache = ResultCache('emotion_analysis')
+
+# Результаты уже выполненных анализов по идентификатору, который /analyze возвращает клиенту:
+# повторные запросы (например, /generate_safe_image) используют их без нового обращения к GPT
+ANALYSIS_HANDLE_TTL = int(os.environ.get('ANALYSIS_HANDLE_TTL', 24 * 3600))
+analysis_handles = ResultCache('analysis_handles', ttl_seconds=ANALYSIS_HANDLE_TTL)
+
+# Кэш аргументов function calling, обогащающего промпт изображения (та же база, отдельная таблица)
+PROMPT_ENHANCEMENT_VERSION = "1"
+prompt_enhancement_cache = ResultCache('prompt_enhancement')
+
+# Ограниченный пул потоков для параллельной генерации текста, изображения и музыки
+GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', 6))
+generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS,
+                                         thread_name_prefix='generation')
+# Этапы, которые продолжают выполняться после таймаута и занимают потоки generation_executor
+_overrun_stages = set()
+_overrun_lock = threading.Lock()
+
+
+def abandon_stage(stage, future):
+    """
+    Освобождает этап, превысивший таймаут: еще не начатый этап отменяется, а уже
+    выполняющийся учитывается до завершения, чтобы было видно, сколько потоков пула
+    заняты брошенной работой.
+    
+    Args:
+        stage (str): Название этапа
+        future (Future): Задача этапа в generation_executor
+    """
+    if future.cancel():
+        print(f"Этап '{stage}' отменен до запуска")
+        return
+    started = time.time()
+    with _overrun_lock:
+        _overrun_stages.add(future)
+        busy = len(_overrun_stages)
+    print(f"Этап '{stage}' продолжает выполняться после таймаута; "
+          f"потоков пула генерации занято такими этапами: {busy} из {GENERATION_WORKERS}")
+    
+    def release(done_future):
+        with _overrun_lock:
+            _overrun_stages.discard(done_future)
+        print(f"Брошенный этап '{stage}' завершился через {time.time() - started:.1f} сек. после таймаута")
+    
+    future.add_done_callback(release)
+
+
+def overrun_stage_count():
+    """
+    Количество этапов, которые выполняются после своего таймаута.
+    """
+    with _overrun_lock:
+        return len(_overrun_stages)
+
+# Формат ответа DALL-E: b64_json (изображение приходит в ответе, без второго запроса к CDN) или url
+IMAGE_RESPONSE_FORMAT = os.environ.get('IMAGE_RESPONSE_FORMAT', 'b64_json')
+
+# Последний запасной вариант безопасного изображения: промпт постоянный, поэтому
+# изображения генерируются заранее (пул safe_pool) и отдаются без обращения к API
+SUPER_SAFE_IMAGE_PROMPT = """
+                    Create a symbolic artistic painting showing an old Russian/Soviet journal and personal items from 1941-1945 Great Patriotic War 
+                    on a wooden desk next to a window. The window shows a peaceful Eastern European landscape at sunset. 
+                    Include subtle elements that suggest Soviet wartime context - medals, propaganda poster on wall, etc.
+                    Style: detailed oil painting with warm lighting.
+                    """
+safe_image_pool = AssetPool('safe_pool', SUPER_SAFE_IMAGE_PROMPT)
+
+# Упреждающая генерация безопасного изображения (по умолчанию выключена): если исходное
+# изображение отклонено политикой содержания, безопасная версия начинает генерироваться
+# сразу, а /generate_safe_image отдает готовый результат
+SPECULATIVE_SAFE_IMAGE_ENABLED = os.environ.get('SPECULATIVE_SAFE_IMAGE', '0').lower() in ('1', 'true', 'yes')
+SPECULATIVE_SAFE_IMAGE_VERSION = "1"
+# Сколько /generate_safe_image ждет незавершенную упреждающую генерацию, прежде чем начать свою
+SPECULATIVE_SAFE_IMAGE_WAIT = float(os.environ.get('SPECULATIVE_SAFE_IMAGE_WAIT', 5))
+speculative_safe_images = ResultCache('speculative_safe_images',
+                                      ttl_seconds=int(os.environ.get('SPECULATIVE_SAFE_IMAGE_TTL', 600)),
+                                      max_entries=200)
+speculative_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('SPECULATIVE_SAFE_IMAGE_WORKERS', 2)),
+                                          thread_name_prefix='speculative-safe-image')
+_speculative_pending = {}
+_speculative_lock = threading.Lock()
+
+# Длинные дневники анализируются по фрагментам (map-reduce) вместо обрезки до 8000 символов
+EMOTION_TEXT_LIMIT = 8000
+CHUNKED_ANALYSIS_ENABLED = os.environ.get('CHUNKED_ANALYSIS', '1').lower() not in ('0', 'false', 'no')
+ANALYSIS_CHUNK_CHARS = min(EMOTION_TEXT_LIMIT, int(os.environ.get('ANALYSIS_CHUNK_CHARS', 6000)))
+ANALYSIS_CHUNK_CONCURRENCY = int(os.environ.get('ANALYSIS_CHUNK_CONCURRENCY', 4))
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_CHUNK_CONCURRENCY,
+                                       thread_name_prefix='analysis-chunk')
+
+# Таймауты этапов генерации в секундах (фронтенд прерывает запрос через 180 секунд)
+STAGE_TIMEOUTS = {
+    'text': int(os.environ.get('STAGE_TIMEOUT_TEXT', 150)),
+    'image': int(os.environ.get('STAGE_TIMEOUT_IMAGE', 170)),
+    'music': int(os.environ.get('STAGE_TIMEOUT_MUSIC', 90)),
+}
+
 class WarDiaryAnalyzer:
     def __init__(self):
         """
         Инициализация анализатора военных дневников.
-        Загружает API ключи и конфигурирует клиент OpenAI.
+        Читает API ключи из окружения (файл .env загружается один раз при импорте модуля)
+        и создает долгоживущие HTTP-клиенты с пулом keep-alive соединений.
         """
-        # Загружаем переменные окружения из файла .env
-        load_dotenv()
-        
-        # Улучшенная загрузка переменных окружения
         self.api_key = os.environ.get('OPENAI_API_KEY')
         self.suno_api_key = os.environ.get('SUNOAI_API_KEY')
         
-        # Если ключи не найдены в переменных окружения, пробуем получить их через getenv
-        if not self.api_key:
-            self.api_key = os.getenv('OPENAI_API_KEY')
-        if not self.suno_api_key:
-            self.suno_api_key = os.getenv('SUNOAI_API_KEY')
-        
         print(f"Инициализация WarDiaryAnalyzer, API ключ OpenAI {'найден' if self.api_key else 'НЕ НАЙДЕН'}")
         print(f"API ключ Suno {'найден' if self.suno_api_key else 'НЕ НАЙДЕН'}")
-        print(f"Содержимое переменной SUNOAI_API_KEY: '{self.suno_api_key}'")
-        print(f"Текущий рабочий каталог: {os.getcwd()}")
-        print(f"Проверка, существует ли файл .env: {os.path.exists('.env')}")
         
         if not self.api_key:
             raise ValueError("Пожалуйста, установите OPENAI_API_KEY в файле .env")
         
-        # Конфигурируем клиент OpenAI
-        self.client = OpenAI(api_key=self.api_key)
+        # Конфигурируем клиент OpenAI с постоянным пулом соединений,
+        # чтобы не устанавливать TLS-соединение заново на каждый запрос
+        pool_size = int(os.environ.get('HTTP_POOL_SIZE', 20))
+        self.client = OpenAI(
+            api_key=self.api_key,
+            http_client=httpx.Client(
+                limits=httpx.Limits(max_connections=pool_size,
+                                    max_keepalive_connections=pool_size,
+                                    keepalive_expiry=120)
+            )
+        )
+        
+        # Общая сессия requests для Suno API (apibox) и скачивания файлов
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size,
+                                                max_retries=3)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
 
-    def analyze_emotions(self, text):
+    def analyze_emotions(self, text, allow_fallback=True):
         """
         Глубокий анализ эмоций в тексте с помощью GPT.
+        Успешные результаты кэшируются по хешу нормализованного текста,
+        модели и версии промпта, поэтому повторный анализ того же текста
+        не требует обращения к API. Если API недоступен или не ответил
+        за LEXICON_FALLBACK_DEADLINE секунд, возвращается словарный анализ
+        (source='lexicon', degraded=True, fallback_reason), который не кэшируется.
         
         Args:
             text (str): Входной текст для анализа
+            allow_fallback (bool): Разрешить словарный анализ вместо ошибки API
+                (пакетная обработка отключает его, чтобы повторить такие дневники)
             
         Returns:
             dict: Словарь с результатами анализа эмоций
         """
-        if len(text) > 8000:
+        if not (allow_fallback and LEXICON_FALLBACK_ENABLED):
+            return self._analyze_emotions_cached(text)
+        
+        future = emotion_analysis_executor.submit(self._analyze_emotions_cached, text)
+        try:
+            result = future.result(timeout=LEXICON_FALLBACK_DEADLINE)
+        except FutureTimeoutError:
+            result = {'error': f"API не ответил за {LEXICON_FALLBACK_DEADLINE:.0f} секунд"}
+        except Exception as e:
+            result = {'error': str(e)}
+        if isinstance(result, dict) and result.get('error'):
+            print(f"Анализ эмоций через API не удался, используется словарный анализ: {result['error']}")
+            fallback = emotion_lexicon.analyze(text)
+            fallback['fallback_reason'] = result['error']
+            fallback['degraded'] = True
+            return fallback
+        return result
+
+    def register_analysis(self, text, emotion_analysis):
+        """
+        Сохраняет результат анализа эмоций и возвращает его идентификатор.
+        
+        Args:
+            text (str): Проанализированный текст
+            emotion_analysis (dict): Результат анализа эмоций
+            
+        Returns:
+            str or None: Идентификатор анализа или None, если результат содержит ошибку
+        """
+        if not isinstance(emotion_analysis, dict) or emotion_analysis.get('error'):
+            return None
+        analysis_id = uuid.uuid4().hex
+        analysis_handles.set(analysis_id, {
+            'text_key': make_cache_key(text, EMOTION_ANALYSIS_MODEL, EMOTION_PROMPT_VERSION),
+            'emotion_analysis': emotion_analysis
+        })
+        return analysis_id
+
+    def get_registered_analysis(self, analysis_id, text):
+        """
+        Возвращает сохраненный анализ эмоций по идентификатору.
+        Анализ возвращается, только если он был выполнен для того же текста.
+        
+        Args:
+            analysis_id (str): Идентификатор, полученный от register_analysis
+            text (str): Текст дневника из текущего запроса
+            
+        Returns:
+            dict or None: Результат анализа эмоций или None, если он не найден или устарел
+        """
+        if not analysis_id:
+            return None
+        entry = analysis_handles.get(analysis_id)
+        if not isinstance(entry, dict):
+            return None
+        if entry.get('text_key') != make_cache_key(text, EMOTION_ANALYSIS_MODEL, EMOTION_PROMPT_VERSION):
+            print(f"Анализ {analysis_id[:12]}... выполнен для другого текста, проводим анализ заново")
+            return None
+        return entry.get('emotion_analysis')
+
+    def _analyze_emotions_cached(self, text):
+        """
+        Анализ эмоций через GPT с использованием кэша (без словарного запасного варианта).
+        """
+        cache_key = make_cache_key(text, EMOTION_ANALYSIS_MODEL, EMOTION_PROMPT_VERSION)
+        cached = analysis_cache.get(cache_key)
+        if cached is not None:
+            print(f"Анализ эмоций взят из кэша (ключ {cache_key[:12]}...)")
+            return cached
+        
+        if CHUNKED_ANALYSIS_ENABLED and len(text) > EMOTION_TEXT_LIMIT:
+            result = self._analyze_emotions_chunked(text)
+        else:
+            result = self._request_emotion_analysis(text)
+        
+        # Кэшируем только успешно распарсенные результаты
+        if isinstance(result, dict) and not result.get('error'):
+            analysis_cache.set(cache_key, result)
+        return result
+
+    def _analyze_emotions_chunked(self, text):
+        """
+        Анализ длинного дневника по фрагментам: фрагменты анализируются параллельно
+        (не более ANALYSIS_CHUNK_CONCURRENCY одновременно), затем результаты объединяются
+        в ту же схему, что возвращает обычный анализ.
+        
+        Args:
+            text (str): Входной текст для анализа
+            
+        Returns:
+            dict: Объединенный результат анализа эмоций
+        """
+        chunks = split_diary_into_chunks(text, ANALYSIS_CHUNK_CHARS)
+        print(f"Длинный текст ({len(text)} символов) разбит на {len(chunks)} фрагментов для анализа")
+        
+        start_time = time.time()
+        # Каждый фрагмент кэшируется отдельно,
+        # поэтому при дописывании дневника повторно анализируются только новые фрагменты
+        results = list(analysis_executor.map(self._analyze_emotions_cached, chunks))
+        print(f"Анализ {len(chunks)} фрагментов завершен за {time.time() - start_time:.2f} секунд")
+        
+        successful = [(result, len(chunk)) for result, chunk in zip(results, chunks)
+                      if isinstance(result, dict) and not result.get('error')]
+        if not successful:
+            return results[0] if results else self._request_emotion_analysis(text)
+        if len(successful) < len(chunks):
+            print(f"ВНИМАНИЕ: не удалось проанализировать {len(chunks) - len(successful)} фрагментов")
+        
+        return merge_emotion_analyses([r for r, _ in successful], [w for _, w in successful])
+
+    def _request_emotion_analysis(self, text):
+        """
+        Выполняет запрос к GPT для анализа эмоций без использования кэша.
+        
+        Args:
+            text (str): Входной текст для анализа
+            
+        Returns:
+            dict: Словарь с результатами анализа эмоций
+        """
+        if len(text) > EMOTION_TEXT_LIMIT:
             print(f"ВНИМАНИЕ: Текст слишком длинный ({len(text)} символов), что может вызвать таймаут")
             # Обрезаем текст, если он слишком длинный
-            text = text[:8000] + "..."
+            text = text[:EMOTION_TEXT_LIMIT] + "..."
             
         prompt = f"""
         Проанализируйте эмоциональное состояние автора в следующем отрывке из военного дневника.
@@ -117,13 +379,13 @@ class WarDiaryAnalyzer:
             
             # Отправляем запрос через новый API
             response = self.client.chat.completions.create(
-                model="gpt-4",
+                model=EMOTION_ANALYSIS_MODEL,
                 messages=[
                     {"role": "system", "content": "Вы - опытный военный психолог, специализирующийся на анализе военных дневников и воспоминаний. Всегда возвращайте ответ в формате JSON."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.7,
-                timeout=120  # Увеличиваем таймаут до 120 секунд
+                timeout=EMOTION_ANALYSIS_TIMEOUT
             )
             
             elapsed_time = time.time() - start_time
@@ -194,6 +456,47 @@ class WarDiaryAnalyzer:
         Returns:
             str: Сгенерированное художественное произведение
         """
+        try:
+            response = self.client.chat.completions.create(
+                model="gpt-4",
+                messages=self._literary_work_messages(diary_text, emotion_analysis),
+                temperature=0.8,
+                max_tokens=2000
+            )
+            return response.choices[0].message.content
+        except Exception as e:
+            return f"Произошла ошибка при генерации текста: {str(e)}"
+
+    def stream_literary_work(self, diary_text, emotion_analysis):
+        """
+        Потоковая генерация художественного произведения: возвращает фрагменты текста
+        по мере их получения от API (stream=True).
+        
+        Args:
+            diary_text (str): Исходный текст дневника
+            emotion_analysis (dict): Результаты анализа эмоций
+            
+        Yields:
+            str: Очередной фрагмент сгенерированного текста
+        """
+        stream = self.client.chat.completions.create(
+            model="gpt-4",
+            messages=self._literary_work_messages(diary_text, emotion_analysis),
+            temperature=0.8,
+            max_tokens=2000,
+            stream=True
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                yield token
+
+    def _literary_work_messages(self, diary_text, emotion_analysis):
+        """
+        Формирует сообщения для генерации художественного произведения.
+        """
         prompt = f"""
         На основе следующего дневникового текста времен войны и его эмоционального анализа создайте художественное произведение.
         
@@ -213,22 +516,12 @@ class WarDiaryAnalyzer:
         4. Использует художественные приемы для усиления эмоционального воздействия
         5. Сохраняет атмосферу военного времени
         """
+        return [
+            {"role": "system", "content": "Вы - талантливый писатель, специализирующийся на военной прозе. Ваш стиль сочетает реализм с глубоким психологизмом."},
+            {"role": "user", "content": prompt}
+        ]
 
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "Вы - талантливый писатель, специализирующийся на военной прозе. Ваш стиль сочетает реализм с глубоким психологизмом."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.8,
-                max_tokens=2000
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"Произошла ошибка при генерации текста: {str(e)}"
-
-    def generate_image(self, prompt, size="1024x1024", model="gpt-4"):
+    def generate_image(self, prompt, size="1024x1024", model="gpt-4", policy_gate=False, image_prefix='image'):
         """
         Генерирует изображение через Chat Completions API с использованием function_call 
         для вызова Image Generation API.
@@ -237,6 +530,10 @@ class WarDiaryAnalyzer:
             prompt (str): Текстовое описание для генерации изображения
             size (str): Размер изображения: "256x256", "512x512", "1024x1024"
             model (str): Модель GPT для обработки запроса
+            policy_gate (bool): Проверять запрос локальной моделью риска политики содержания
+                и записывать исход вызова DALL-E (только для изображений по тексту дневника;
+                безопасные промпты и пул запасных изображений проверку не проходят)
+            image_prefix (str): Префикс имени сохраняемого файла (<prefix>_<хеш>.png)
             
         Returns:
             dict: Словарь с URL сгенерированного изображения или информацией об ошибке
@@ -245,158 +542,30 @@ class WarDiaryAnalyzer:
             # Логируем только начало промпта для отладки, но используем полный промпт
             print(f"Генерация изображения с запросом (начало): {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
             
-            # Проверяем наличие слов, которые могут вызвать фильтрацию содержимого
-            risky_words = ["война", "военный", "битва", "сражение", "атака", "бой", "труп", 
-                           "оружие", "убитый", "раненый", "насилие", "кровь", "взрыв", "бомба",
-                           "war", "battle", "violence", "dead", "kill", "blood", "weapon", "gun",
-                           "attack", "corpse", "victim", "bomb", "explosive", "combat", "fight"]
-            
-            extremely_violent_words = [
-                "кровь", "пытки", "расстрел", "убил", "пули", "труп", "пытка", 
-                "изуродован", "оторвало", "blood", "torture", "shot", "killed", "bullets",
-                "corpse", "mutilated", "dismembered", "gore", "visceral"
-            ]
+            # Проверяем наличие слов, которые могут вызвать фильтрацию содержимого (один проход по тексту)
+            prompt_categories = content_screener.categories(prompt)
             
             # Проверяем на наличие очень жестокого содержимого
-            if any(word in prompt.lower() for word in extremely_violent_words):
+            if EXTREME_VIOLENCE in prompt_categories:
                 print("Обнаружены явные описания насилия в промпте, сразу возвращаем ошибку политики содержания")
                 raise Exception(f"Запрос содержит описания насилия, которые запрещены политикой содержания OpenAI.")
             
             # Если в промпте есть потенциально рискованные слова, добавляем префикс, но не пытаемся явно обойти фильтры
-            if any(word in prompt.lower() for word in risky_words):
+            if RISKY in prompt_categories:
                 print("Обнаружены потенциально рискованные слова в промпте, добавляем префикс")
                 # Используем менее агрессивный префикс
                 prompt = f"Create a symbolic historical scene that avoids explicit violence: {prompt}"
             
-            # Определяем функцию для генерации изображения
-            tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "generate_image",
-                        "description": "Генерирует изображение на основе детального описания",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "detailed_prompt": {
-                                    "type": "string",
-                                    "description": "Подробное описание изображения для генерации"
-                                },
-                                "style": {
-                                    "type": "string",
-                                    "description": "Художественный стиль изображения",
-                                    "enum": ["realistic", "artistic", "cinematic", "documentary"]
-                                },
-                                "mood": {
-                                    "type": "string",
-                                    "description": "Эмоциональное настроение изображения",
-                                    "enum": ["dramatic", "solemn", "tense", "hopeful", "melancholic"]
-                                }
-                            },
-                            "required": ["detailed_prompt"]
-                        }
-                    }
-                }
-            ]
-            
-            # Вызываем Chat Completions API для создания обогащенного промпта
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "Ты - эксперт по визуальному искусству с глубоким пониманием истории. "
-                                                "Твоя задача - преобразовать описание сцены в детальный визуальный образ "
-                                                "для художественной иллюстрации. Избегай любых упоминаний насилия, "
-                                                "военных сцен, оружия или боевых действий."},
-                    {"role": "user", "content": f"Мне нужно создать визуальную иллюстрацию на основе следующего описания. "
-                                              f"Опиши эту сцену, добавь визуальные элементы, настроение и атмосферу "
-                                              f"без упоминания войны, оружия или насилия:\n\n{prompt}"}
-                ],
-                tools=tools,
-                tool_choice={"type": "function", "function": {"name": "generate_image"}}
-            )
-            
-            # Извлекаем результат function call
-            function_call = response.choices[0].message.tool_calls[0]
-            arguments_text = function_call.function.arguments
-            
-            # Расширенный метод очистки аргументов от недопустимых символов
-            try:
-                # Сначала пробуем прямой парсинг
-                try:
-                    function_args = json.loads(arguments_text)
-                    print("JSON успешно разобран напрямую")
-                except json.JSONDecodeError as e:
-                    print(f"Ошибка прямого парсинга JSON: {e}")
-                    
-                    # Шаг 1: Удаляем все управляющие символы, кроме разрешенных
-                    cleaned_args = ''.join(ch for ch in arguments_text if 
-                                        (ord(ch) >= 32 or ch in ['\n', '\r', '\t']))
-                    
-                    # Шаг 2: Заменяем экранированные кавычки и другие проблемные последовательности
-                    cleaned_args = cleaned_args.replace('\\"', '"')
-                    cleaned_args = cleaned_args.replace('\\\\', '\\')
-                    
-                    # Шаг 3: Удаляем невидимые символы Unicode, которые могут вызывать проблемы
-                    import re
-                    cleaned_args = re.sub(r'[\u0000-\u001F\u007F-\u009F]', '', cleaned_args)
-                    
-                    # Шаг 4: Проверяем, что JSON имеет правильную структуру
-                    if not (cleaned_args.strip().startswith('{') and cleaned_args.strip().endswith('}')):
-                        # Если нет, пытаемся найти JSON-объект с помощью регулярного выражения
-                        json_match = re.search(r'\{.*\}', cleaned_args, re.DOTALL)
-                        if json_match:
-                            cleaned_args = json_match.group(0)
-                    
-                    print(f"Очищенные аргументы (начало): {cleaned_args[:100]}{'...' if len(cleaned_args) > 100 else ''}")
-                    
-                    # Пробуем парсить очищенные аргументы
-                    try:
-                        function_args = json.loads(cleaned_args)
-                        print("JSON успешно разобран после очистки")
-                    except json.JSONDecodeError as e2:
-                        print(f"Ошибка парсинга JSON после очистки: {e2}")
-                        
-                        # Пробуем восстановить промпт напрямую из ответа
-                        try:
-                            # Ищем часть с описанием изображения
-                            prompt_match = re.search(r'"detailed_prompt"\s*:\s*"([^"]*)"', cleaned_args)
-                            if prompt_match:
-                                detailed_prompt = prompt_match.group(1)
-                                print(f"Найден промпт с помощью regex (начало): {detailed_prompt[:50]}{'...' if len(detailed_prompt) > 50 else ''}")
-                                function_args = {
-                                    "detailed_prompt": detailed_prompt,
-                                    "style": "realistic",
-                                    "mood": "dramatic"
-                                }
-                            else:
-                                # Если не удалось найти по regex, используем оригинальный промпт
-                                print("Не удалось извлечь промпт из JSON, используем оригинальный промпт")
-                                function_args = {
-                                    "detailed_prompt": f"Create a realistic illustration inspired by historical context: {prompt}",
-                                    "style": "realistic",
-                                    "mood": "dramatic"
-                                }
-                        except Exception as e3:
-                            print(f"Ошибка при извлечении промпта: {e3}")
-                            raise e2  # Пробрасываем исходную ошибку JSON для обработки ниже
-            except json.JSONDecodeError as e:
-                print(f"Критическая ошибка при парсинге JSON аргументов: {e}")
-                print(f"Начало аргументов: {arguments_text[:100]}{'...' if len(arguments_text) > 100 else ''}")
-                
-                # Создаем безопасные аргументы
-                function_args = {
-                    "detailed_prompt": f"Create a detailed artistic illustration of a historical scene",
-                    "style": "realistic",
-                    "mood": "dramatic"
-                }
-                print("Используем безопасные аргументы")
-            except Exception as e:
-                print(f"Неожиданная ошибка при обработке аргументов: {e}")
-                function_args = {
-                    "detailed_prompt": f"Create an artistic historical illustration",
-                    "style": "realistic",
-                    "mood": "atmospheric"
-                }
+            # Обогащаем промпт через function calling; результат кэшируется,
+            # поэтому повторная генерация по тому же промпту сразу идет к DALL-E
+            enhancement_key = make_cache_key(prompt, model, PROMPT_ENHANCEMENT_VERSION)
+            function_args = prompt_enhancement_cache.get(enhancement_key)
+            if function_args is not None:
+                print("Обогащенный промпт взят из кэша")
+            else:
+                function_args, cacheable = self._request_prompt_enhancement(prompt, model)
+                if cacheable:
+                    prompt_enhancement_cache.set(enhancement_key, function_args)
             
             # Получаем обогащенный промпт
             enhanced_prompt = function_args.get('detailed_prompt')
@@ -404,12 +573,13 @@ class WarDiaryAnalyzer:
             mood = function_args.get('mood', 'dramatic')
             
             # Проверяем детальный промпт на наличие крайне жестоких слов
-            if any(word in enhanced_prompt.lower() for word in extremely_violent_words):
+            enhanced_categories = content_screener.categories(enhanced_prompt)
+            if EXTREME_VIOLENCE in enhanced_categories:
                 print("Обнаружены экстремально жестокие слова в обогащенном промпте, прерываем генерацию")
                 raise Exception("Запрос содержит описания насилия, которые запрещены политикой содержания OpenAI.")
             
             # Если в обогащенном промпте есть рискованные слова, мягко корректируем его
-            if any(word in enhanced_prompt.lower() for word in risky_words):
+            if RISKY in enhanced_categories:
                 print("Обнаружены рискованные слова в обогащенном промпте, делаем промпт более абстрактным")
                 
                 # Делаем промпт более абстрактным и символическим
@@ -431,7 +601,22 @@ class WarDiaryAnalyzer:
             # Логируем только начало для отладки, но передаем полный промпт
             print(f"Обогащенный промпт (начало): {final_prompt[:150]}{'...' if len(final_prompt) > 150 else ''}")
             
+            # Локальная модель риска: запрос, который почти наверняка будет отклонен,
+            # не отправляется в DALL-E; generate_image_from_diary сразу переходит к безопасной версии
+            if policy_gate:
+                route_safe, policy_risk = policy_risk_model.should_route_safe(prompt, final_prompt)
+                if route_safe:
+                    print(f"Модель риска политики содержания: вероятность отклонения {policy_risk:.2f}, вызов DALL-E пропущен")
+                    policy_risk_model.record_routed(prompt, final_prompt, policy_risk)
+                    return {
+                        'success': False,
+                        'error': "Запрос будет отклонен политикой контента OpenAI",
+                        'type': 'predicted_policy_violation',
+                        'predicted_policy_risk': round(policy_risk, 3)
+                    }
+            
             # Теперь вызываем Image Generation API с улучшенным промптом и таймаутом
+            dalle_started = time.time()
             try:
                 image_response = self.client.images.generate(
                     model="dall-e-3",  # Используем современную модель
@@ -439,6 +624,7 @@ class WarDiaryAnalyzer:
                     size=size,
                     quality="standard",  # Баланс между качеством и стоимостью
                     n=1,
+                    response_format=IMAGE_RESPONSE_FORMAT,
                     timeout=60  # Добавляем таймаут 60 секунд
                 )
             except Exception as dalle_error:
@@ -448,29 +634,56 @@ class WarDiaryAnalyzer:
                 # Проверяем ошибки, связанные с политикой контента
                 if "content_policy_violation" in error_message or "image_generation_user_error" in error_message or "violates" in error_message.lower():
                     print("Обнаружено нарушение политики содержания при вызове DALL-E API")
+                    if policy_gate:
+                        policy_risk_model.record_outcome(prompt, final_prompt, True, time.time() - dalle_started)
                     raise Exception(f"Запрос отклонен политикой содержания OpenAI: {error_message}")
                 else:
                     # Другие ошибки пробрасываем дальше
                     raise dalle_error
             
-            # Получаем URL сгенерированного изображения
-            image_url = image_response.data[0].url
-            print(f"Изображение успешно сгенерировано, URL: {image_url[:60]}...")
+            if policy_gate:
+                policy_risk_model.record_outcome(prompt, final_prompt, False, time.time() - dalle_started)
             
-            # Скачиваем изображение и сохраняем его локально
-            img_filename = f"image_{int(datetime.now().timestamp())}.png"
-            img_path = os.path.join("static", "generated_images", img_filename)
+            image_data = image_response.data[0]
+            image_b64 = getattr(image_data, 'b64_json', None)
+            
+            if image_b64:
+                # Изображение пришло в ответе: декодируем его блоками прямо в файл
+                print("Изображение успешно сгенерировано (base64), сохраняем без повторного скачивания")
+                try:
+                    img_path = store_stream(iter_base64_chunks(image_b64), GENERATED_IMAGES_DIR, image_prefix, '.png')
+                except Exception as img_error:
+                    print(f"Ошибка при сохранении изображения: {str(img_error)}")
+                    return {
+                        'success': False,
+                        'error': f"Не удалось сохранить изображение: {str(img_error)}"
+                    }
+                if not img_path:
+                    return {
+                        'success': False,
+                        'error': "Получены пустые данные изображения"
+                    }
+                print(f"Изображение успешно сохранено: {img_path}")
+                # WebP-копия и миниатюры создаются в фоне
+                schedule_derivatives(img_path)
+                return {
+                    'success': True,
+                    'image_url': '',  # Внешнего URL в этом режиме нет
+                    'local_path': img_path.replace("\\", "/"),
+                    'filename': os.path.basename(img_path)
+                }
             
-            # Создаем директорию, если она не существует
-            os.makedirs(os.path.dirname(img_path), exist_ok=True)
+            # Получаем URL сгенерированного изображения
+            image_url = image_data.url
+            print(f"Изображение успешно сгенерировано, URL: {image_url[:60]}...")
             
             try:
-                # Скачиваем изображение
+                # Скачиваем изображение потоково во временный файл; имя файла — хеш содержимого
                 print(f"Скачивание изображения с URL: {image_url}")
-                img_data = requests.get(image_url).content
+                img_path = download_to_storage(self.http, image_url, GENERATED_IMAGES_DIR, image_prefix, '.png')
                 
                 # Проверяем, что данные получены
-                if not img_data:
+                if not img_path:
                     print("Предупреждение: получены пустые данные изображения")
                     return {
                         'success': True,
@@ -479,13 +692,12 @@ class WarDiaryAnalyzer:
                         'filename': ""
                     }
                 
-                # Сохраняем изображение
-                with open(img_path, 'wb') as img_file:
-                    img_file.write(img_data)
+                img_filename = os.path.basename(img_path)
                 
                 # Проверяем, что файл создан и имеет размер
                 if os.path.exists(img_path) and os.path.getsize(img_path) > 0:
                     print(f"Изображение успешно сохранено: {img_path}")
+                    schedule_derivatives(img_path)
                     
                     # Формируем URL-путь для веб-сервера (всегда используем прямые слеши для web)
                     web_path = img_path.replace("\\", "/")
@@ -540,9 +752,162 @@ class WarDiaryAnalyzer:
                     'error': str(e)
                 }
 
+    def _request_prompt_enhancement(self, prompt, model):
+        """
+        Запрашивает у GPT обогащенный промпт для изображения через function calling
+        и разбирает аргументы вызова функции.
+        
+        Args:
+            prompt (str): Исходный промпт
+            model (str): Модель GPT для обработки запроса
+            
+        Returns:
+            tuple: (аргументы функции: detailed_prompt, style, mood;
+                    True, если аргументы получены от модели и их можно кэшировать)
+        """
+        cacheable = False
+        
+        # Определяем функцию для генерации изображения
+        tools = [
+            {
+                "type": "function",
+                "function": {
+                    "name": "generate_image",
+                    "description": "Генерирует изображение на основе детального описания",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "detailed_prompt": {
+                                "type": "string",
+                                "description": "Подробное описание изображения для генерации"
+                            },
+                            "style": {
+                                "type": "string",
+                                "description": "Художественный стиль изображения",
+                                "enum": ["realistic", "artistic", "cinematic", "documentary"]
+                            },
+                            "mood": {
+                                "type": "string",
+                                "description": "Эмоциональное настроение изображения",
+                                "enum": ["dramatic", "solemn", "tense", "hopeful", "melancholic"]
+                            }
+                        },
+                        "required": ["detailed_prompt"]
+                    }
+                }
+            }
+        ]
+
+        # Вызываем Chat Completions API для создания обогащенного промпта
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "Ты - эксперт по визуальному искусству с глубоким пониманием истории. "
+                                            "Твоя задача - преобразовать описание сцены в детальный визуальный образ "
+                                            "для художественной иллюстрации. Избегай любых упоминаний насилия, "
+                                            "военных сцен, оружия или боевых действий."},
+                {"role": "user", "content": f"Мне нужно создать визуальную иллюстрацию на основе следующего описания. "
+                                          f"Опиши эту сцену, добавь визуальные элементы, настроение и атмосферу "
+                                          f"без упоминания войны, оружия или насилия:\n\n{prompt}"}
+            ],
+            tools=tools,
+            tool_choice={"type": "function", "function": {"name": "generate_image"}}
+        )
+
+        # Извлекаем результат function call
+        function_call = response.choices[0].message.tool_calls[0]
+        arguments_text = function_call.function.arguments
+
+        # Расширенный метод очистки аргументов от недопустимых символов
+        try:
+            # Сначала пробуем прямой парсинг
+            try:
+                function_args = json.loads(arguments_text)
+                cacheable = True
+                print("JSON успешно разобран напрямую")
+            except json.JSONDecodeError as e:
+                print(f"Ошибка прямого парсинга JSON: {e}")
+
+                # Шаг 1: Удаляем все управляющие символы, кроме разрешенных
+                cleaned_args = ''.join(ch for ch in arguments_text if 
+                                    (ord(ch) >= 32 or ch in ['\n', '\r', '\t']))
+
+                # Шаг 2: Заменяем экранированные кавычки и другие проблемные последовательности
+                cleaned_args = cleaned_args.replace('\\"', '"')
+                cleaned_args = cleaned_args.replace('\\\\', '\\')
+
+                # Шаг 3: Удаляем невидимые символы Unicode, которые могут вызывать проблемы
+                import re
+                cleaned_args = re.sub(r'[\u0000-\u001F\u007F-\u009F]', '', cleaned_args)
+
+                # Шаг 4: Проверяем, что JSON имеет правильную структуру
+                if not (cleaned_args.strip().startswith('{') and cleaned_args.strip().endswith('}')):
+                    # Если нет, пытаемся найти JSON-объект с помощью регулярного выражения
+                    json_match = re.search(r'\{.*\}', cleaned_args, re.DOTALL)
+                    if json_match:
+                        cleaned_args = json_match.group(0)
+
+                print(f"Очищенные аргументы (начало): {cleaned_args[:100]}{'...' if len(cleaned_args) > 100 else ''}")
+
+                # Пробуем парсить очищенные аргументы
+                try:
+                    function_args = json.loads(cleaned_args)
+                    cacheable = True
+                    print("JSON успешно разобран после очистки")
+                except json.JSONDecodeError as e2:
+                    print(f"Ошибка парсинга JSON после очистки: {e2}")
+
+                    # Пробуем восстановить промпт напрямую из ответа
+                    try:
+                        # Ищем часть с описанием изображения
+                        prompt_match = re.search(r'"detailed_prompt"\s*:\s*"([^"]*)"', cleaned_args)
+                        if prompt_match:
+                            detailed_prompt = prompt_match.group(1)
+                            print(f"Найден промпт с помощью regex (начало): {detailed_prompt[:50]}{'...' if len(detailed_prompt) > 50 else ''}")
+                            function_args = {
+                                "detailed_prompt": detailed_prompt,
+                                "style": "realistic",
+                                "mood": "dramatic"
+                            }
+                        else:
+                            # Если не удалось найти по regex, используем оригинальный промпт
+                            print("Не удалось извлечь промпт из JSON, используем оригинальный промпт")
+                            function_args = {
+                                "detailed_prompt": f"Create a realistic illustration inspired by historical context: {prompt}",
+                                "style": "realistic",
+                                "mood": "dramatic"
+                            }
+                    except Exception as e3:
+                        print(f"Ошибка при извлечении промпта: {e3}")
+                        raise e2  # Пробрасываем исходную ошибку JSON для обработки ниже
+        except json.JSONDecodeError as e:
+            print(f"Критическая ошибка при парсинге JSON аргументов: {e}")
+            print(f"Начало аргументов: {arguments_text[:100]}{'...' if len(arguments_text) > 100 else ''}")
+
+            # Создаем безопасные аргументы
+            function_args = {
+                "detailed_prompt": f"Create a detailed artistic illustration of a historical scene",
+                "style": "realistic",
+                "mood": "dramatic"
+            }
+            print("Используем безопасные аргументы")
+        except Exception as e:
+            print(f"Неожиданная ошибка при обработке аргументов: {e}")
+            function_args = {
+                "detailed_prompt": f"Create an artistic historical illustration",
+                "style": "realistic",
+                "mood": "atmospheric"
+            }
+        
+        return function_args, cacheable
+
     def generate_image_from_diary(self, diary_text, emotion_analysis=None):
         """
         Генерирует изображение на основе текста дневника и его эмоционального анализа.
+        Если локальная модель риска предсказывает отклонение запроса, сразу генерируется
+        безопасная версия (без вызова DALL-E с исходным промптом).
+        Если изображение отклонено политикой содержания и включен режим SPECULATIVE_SAFE_IMAGE,
+        в фоне сразу запускается генерация безопасной версии.
         
         Args:
             diary_text (str): Текст дневника
@@ -551,20 +916,86 @@ class WarDiaryAnalyzer:
         Returns:
             dict: Результат генерации изображения
         """
+        result = self._generate_direct_image_from_diary(diary_text, emotion_analysis)
+        if isinstance(result, dict) and result.get('type') == 'predicted_policy_violation':
+            safe_result = self.generate_safe_image_from_diary(diary_text, emotion_analysis)
+            safe_result['predicted_policy_risk'] = result.get('predicted_policy_risk')
+            return safe_result
+        if (SPECULATIVE_SAFE_IMAGE_ENABLED and isinstance(result, dict)
+                and result.get('type') == 'content_policy_violation'):
+            self.start_speculative_safe_image(diary_text, emotion_analysis)
+        return result
+
+    def _speculative_key(self, diary_text):
+        return make_cache_key(diary_text, 'safe_image', SPECULATIVE_SAFE_IMAGE_VERSION)
+
+    def start_speculative_safe_image(self, diary_text, emotion_analysis=None):
+        """
+        Запускает фоновую генерацию безопасного изображения для текста дневника,
+        если она еще не запущена и готового результата нет.
+        """
+        key = self._speculative_key(diary_text)
+        with _speculative_lock:
+            if key in _speculative_pending:
+                return
+            if speculative_safe_images.get(key) is not None:
+                return
+            print("Запускаем упреждающую генерацию безопасного изображения")
+            _speculative_pending[key] = speculative_executor.submit(
+                self._run_speculative_safe_image, key, diary_text, emotion_analysis)
+
+    def _run_speculative_safe_image(self, key, diary_text, emotion_analysis):
+        try:
+            result = self.generate_safe_image_from_diary(diary_text, emotion_analysis)
+            if isinstance(result, dict) and result.get('success'):
+                speculative_safe_images.set(key, result)
+            return result
+        except Exception as e:
+            print(f"Ошибка упреждающей генерации безопасного изображения: {str(e)}")
+            return None
+        finally:
+            with _speculative_lock:
+                _speculative_pending.pop(key, None)
+
+    def get_speculative_safe_image(self, diary_text, wait=SPECULATIVE_SAFE_IMAGE_WAIT):
+        """
+        Забирает результат упреждающей генерации безопасного изображения.
+        Если генерация еще идет в этом процессе, ждет ее завершения не дольше wait секунд.
+        Использованный результат удаляется из кэша, повторный запрос сгенерирует новое изображение.
+        
+        Args:
+            diary_text (str): Текст дневника
+            wait (float, optional): Максимальное время ожидания незавершенной генерации
+            
+        Returns:
+            dict or None: Успешный результат generate_safe_image_from_diary или None
+        """
+        key = self._speculative_key(diary_text)
+        with _speculative_lock:
+            future = _speculative_pending.get(key)
+        if future is not None:
+            try:
+                future.result(timeout=wait)
+            except FutureTimeoutError:
+                return None
+        # Успешный результат сохраняется в кэш до завершения future
+        result = speculative_safe_images.get(key)
+        if isinstance(result, dict) and result.get('success'):
+            speculative_safe_images.delete(key)
+            return result
+        return None
+
+    def _generate_direct_image_from_diary(self, diary_text, emotion_analysis=None):
+        """
+        Генерирует изображение напрямую по тексту дневника (без упреждающей безопасной версии).
+        """
         try:
             # Если текст слишком длинный, обрезаем его
             if len(diary_text) > 4000:
                 diary_text = diary_text[:4000]
             
             # Сначала проверяем текст на очень жестокое содержимое, чтобы не пытаться генерировать изображение
-            extremely_violent_words = [
-                "кровь", "пытки", "расстреляли", "убили", "пули", "трупы", "пытка", 
-                "изуродованы", "оторвало", "blood", "torture", "shot", "killed", "bullets",
-                "corpses", "mutilated", "dismembered", "gore", "visceral"
-            ]
-            
-            # Проверяем наличие очень жестокого содержимого
-            contains_extreme_violence = any(word in diary_text.lower() for word in extremely_violent_words)
+            contains_extreme_violence = EXTREME_VIOLENCE in content_screener.categories(diary_text)
             
             # Если обнаружен очень жестокий контент, сразу возвращаем ошибку политики содержания
             if contains_extreme_violence:
@@ -619,7 +1050,7 @@ class WarDiaryAnalyzer:
             
             # Пытаемся сгенерировать изображение
             try:
-                result = self.generate_image(direct_prompt)
+                result = self.generate_image(direct_prompt, policy_gate=True)
                 print(f"Ответ от API получен для изображения: {result}")
                 return result
             except Exception as direct_image_error:
@@ -720,36 +1151,43 @@ class WarDiaryAnalyzer:
                 # Добавляем метку, что это альтернативная/безопасная версия
                 if result.get('success'):
                     result['is_safe_alternative'] = True
-                
-                return result
+                    return result
+                error_message = result.get('error', 'Неизвестная ошибка')
             except Exception as image_error:
                 print(f"Ошибка при генерации безопасного изображения: {str(image_error)}")
-                
-                # Если даже этот безопасный промпт не прошел, пробуем супер-безопасный вариант
-                try:
-                    print("Пробуем ультра-безопасный вариант генерации...")
-                    super_safe_prompt = """
-                    Create a symbolic artistic painting showing an old Russian/Soviet journal and personal items from 1941-1945 Great Patriotic War 
-                    on a wooden desk next to a window. The window shows a peaceful Eastern European landscape at sunset. 
-                    Include subtle elements that suggest Soviet wartime context - medals, propaganda poster on wall, etc.
-                    Style: detailed oil painting with warm lighting.
-                    """
-                    
-                    super_safe_result = self.generate_image(super_safe_prompt)
-                    print(f"Ответ от API получен для ультра-безопасного изображения: {super_safe_result}")
-                    
-                    if super_safe_result.get('success'):
-                        super_safe_result['is_safe_alternative'] = True
-                        return super_safe_result
-                except Exception as super_safe_error:
-                    print(f"Ошибка при ультра-безопасной генерации: {str(super_safe_error)}")
-                
-                # Если все попытки провалились
+                error_message = str(image_error)
+            
+            # Если даже этот безопасный промпт не прошел, отдаем заранее сгенерированный вариант
+            pooled_path = safe_image_pool.pick()
+            if pooled_path:
+                print(f"Используем заранее сгенерированное безопасное изображение: {pooled_path}")
                 return {
-                    'success': False,
-                    'error': f"Не удалось создать даже безопасную версию изображения: {str(image_error)}",
-                    'is_safe_alternative': True
+                    'success': True,
+                    'image_url': '',
+                    'local_path': pooled_path.replace("\\", "/"),
+                    'filename': os.path.basename(pooled_path),
+                    'is_safe_alternative': True,
+                    'from_pool': True
                 }
+            
+            # Пул еще пуст: пробуем супер-безопасный вариант напрямую
+            try:
+                print("Пробуем ультра-безопасный вариант генерации...")
+                super_safe_result = self.generate_image(SUPER_SAFE_IMAGE_PROMPT)
+                print(f"Ответ от API получен для ультра-безопасного изображения: {super_safe_result}")
+                
+                if super_safe_result.get('success'):
+                    super_safe_result['is_safe_alternative'] = True
+                    return super_safe_result
+            except Exception as super_safe_error:
+                print(f"Ошибка при ультра-безопасной генерации: {str(super_safe_error)}")
+            
+            # Если все попытки провалились
+            return {
+                'success': False,
+                'error': f"Не удалось создать даже безопасную версию изображения: {error_message}",
+                'is_safe_alternative': True
+            }
                 
         except Exception as e:
             print(f"Ошибка при подготовке безопасного изображения: {str(e)}")
@@ -901,10 +1339,11 @@ class WarDiaryAnalyzer:
                 "Accept": "application/json"
             }
             print(f"Отправка запроса к Suno API с данными: {json.dumps(request_data, ensure_ascii=False)[:200]}...")
-            response = requests.post(
+            response = self.http.post(
                 "https://apibox.erweima.ai/api/v1/generate",
                 json=request_data,
-                headers=headers
+                headers=headers,
+                timeout=60
             )
             print(f"Получен ответ от Suno API, код: {response.status_code}")
             if response.status_code == 200:
@@ -948,11 +1387,9 @@ class WarDiaryAnalyzer:
                     'created_at': datetime.now().isoformat(),
                     'callback_url': callback_url,
                 }
-                os.makedirs(os.path.join('static', 'generated_music'), exist_ok=True)
-                metadata_filename = f"music_metadata_{task_id}.json"
-                metadata_path = os.path.join('static', 'generated_music', metadata_filename)
-                with open(metadata_path, 'w', encoding='utf-8') as f:
-                    json.dump(music_metadata, f, ensure_ascii=False, indent=2)
+                metadata_store.save(task_id, music_metadata)
+                # Статус задачи дальше отслеживает фоновый опрос Suno
+                music_poller.track(task_id)
                 music_description = f"Сгенерирована {mood} {style} музыка, отражающая "
                 music_description += f"{', '.join(music_metadata['emotions'] if music_metadata['emotions'] else ['различные'])} эмоции. "
                 music_description += f"Использует {instruments}."
@@ -962,8 +1399,7 @@ class WarDiaryAnalyzer:
                     'task_id': task_id,
                     'music_description': music_description,
                     'audio_url': None,
-                    'metadata': music_metadata,
-                    'metadata_path': metadata_path
+                    'metadata': music_metadata
                 }
             else:
                 error_msg = f"Ошибка Suno API: {response.status_code}"
@@ -981,8 +1417,8 @@ class WarDiaryAnalyzer:
     
     def _check_music_status_via_api(self, task_id):
         """
-        Выполняет прямой запрос к Suno API для проверки статуса задачи.
-        Добавляет задержку перед первой проверкой и пробует альтернативные endpoint'ы.
+        Выполняет однократную проверку статуса задачи через Suno API, пробуя альтернативные endpoint'ы.
+        Не ждет и не повторяет попытки: интервалы между проверками задает фоновый опрос (music_poller).
         """
         if not self.suno_api_key or not task_id:
             return {
@@ -998,10 +1434,6 @@ class WarDiaryAnalyzer:
                 "Accept": "application/json"
             }
             
-            # Задержка перед первой проверкой (важно для Suno)
-            print(f"Жду 10 секунд перед первой проверкой статуса задачи {task_id}...")
-            time.sleep(10)
-            
             # Список endpoint'ов для проверки статуса
             endpoints = [
                 f"https://apibox.erweima.ai/api/v1/tasks/{task_id}",
@@ -1009,105 +1441,100 @@ class WarDiaryAnalyzer:
                 f"https://apibox.erweima.ai/api/v1/music/{task_id}"
             ]
             
-            delays = [0, 5, 10, 15, 20, 30]  # Интервалы между попытками
             last_error = None
-            for attempt in range(len(delays)):
-                if attempt > 0:
-                    print(f"Повторная попытка проверки статуса через {delays[attempt]} секунд...")
-                    time.sleep(delays[attempt])
-                for url in endpoints:
-                    print(f"Проверяю статус задачи через endpoint: {url}")
-                    try:
-                        response = requests.get(url, headers=headers, timeout=30)
-                        print(f"Ответ [{response.status_code}] от {url}: {response.text[:300]}")
-                        if response.status_code == 200:
-                            try:
-                                result = response.json()
-                                print(f"JSON-ответ: {json.dumps(result, ensure_ascii=False)[:300]}")
-                                api_code = result.get('code')
-                                if api_code == 200:
-                                    data = result.get('data', {})
-                                    status = data.get('status', 'unknown')
-                                    is_complete = status == 'complete' or data.get('isFinish', False)
-                                    tracks = data.get('tracks', [])
-                                    audio_url = ""
-                                    stream_url = ""
-                                    if tracks and isinstance(tracks, list) and len(tracks) > 0:
-                                        first_track = tracks[0]
-                                        audio_url = (first_track.get('audio_url') or 
-                                                     first_track.get('audioUrl') or 
-                                                     first_track.get('url') or 
-                                                     '')
-                                        stream_url = (first_track.get('stream_audio_url') or 
-                                                     first_track.get('streamAudioUrl') or 
-                                                     first_track.get('streamUrl') or 
-                                                     first_track.get('stream_url') or 
-                                                     '')
-                                    else:
-                                        audio_url = (data.get('audio_url') or 
-                                                    data.get('audioUrl') or 
-                                                    data.get('url') or 
+            for url in endpoints:
+                print(f"Проверяю статус задачи через endpoint: {url}")
+                try:
+                    response = self.http.get(url, headers=headers, timeout=30)
+                    print(f"Ответ [{response.status_code}] от {url}: {response.text[:300]}")
+                    if response.status_code == 200:
+                        try:
+                            result = response.json()
+                            print(f"JSON-ответ: {json.dumps(result, ensure_ascii=False)[:300]}")
+                            api_code = result.get('code')
+                            if api_code == 200:
+                                data = result.get('data', {})
+                                status = data.get('status', 'unknown')
+                                is_complete = status == 'complete' or data.get('isFinish', False)
+                                tracks = data.get('tracks', [])
+                                audio_url = ""
+                                stream_url = ""
+                                if tracks and isinstance(tracks, list) and len(tracks) > 0:
+                                    first_track = tracks[0]
+                                    audio_url = (first_track.get('audio_url') or 
+                                                 first_track.get('audioUrl') or 
+                                                 first_track.get('url') or 
+                                                 '')
+                                    stream_url = (first_track.get('stream_audio_url') or 
+                                                 first_track.get('streamAudioUrl') or 
+                                                 first_track.get('streamUrl') or 
+                                                 first_track.get('stream_url') or 
+                                                 '')
+                                else:
+                                    audio_url = (data.get('audio_url') or 
+                                                data.get('audioUrl') or 
+                                                data.get('url') or 
+                                                '')
+                                    stream_url = (data.get('stream_audio_url') or 
+                                                 data.get('streamAudioUrl') or 
+                                                 data.get('streamUrl') or 
+                                                 data.get('stream_url') or 
+                                                 '')
+                                # Пробуем получить дополнительные данные
+                                results = data.get('results', {})
+                                if results and isinstance(results, dict):
+                                    if not audio_url:
+                                        audio_url = (results.get('audio_url') or 
+                                                    results.get('audioUrl') or 
+                                                    results.get('url') or 
                                                     '')
-                                        stream_url = (data.get('stream_audio_url') or 
-                                                     data.get('streamAudioUrl') or 
-                                                     data.get('streamUrl') or 
-                                                     data.get('stream_url') or 
+                                    if not stream_url:
+                                        stream_url = (results.get('stream_audio_url') or 
+                                                     results.get('streamAudioUrl') or 
+                                                     results.get('streamUrl') or 
+                                                     results.get('stream_url') or 
                                                      '')
-                                    # Пробуем получить дополнительные данные
-                                    results = data.get('results', {})
-                                    if results and isinstance(results, dict):
-                                        if not audio_url:
-                                            audio_url = (results.get('audio_url') or 
-                                                        results.get('audioUrl') or 
-                                                        results.get('url') or 
-                                                        '')
-                                        if not stream_url:
-                                            stream_url = (results.get('stream_audio_url') or 
-                                                         results.get('streamAudioUrl') or 
-                                                         results.get('streamUrl') or 
-                                                         results.get('stream_url') or 
-                                                         '')
-                                    if is_complete and not audio_url and not stream_url:
-                                        print("Внимание: Задача отмечена как завершенная, но нет URL аудио")
-                                        is_complete = False
-                                    return {
-                                        'success': True,
-                                        'api_status': status,
-                                        'is_complete': is_complete,
-                                        'audio_url': audio_url,
-                                        'stream_url': stream_url,
-                                        'data': data
-                                    }
-                                else:
-                                    error_msg = result.get('msg', f"Код ошибки API: {api_code}")
-                                    print(f"API вернул ошибку {api_code}: {error_msg}")
-                                    last_error = error_msg
-                                    continue
-                            except Exception as e:
-                                print(f"Ошибка при обработке ответа API: {str(e)}")
-                                last_error = str(e)
+                                if is_complete and not audio_url and not stream_url:
+                                    print("Внимание: Задача отмечена как завершенная, но нет URL аудио")
+                                    is_complete = False
+                                return {
+                                    'success': True,
+                                    'api_status': status,
+                                    'is_complete': is_complete,
+                                    'audio_url': audio_url,
+                                    'stream_url': stream_url,
+                                    'data': data
+                                }
+                            else:
+                                error_msg = result.get('msg', f"Код ошибки API: {api_code}")
+                                print(f"API вернул ошибку {api_code}: {error_msg}")
+                                last_error = error_msg
                                 continue
-                        elif response.status_code == 404:
-                            print(f"Endpoint {url} вернул 404 (не найдено) — задача, возможно, ещё в очереди")
-                            # Возвращаем статус 'processing', если не истёк таймаут
-                            return {
-                                'success': True,
-                                'api_status': 'processing',
-                                'is_complete': False,
-                                'audio_url': '',
-                                'stream_url': '',
-                                'data': {},
-                                'message': 'Задача ещё в очереди на генерацию (Suno API вернул 404)'
-                            }
-                        else:
-                            error_msg = f"Ошибка запроса к API: {response.status_code} - {response.text}"
-                            print(error_msg)
-                            last_error = error_msg
+                        except Exception as e:
+                            print(f"Ошибка при обработке ответа API: {str(e)}")
+                            last_error = str(e)
                             continue
-                    except Exception as e:
-                        print(f"Ошибка при запросе к {url}: {str(e)}")
-                        last_error = str(e)
+                    elif response.status_code == 404:
+                        print(f"Endpoint {url} вернул 404 (не найдено) — задача, возможно, ещё в очереди")
+                        # Возвращаем статус 'processing', если не истёк таймаут
+                        return {
+                            'success': True,
+                            'api_status': 'processing',
+                            'is_complete': False,
+                            'audio_url': '',
+                            'stream_url': '',
+                            'data': {},
+                            'message': 'Задача ещё в очереди на генерацию (Suno API вернул 404)'
+                        }
+                    else:
+                        error_msg = f"Ошибка запроса к API: {response.status_code} - {response.text}"
+                        print(error_msg)
+                        last_error = error_msg
                         continue
+                except Exception as e:
+                    print(f"Ошибка при запросе к {url}: {str(e)}")
+                    last_error = str(e)
+                    continue
             # Если все попытки не увенчались успехом
             return {
                 'success': False,
@@ -1122,13 +1549,14 @@ class WarDiaryAnalyzer:
                 'api_status': 'error'
             }
     
-    def _check_music_generation_status(self, task_id):
+    def _check_music_generation_status(self, task_id, metadata=None):
         """
         Проверяет статус задачи генерации музыки по task_id.
         Сначала проверяет через API, затем проверяет локальные метаданные.
         
         Args:
             task_id (str): Идентификатор задачи
+            metadata (dict, optional): Уже загруженные метаданные задачи
             
         Returns:
             dict: Информация о статусе задачи и результаты, если задача завершена
@@ -1142,141 +1570,17 @@ class WarDiaryAnalyzer:
                     'message': "Отсутствует идентификатор задачи (task_id)"
                 }
             
-            # Сначала проверяем статус через API
-            api_status = self._check_music_status_via_api(task_id)
-            
-            # Проверяем, что api_status не None
-            if api_status is None:
-                print(f"API вернул None для задачи {task_id}")
-                api_status = {
-                    'success': False,
-                    'error': 'API вернул пустой ответ',
-                    'api_status': 'error'
-                }
-            
-            # Если API вернул статус "error", считаем задачу неуспешной
-            if api_status.get('api_status') == 'error' or (not api_status.get('success') and api_status.get('error')):
-                print(f"API вернул статус 'error' для задачи {task_id}")
-                
-                # Обновляем метаданные
-                metadata_path = os.path.join('static', 'generated_music', f"music_metadata_{task_id}.json")
-                
-                # Пытаемся загрузить существующие метаданные
-                metadata = {}
-                if os.path.exists(metadata_path):
-                    try:
-                        with open(metadata_path, 'r', encoding='utf-8') as f:
-                            metadata = json.load(f)
-                    except Exception as e:
-                        print(f"Ошибка при чтении метаданных: {str(e)}")
-                
-                # Обновляем метаданные с данными из API
-                metadata['status'] = 'error'
-                metadata['last_update'] = datetime.now().isoformat()
-                metadata['error_message'] = api_status.get('error', "Ошибка API Suno при генерации музыки")
-                metadata['api_status'] = 'error'
-                metadata['api_data'] = api_status.get('data', {})
-                
-                # Сохраняем обновленные метаданные
-                try:
-                    os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
-                    with open(metadata_path, 'w', encoding='utf-8') as f:
-                        json.dump(metadata, f, ensure_ascii=False, indent=2)
-                    print(f"Метаданные обновлены с ошибкой: {metadata_path}")
-                except Exception as e:
-                    print(f"Ошибка при сохранении метаданных: {str(e)}")
-                
-                return {
-                    'success': False,
-                    'status': 'error',
-                    'message': api_status.get('error', "API вернул ошибку при генерации музыки. Попробуйте снова."),
-                    'task_id': task_id
-                }
-            
-            # Если получили статус через API и он указывает на завершение задачи
-            if api_status.get('success') and api_status.get('is_complete') and api_status.get('audio_url'):
-                print(f"Задача {task_id} завершена по данным API")
-                
-                # Обновляем метаданные
-                metadata_path = os.path.join('static', 'generated_music', f"music_metadata_{task_id}.json")
-                
-                # Пытаемся загрузить существующие метаданные
-                metadata = {}
-                if os.path.exists(metadata_path):
-                    try:
-                        with open(metadata_path, 'r', encoding='utf-8') as f:
-                            metadata = json.load(f)
-                    except Exception as e:
-                        print(f"Ошибка при чтении метаданных: {str(e)}")
-                
-                # Получаем URL аудио и другие данные
-                audio_url = api_status.get('audio_url', '')
-                stream_url = api_status.get('stream_url', '')
-                
-                # Скачиваем MP3 файл, если есть URL и файл еще не скачан
-                local_audio_path = metadata.get('local_audio_path', '')
-                local_audio_url = metadata.get('local_audio_url', '')
-                
-                # Если локальный аудиофайл указан, но не существует, очищаем путь
-                if local_audio_path and not os.path.exists(local_audio_path):
-                    print(f"Предупреждение: локальный аудиофайл {local_audio_path} не найден")
-                    local_audio_path = ''
-                    local_audio_url = ''
-                
-                # Формируем описание музыки
-                music_description = f"Сгенерирована музыка в стиле {metadata.get('style', 'инструментальный')}."
-                if 'mood' in metadata:
-                    music_description += f" Настроение: {metadata.get('mood')}."
-                if 'emotions' in metadata and metadata['emotions']:
-                    music_description += f" Отражает эмоции: {', '.join(metadata['emotions'])}."
-                
-                return {
-                    'success': True,
-                    'status': 'complete',
-                    'audio_url': audio_url,
-                    'stream_url': stream_url,
-                    'image_url': metadata.get('image_url', ''),
-                    'local_audio_path': local_audio_path,
-                    'local_audio_url': local_audio_url,
-                    'local_image_path': metadata.get('local_image_path', ''),
-                    'local_image_url': metadata.get('local_image_url', ''),
-                    'title': metadata.get('title', ''),
-                    'task_id': task_id,
-                    'music_description': music_description,
-                    'style': metadata.get('style', ''),
-                    'mood': metadata.get('mood', ''),
-                    'emotions': metadata.get('emotions', []),
-                    'emotional_tone': metadata.get('emotional_tone', ''),
-                    'is_music_ready': True if local_audio_path or audio_url else False
-                }
-            
-            # Если API вернул ошибку, но не завершил задачу, используем локальные метаданные
-            if not api_status.get('success') and api_status.get('error'):
-                print(f"Ошибка API при проверке статуса задачи {task_id}: {api_status.get('error')}")
-            
-            # Если API не подтвердил завершение, проверяем локальные метаданные
-            metadata_path = os.path.join('static', 'generated_music', f"music_metadata_{task_id}.json")
-            if not os.path.exists(metadata_path):
+            # Статус читается только из метаданных: их обновляют коллбэк Suno и фоновый опрос
+            # (music_poller), поэтому проверка не ждет ответа API в потоке запроса
+            if metadata is None:
+                metadata = metadata_store.load(task_id)
+            if metadata is None:
                 return {
                     'success': False,
                     'status': 'error',
                     'message': f"Метаданные для задачи {task_id} не найдены. Возможно, задача была удалена."
                 }
             
-            # Загружаем метаданные
-            try:
-                with open(metadata_path, 'r', encoding='utf-8') as f:
-                    metadata = json.load(f)
-                    
-                print(f"Загружены метаданные для задачи {task_id}: {json.dumps(metadata, ensure_ascii=False)[:500]}...")
-            except Exception as e:
-                print(f"Ошибка при чтении метаданных: {str(e)}")
-                return {
-                    'success': False,
-                    'status': 'error',
-                    'message': f"Ошибка при чтении метаданных: {str(e)}"
-                }
-            
             # Если в метаданных уже отмечено завершение, возвращаем результат
             if metadata.get('status') == 'complete' and (metadata.get('audio_url') or metadata.get('stream_url') or metadata.get('local_audio_path')):
                 print(f"Задача {task_id} завершена по локальным метаданным")
@@ -1312,7 +1616,7 @@ class WarDiaryAnalyzer:
                     'title': metadata.get('title', ''),
                     'task_id': task_id,
                     'music_description': music_description,
-                    'is_music_ready': True if local_audio_path or audio_url else False
+                    'is_music_ready': True if local_audio_path or metadata.get('audio_url') else False
                 }
             
             # Если в метаданных статус ошибки, возвращаем ошибку
@@ -1342,11 +1646,9 @@ class WarDiaryAnalyzer:
                 print(f"Превышено время ожидания для задачи {task_id}: {elapsed_seconds:.2f} сек.")
                 
                 # Обновляем метаданные
-                metadata['status'] = 'timeout'
-                metadata['last_update'] = current_time.isoformat()
-                
-                with open(metadata_path, 'w', encoding='utf-8') as f:
-                    json.dump(metadata, f, ensure_ascii=False, indent=2)
+                if metadata_store.compare_and_set(task_id, ('processing',), {
+                        'status': 'timeout', 'last_update': current_time.isoformat()}) is not None:
+                    music_events.publish(task_id, {'status': 'timeout'})
                 
                 return {
                     'success': False,
@@ -1362,21 +1664,8 @@ class WarDiaryAnalyzer:
             # Оценка прогресса на основе времени выполнения (очень примерно)
             progress = min(95, int(elapsed_seconds / max_wait_time * 100))
             
-            # Проверяем, показывает ли API статус ошибки (но задача все еще обрабатывается)
-            api_status_value = "unknown"
-            if api_status is not None:
-                api_status_value = api_status.get('api_status', 'unknown') if api_status.get('success') else 'error'
-            
-            # Если API статус показывает ошибку, но мы до сих пор считаем задачу в процессе, 
-            # устанавливаем флаг ошибки
-            if api_status_value == 'error':
-                return {
-                    'success': False,
-                    'status': 'error',
-                    'message': 'API вернул ошибку. Генерация музыки не может быть завершена.',
-                    'task_id': task_id,
-                    'music_description': metadata.get('music_description', 'Музыка не была сгенерирована из-за ошибки API.')
-                }
+            # Задача могла быть создана до перезапуска процесса: убеждаемся, что она опрашивается
+            music_poller.track(task_id)
             
             # Если ни одно из условий не сработало, возвращаем статус "в процессе"
             return {
@@ -1500,10 +1789,11 @@ class WarDiaryAnalyzer:
             print(f"Отправка запроса к SUNA API с данными: {json.dumps(request_data, ensure_ascii=False)[:200]}...")
             
             # Отправляем запрос на генерацию музыки
-            response = requests.post(
+            response = self.http.post(
                 "https://apibox.erweima.ai/api/v1/generate",
                 json=request_data,
-                headers=headers
+                headers=headers,
+                timeout=60
             )
             
             print(f"Получен ответ от SUNA API, код: {response.status_code}")
@@ -1576,12 +1866,9 @@ class WarDiaryAnalyzer:
                     }
                 }
                 
-                # Сохраняем метаданные в файл
-                metadata_filename = f"music_metadata_{task_id}.json"
-                metadata_path = os.path.join('static', 'generated_music', metadata_filename)
-                
-                with open(metadata_path, 'w', encoding='utf-8') as f:
-                    json.dump(music_metadata, f, ensure_ascii=False, indent=2)
+                # Сохраняем метаданные и передаем задачу фоновому опросу
+                metadata_store.save(task_id, music_metadata)
+                music_poller.track(task_id)
                 
                 # Формируем описание музыки
                 music_description = f"Генерируется {mood} {style} музыка"
@@ -1594,8 +1881,7 @@ class WarDiaryAnalyzer:
                     'status': 'processing',
                     'task_id': task_id,
                     'music_description': music_description,
-                    'metadata': music_metadata,
-                    'metadata_path': metadata_path
+                    'metadata': music_metadata
                 }
             else:
                 # Обработка ошибок API
@@ -1622,7 +1908,8 @@ class WarDiaryAnalyzer:
     
     def _determine_music_params(self, emotion_analysis):
         """
-        Определяет музыкальные параметры на основе эмоционального анализа.
+        Определяет музыкальные параметры на основе эмоционального анализа
+        (по таблице music_params.MUSIC_TABLE).
         
         Args:
             emotion_analysis (dict): Эмоциональный анализ
@@ -1630,111 +1917,99 @@ class WarDiaryAnalyzer:
         Returns:
             tuple: (стиль, настроение, темп, инструменты)
         """
-        # Если нет анализа эмоций, возвращаем базовые параметры
-        if not emotion_analysis or not isinstance(emotion_analysis, dict) or 'primary_emotions' not in emotion_analysis:
-            return "Orchestral", "dramatic", "moderate", "orchestra and piano"
-        
-        # Безопасно получаем эмоции и их интенсивность
-        emotions = []
-        intensities = []
-        
         try:
-            primary_emotions = emotion_analysis.get('primary_emotions', [])
-            if isinstance(primary_emotions, list) and primary_emotions:
-                for e in primary_emotions:
-                    if isinstance(e, dict):
-                        if 'emotion' in e:
-                            emotions.append(e['emotion'])
-                        if 'intensity' in e and isinstance(e['intensity'], (int, float)):
-                            intensities.append(e['intensity'])
+            return determine_music_params(emotion_analysis)
         except Exception as e:
-            print(f"Ошибка при извлечении эмоций: {str(e)}")
+            print(f"Ошибка при определении музыкальных параметров: {str(e)}")
+            return DEFAULT_MUSIC_PARAMS
+
+    def run_generation_stages(self, diary_text, emotion_analysis, generation_types, base_url=None, timeouts=None,
+                              on_stage_done=None):
+        """
+        Параллельно запускает выбранные этапы генерации в общем пуле потоков.
+        Время выполнения определяется самым медленным этапом, а не суммой всех.
+        
+        Args:
+            diary_text (str): Текст дневника
+            emotion_analysis (dict): Результаты анализа эмоций
+            generation_types (list): Типы генерации: 'text', 'image', 'music'
+            base_url (str, optional): Базовый URL для callback от Suno API
+            timeouts (dict, optional): Таймауты этапов в секундах (по умолчанию STAGE_TIMEOUTS)
+            on_stage_done (callable, optional): Вызывается как on_stage_done(stage, result) сразу после
+                завершения этапа без исключения (в том числе этапа, завершившегося после таймаута)
+            
+        Returns:
+            dict: Результаты по этапам в том же формате, что возвращают методы генерации
+        """
+        timeouts = timeouts or STAGE_TIMEOUTS
+        stages = {
+            'text': lambda: self.generate_literary_work(diary_text, emotion_analysis),
+            'image': lambda: self.generate_image_from_diary(diary_text, emotion_analysis),
+            'music': lambda: self.generate_music(diary_text, emotion_analysis, base_url=base_url),
+        }
         
-        if not emotions:
-            # Если не удалось получить эмоции, используем значения по умолчанию
-            return "Orchestral", "dramatic", "moderate", "orchestra and piano"
+        overruns = overrun_stage_count()
+        if overruns >= GENERATION_WORKERS:
+            print(f"Все {GENERATION_WORKERS} потоков пула генерации заняты этапами после таймаута, "
+                  f"новые этапы будут ждать в очереди")
         
-        avg_intensity = sum(intensities) / len(intensities) if intensities else 5
+        started_at = time.time()
+        futures = {}
+        for stage, func in stages.items():
+            if stage in generation_types:
+                print(f"Запуск этапа генерации '{stage}'")
+                futures[stage] = generation_executor.submit(func)
+                if on_stage_done is not None:
+                    futures[stage].add_done_callback(
+                        lambda future, stage=stage: self._notify_stage_done(on_stage_done, stage, future))
         
+        results = {}
+        for stage, future in futures.items():
+            # Таймаут отсчитывается от момента запуска всех этапов
+            remaining = max(0, started_at + timeouts.get(stage, 180) - time.time())
+            try:
+                results[stage] = future.result(timeout=remaining)
+                print(f"Этап '{stage}' завершен за {time.time() - started_at:.2f} секунд")
+            except FutureTimeoutError:
+                print(f"Превышено время ожидания этапа '{stage}' ({timeouts.get(stage, 180)} сек.)")
+                abandon_stage(stage, future)
+                results[stage] = self._stage_error(stage, f"Превышено время ожидания ({timeouts.get(stage, 180)} сек.)")
+            except Exception as e:
+                print(f"Ошибка на этапе '{stage}': {str(e)}")
+                import traceback
+                traceback.print_exc()
+                results[stage] = self._stage_error(stage, str(e))
+        
+        return results
+
+    @staticmethod
+    def _notify_stage_done(on_stage_done, stage, future):
+        if future.cancelled() or future.exception() is not None:
+            return
         try:
-            # Определяем стиль музыки на основе эмоций
-            style = self._determine_music_genre(emotions)
-            
-            # Определяем настроение
-            if any(e.lower() in ['страх', 'ужас', 'тревога', 'fear', 'anxiety', 'panic', 'terror'] for e in emotions):
-                mood = "tense"
-            elif any(e.lower() in ['грусть', 'печаль', 'скорбь', 'sadness', 'grief', 'sorrow', 'melancholy'] for e in emotions):
-                mood = "melancholic"
-            elif any(e.lower() in ['надежда', 'радость', 'счастье', 'hope', 'joy', 'happiness'] for e in emotions):
-                mood = "hopeful"
-            elif any(e.lower() in ['гордость', 'отвага', 'мужество', 'courage', 'bravery', 'valor'] for e in emotions):
-                mood = "heroic"
-            else:
-                mood = "dramatic"
-            
-            # Определяем темп
-            tempo = self._determine_tempo(emotions, intensities)
-            
-            # Определяем инструменты
-            instruments = self._determine_instruments(emotions)
-            
-            return style, mood, tempo, instruments
+            on_stage_done(stage, future.result())
         except Exception as e:
-            print(f"Ошибка при определении музыкальных параметров: {str(e)}")
-            return "Orchestral", "dramatic", "moderate", "orchestra and piano"
+            print(f"Ошибка в обработчике завершения этапа '{stage}': {str(e)}")
 
-    def _determine_music_genre(self, emotions):
-        """Определяет жанр музыки на основе эмоций"""
-        if any(e.lower() in ['страх', 'ужас', 'тревога', 'fear', 'anxiety', 'panic', 'terror'] for e in emotions):
-            return "Cinematic Suspense"
-        elif any(e.lower() in ['грусть', 'печаль', 'скорбь', 'sadness', 'grief', 'sorrow', 'melancholy'] for e in emotions):
-            return "Neoclassical Piano"
-        elif any(e.lower() in ['надежда', 'радость', 'hope', 'joy', 'happiness'] for e in emotions):
-            return "Uplifting Orchestral"
-        elif any(e.lower() in ['гордость', 'отвага', 'мужество', 'courage', 'bravery', 'valor'] for e in emotions):
-            return "Epic Orchestral" 
-        elif any(e.lower() in ['решимость', 'determination', 'resolve', 'conviction'] for e in emotions):
-            return "Dramatic Orchestral"
-        else:
-            return "Dramatic Film Score"
-    
-    def _determine_tempo(self, emotions, intensities):
-        """Определяет темп музыки на основе эмоций и их интенсивности"""
-        avg_intensity = sum(intensities) / len(intensities) if intensities else 5
-        
-        if any(e.lower() in ['страх', 'fear', 'anxiety', 'panic', 'terror'] for e in emotions) and avg_intensity > 7:
-            return "fast-paced and intense"
-        elif any(e.lower() in ['грусть', 'печаль', 'sadness', 'grief', 'sorrow'] for e in emotions):
-            return "slow and contemplative"
-        elif any(e.lower() in ['гордость', 'отвага', 'courage', 'valor'] for e in emotions):
-            return "steady and powerful"
-        elif avg_intensity > 7:
-            return "dynamic with building tension"
-        else:
-            return "moderate with emotional depth"
-    
-    def _determine_instruments(self, emotions):
-        """Определяет инструменты на основе эмоций"""
-        if any(e.lower() in ['страх', 'ужас', 'тревога', 'fear', 'anxiety', 'panic', 'terror'] for e in emotions):
-            return "low strings and percussion"
-        elif any(e.lower() in ['грусть', 'печаль', 'скорбь', 'sadness', 'grief', 'sorrow'] for e in emotions):
-            return "cello and piano"
-        elif any(e.lower() in ['надежда', 'hope', 'joy', 'happiness'] for e in emotions):
-            return "strings and woodwinds"
-        elif any(e.lower() in ['гордость', 'мужество', 'отвага', 'courage', 'bravery', 'heroism'] for e in emotions):
-            return "brass and timpani"
-        elif any(e.lower() in ['решимость', 'determination', 'resolve'] for e in emotions):
-            return "brass and strings"
-        else:
-            return "full orchestra with piano accents"
+    def _stage_error(self, stage, message):
+        """
+        Формирует результат неуспешного этапа в формате соответствующего метода генерации.
+        """
+        if stage == 'text':
+            return f"Произошла ошибка при генерации текста: {message}"
+        return {
+            'success': False,
+            'error': message
+        }
 
-    def process_diary(self, diary_text, generation_type='text'):
+    def process_diary(self, diary_text, generation_type='text', concurrent=True):
         """
         Основной метод для обработки текста дневника.
         
         Args:
             diary_text (str): Текст дневника для анализа
             generation_type (str): Тип генерации: 'text', 'image', 'music' или 'all'
+            concurrent (bool): Выполнять этапы генерации параллельно
             
         Returns:
             dict: Результаты анализа и генерации
@@ -1763,6 +2038,17 @@ class WarDiaryAnalyzer:
             }
             
             # Генерация выбранного типа контента
+            if concurrent:
+                generation_types = ['text', 'image', 'music'] if generation_type == 'all' else [generation_type]
+                stage_results = self.run_generation_stages(diary_text, emotions, generation_types)
+                if 'text' in stage_results:
+                    result['generated_literary_work'] = stage_results['text']
+                if 'image' in stage_results:
+                    result['generated_image'] = stage_results['image']
+                if 'music' in stage_results:
+                    result['generated_music'] = stage_results['music']
+                return result
+            
             if generation_type in ['text', 'all']:
                 # Генерация художественного произведения
                 print("Начало генерации художественного произведения")
@@ -1849,14 +2135,11 @@ class WarDiaryAnalyzer:
             }
             
             # Сохраняем метаданные
-            metadata_path = os.path.join('static', 'generated_music', f'music_metadata_{task_id}.json')
-            with open(metadata_path, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
+            metadata_store.save(task_id, metadata)
             
             return {
                 'success': True,
-                'task_id': task_id,
-                'metadata_path': metadata_path
+                'task_id': task_id
             }
         except Exception as e:
             print(f"Ошибка при обработке данных из callback от Suno API: {str(e)}")
@@ -1866,6 +2149,24 @@ class WarDiaryAnalyzer:
                 'task_id': task_id
             }
 
+_shared_analyzer = None
+_shared_analyzer_lock = threading.Lock()
+
+
+def get_analyzer():
+    """
+    Возвращает общий для процесса экземпляр WarDiaryAnalyzer.
+    Экземпляр создается один раз при первом обращении; клиенты OpenAI и requests
+    потокобезопасны, поэтому анализатор можно использовать из разных потоков запросов.
+    """
+    global _shared_analyzer
+    if _shared_analyzer is None:
+        with _shared_analyzer_lock:
+            if _shared_analyzer is None:
+                _shared_analyzer = WarDiaryAnalyzer()
+    return _shared_analyzer
+
+
 def main():
     """
     Пример использования анализатора дневников
@@ -1879,7 +2180,7 @@ def main():
     """
     
     try:
-        analyzer = WarDiaryAnalyzer()
+        analyzer = get_analyzer()
         results = analyzer.process_diary(sample_diary)
         
         # Сохранение только сгенерированного произведения